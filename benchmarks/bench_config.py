@@ -0,0 +1,194 @@
+"""Runtime library benchmarks for configuration
+
+Run from the repository root with `python benchmarks/bench_config.py`
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import tempfile
+
+# Add the benchmarks parent directory to be able to include runtime module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meg_runtime.config import Config  # noqa: E402
+
+
+# Report the rate of a benchmarked statement
+def report(name, seconds, count):
+    """Report the rate of a benchmarked statement"""
+    print(f'{name:<48} {count / seconds:>14,.0f} /sec')
+
+
+# Benchmark configuration lookups with and without the resolved value cache
+def bench_get(count=100000):
+    """Benchmark configuration lookups with and without the resolved value cache"""
+    Config.clear()
+    for key in ['path/plugin_cache', 'path/downloads', 'path/no/key']:
+        # Resolve the key without the cache
+        seconds = timeit.timeit(lambda: (Config._rebuild(False), Config.get(key)), number=count // 10)
+        report(f'Config.get({key!r}) after rebuild', seconds, count // 10)
+        # Resolve the key with the cache
+        seconds = timeit.timeit(lambda: Config.get(key), number=count)
+        report(f'Config.get({key!r}) cached', seconds, count)
+        seconds = timeit.timeit(lambda: Config.exists(key), number=count)
+        report(f'Config.exists({key!r})', seconds, count)
+
+
+# Benchmark fully expanding trees of interpolated keys
+def bench_expand(sizes=(1000, 2000, 4000, 8000)):
+    """Benchmark fully expanding trees of interpolated keys"""
+    for size in sizes:
+        Config.clear()
+        # Each key references its parent key in a binary tree, so every key depends on the first key
+        start = time.perf_counter()
+        Config.set('bench/key0', 'value')
+        for i in range(1, size):
+            Config.set(f'bench/key{i}', f'$(bench/key{(i - 1) // 2})/{i}')
+        report(f'Config.set tree of {size} keys', time.perf_counter() - start, size)
+        # Expand every key once
+        start = time.perf_counter()
+        for i in range(size):
+            Config.get(f'bench/key{i}')
+        report(f'Config.get tree of {size} keys', time.perf_counter() - start, size)
+        # Change the first key so every other key is expanded again
+        start = time.perf_counter()
+        Config.set('bench/key0', 'changed')
+        for i in range(size):
+            Config.get(f'bench/key{i}')
+        report(f'Config.set first and get tree of {size} keys', time.perf_counter() - start, size)
+
+
+# Benchmark saving a large configuration with and without changes
+def bench_save(size=20000, count=20):
+    """Benchmark saving a large configuration with and without changes"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        Config.clear()
+        config_path = os.path.join(temp_path, 'config.json')
+        # Create a large configuration of plugin option blocks
+        for i in range(size):
+            Config.set(f'options/plugin{i // 100}/option{i % 100}', f'value {i}')
+        # Save with a change every time
+        start = time.perf_counter()
+        for i in range(count):
+            Config.set('options/changed', i)
+            Config.save(config_path)
+        seconds = time.perf_counter() - start
+        print(f'Config.save {size} keys changed {seconds / count * 1000:>28.2f} ms')
+        # Save without changes
+        start = time.perf_counter()
+        for i in range(count):
+            Config.save(config_path)
+        seconds = time.perf_counter() - start
+        print(f'Config.save {size} keys unchanged {seconds / count * 1000:>26.2f} ms')
+        # Coalesce a burst of saves
+        start = time.perf_counter()
+        for i in range(count):
+            Config.set('options/changed', -i)
+            Config.save(config_path, delay=60)
+        Config.flush()
+        seconds = time.perf_counter() - start
+        print(f'Config.save {size} keys burst of {count} delayed {seconds * 1000:>19.2f} ms')
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark loading a multi-megabyte configuration eagerly and lazily
+def bench_load(repositories=2000, options=50, count=10):
+    """Benchmark loading a multi-megabyte configuration eagerly and lazily"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        # Create a large machine generated configuration
+        config_path = os.path.join(temp_path, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({
+                'path': {'home': temp_path},
+                'plugins': ['test'],
+                'repositories': {f'repo{i}': {f'option{j}': f'$(path/home)/repo{i}/{j}' for j in range(options)} for i in range(repositories)},
+                'options': {f'plugin{i}': {f'option{j}': j for j in range(options)} for i in range(repositories)},
+            }, config_file, indent=2)
+        print(f'Config.load {os.path.getsize(config_path) / 1024 / 1024:.1f} MB configuration')
+        for lazy in [False, True]:
+            # Load and get the keys used at startup
+            start = time.perf_counter()
+            for i in range(count):
+                Config.load(config_path, lazy=lazy)
+                Config.get('path/plugin_cache')
+                Config.get('plugins')
+            seconds = time.perf_counter() - start
+            print(f'Config.load {"lazy" if lazy else "eager"} startup {seconds / count * 1000:>30.2f} ms')
+        Config.clear()
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark switching between repository configuration layers on a large user configuration
+def bench_layers(size=20000, options=50, count=100):
+    """Benchmark switching between repository configuration layers on a large user configuration"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        Config.clear()
+        for i in range(size):
+            Config.set(f'bench/key{i}', f'$(path/home)/{i}')
+        # Create two repositories that override a few options
+        repo_paths = []
+        for repo in range(2):
+            repo_paths.append(os.path.join(temp_path, f'repo{repo}'))
+            os.makedirs(os.path.join(repo_paths[-1], '.meg'))
+            with open(os.path.join(repo_paths[-1], Config.REPOSITORY_CONFIG_PATH), 'w') as config_file:
+                json.dump({'bench': {f'key{i}': f'repo{repo}/{i}' for i in range(options)}}, config_file)
+        # Switch the repository layer and get the overridden and untouched keys
+        start = time.perf_counter()
+        for i in range(count):
+            Config.load_repository(repo_paths[i % 2])
+            Config.get('bench/key0')
+            Config.get(f'bench/key{size - 1}')
+        seconds = time.perf_counter() - start
+        report(f'Config.load_repository ({size} user keys)', seconds, count)
+        Config.clear()
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark reloading a large configuration file compared to loading it again
+def bench_reload(size=20000, count=20):
+    """Benchmark reloading a large configuration file compared to loading it again"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(temp_path, 'config.json')
+        Config.clear()
+        for i in range(size):
+            Config.set(f'bench/key{i}', f'$(path/home)/{i}')
+        Config.save(config_path)
+        Config.subscribe('bench/key0', lambda key, value: None)
+        # Load again, reload unchanged and reload with one changed key
+        seconds = timeit.timeit(lambda: Config.load(config_path), number=count)
+        report(f'Config.load ({size} keys)', seconds, count)
+        seconds = timeit.timeit(lambda: Config.reload(config_path), number=count)
+        report(f'Config.reload unchanged ({size} keys)', seconds, count)
+        start = time.perf_counter()
+        for i in range(count):
+            with open(config_path) as config_file:
+                config = json.load(config_file)
+            config['bench']['key0'] = str(i)
+            with open(config_path, 'w') as config_file:
+                json.dump(config, config_file)
+            Config.reload(config_path)
+        seconds = time.perf_counter() - start
+        report(f'Config.reload one changed key ({size} keys)', seconds, count)
+        Config.clear()
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+if __name__ == '__main__':
+    bench_get()
+    bench_expand()
+    bench_save()
+    bench_load()
+    bench_layers()
+    bench_reload()
@@ -0,0 +1,166 @@
+"""Runtime library benchmarks for downloads
+
+Run from the repository root with `python benchmarks/bench_downloads.py`
+"""
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Add the benchmarks parent directory to be able to include runtime module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meg_runtime.config import Config  # noqa: E402
+
+
+# HTTP request handler streaming generated archives of the size in the url path
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    """HTTP request handler streaming generated archives of the size in the url path"""
+
+    # Use persistent connections
+    protocol_version = 'HTTP/1.1'
+    # The block of content repeated to generate archives
+    block = os.urandom(1024 * 1024)
+    # The number of content bytes sent
+    sent = 0
+    # The simulated latency in seconds and bandwidth in bytes per second of each connection, if any
+    latency = 0
+    bandwidth = None
+
+    # Stream the generated archive
+    def do_GET(self):
+        """Stream the generated archive"""
+        size = int(self.path.strip('/').split('/')[-1].split('.')[0])
+        time.sleep(ArchiveRequestHandler.latency)
+        # The generated content never changes
+        if self.headers.get('If-None-Match') == f'"{size}"':
+            self.send_response(304)
+            self.send_header('ETag', f'"{size}"')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('ETag', f'"{size}"')
+        self.end_headers()
+        # Send blocks of the maximum size that can be sent in a tenth of a second, if the bandwidth is simulated
+        block = ArchiveRequestHandler.block
+        if ArchiveRequestHandler.bandwidth is not None:
+            block = block[:ArchiveRequestHandler.bandwidth // 10]
+        while size > 0:
+            self.wfile.write(block[:size])
+            ArchiveRequestHandler.sent += min(size, len(block))
+            size -= len(block)
+            if ArchiveRequestHandler.bandwidth is not None:
+                time.sleep(0.1)
+
+    # Do not log requests
+    def log_message(self, format, *args):
+        """Do not log requests"""
+        pass
+
+
+# Start a local HTTP server streaming generated archives
+def start_server():
+    """Start a local HTTP server streaming generated archives"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+# Download an archive in this process and report the time and peak resident memory
+def download(mode, url, path):
+    """Download an archive in this process and report the time and peak resident memory"""
+    start = time.perf_counter()
+    if mode == 'memory':
+        # The previous implementation holding the whole content in memory
+        import requests
+        open(path, 'wb').write(requests.get(url, allow_redirects=True).content)
+    else:
+        Config.download(url, path, cache=False)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Config.download {mode:<8} {os.path.getsize(path) / 1024 / 1024:>6.0f} MB {seconds:>8.2f} s {peak:>10.1f} MB peak RSS')
+
+
+# Benchmark downloading large archives streaming compared to in memory
+def bench_download(sizes=(100, 300)):
+    """Benchmark downloading large archives streaming compared to in memory"""
+    server, url = start_server()
+    temp_path = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for mode in ['memory', 'stream']:
+                # Run each download in a new process to measure the peak resident memory of only that download
+                path = os.path.join(temp_path, f'{mode}-{size}.zip')
+                subprocess.run([sys.executable, os.path.abspath(__file__), mode, f'{url}/{size * 1024 * 1024}.zip', path], check=True)
+                os.remove(path)
+    finally:
+        server.shutdown()
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark repeatedly downloading the same archive with and without the download cache
+def bench_cache(size=100, count=5):
+    """Benchmark repeatedly downloading the same archive with and without the download cache"""
+    server, url = start_server()
+    temp_path = tempfile.mkdtemp()
+    try:
+        Config.set('path/download_cache', os.path.join(temp_path, 'cache'))
+        for cache in [False, True]:
+            downloads_path = os.path.join(temp_path, 'cached' if cache else 'uncached')
+            os.makedirs(downloads_path)
+            ArchiveRequestHandler.sent = 0
+            start = time.perf_counter()
+            for i in range(count):
+                # Download to the same directory like repeatedly installing the same plugin archive
+                Config.download(f'{url}/{size * 1024 * 1024}.zip', os.path.join(downloads_path, 'archive.zip'), cache=cache)
+            seconds = time.perf_counter() - start
+            print(f'Config.download {"cached" if cache else "uncached":<8} {count} x {size} MB {seconds:>8.2f} s'
+                  f' {ArchiveRequestHandler.sent / 1024 / 1024:>8.0f} MB sent {len(os.listdir(downloads_path)):>4} files')
+        Config.remove('path/download_cache')
+    finally:
+        server.shutdown()
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark downloading many archives sequentially compared to concurrently
+def bench_download_all(count=50, size=1, latency=0.05, bandwidth=10 * 1024 * 1024):
+    """Benchmark downloading many archives sequentially compared to concurrently"""
+    server, url = start_server()
+    temp_path = tempfile.mkdtemp()
+    # Simulate the latency and bandwidth of each connection to a remote host
+    ArchiveRequestHandler.latency = latency
+    ArchiveRequestHandler.bandwidth = bandwidth
+    try:
+        urls = [f'{url}/{i}/{size * 1024 * 1024}.zip' for i in range(count)]
+        for concurrent in [False, True]:
+            downloads_path = os.path.join(temp_path, 'concurrent' if concurrent else 'sequential')
+            Config.set('path/download_cache', os.path.join(downloads_path, 'cache'))
+            start = time.perf_counter()
+            if concurrent:
+                paths = Config.download_all(urls, downloads_path)
+            else:
+                paths = [Config.download(url, os.path.join(downloads_path, os.path.basename(url))) for url in urls]
+            seconds = time.perf_counter() - start
+            print(f'Config.download{"_all" if concurrent else "    "} {count} x {size} MB archives {seconds:>8.2f} s {len([path for path in paths if path])} downloaded')
+        Config.remove('path/download_cache')
+    finally:
+        ArchiveRequestHandler.latency = 0
+        ArchiveRequestHandler.bandwidth = None
+        server.shutdown()
+        shutil.rmtree(temp_path, True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        download(*sys.argv[1:])
+    else:
+        bench_download()
+        bench_cache()
+        bench_download_all()
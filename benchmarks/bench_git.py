@@ -0,0 +1,221 @@
+"""Runtime library benchmarks for git
+
+Run from the repository root with `python benchmarks/bench_git.py`
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import pygit2
+
+# Add the benchmarks parent directory to be able to include runtime module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meg_runtime import GitRepository, GitManager  # noqa: E402
+
+
+# Report the rate of a benchmarked statement
+def report(name, seconds, count):
+    """Report the rate of a benchmarked statement"""
+    print(f'{name:<56} {count / seconds:>14,.0f} /sec')
+
+
+# Create a bare remote with generated files
+def create_remote(path, files, size):
+    """Create a bare remote with generated files"""
+    remote = pygit2.init_repository(path, bare=True)
+    commit_generated(remote, files, size)
+    return remote
+
+
+# Commit generated files to a repository
+def commit_generated(repo, files, size):
+    """Commit generated files to a repository"""
+    signature = pygit2.Signature('bench', 'bench@localhost')
+    builder = repo.TreeBuilder()
+    for i in range((files + 99) // 100):
+        subtree = repo.TreeBuilder()
+        for j in range(min(100, files - i * 100)):
+            subtree.insert(f'part{j}.dwg', repo.create_blob(os.urandom(size)), pygit2.GIT_FILEMODE_BLOB)
+        builder.insert(f'assets{i}', subtree.write(), pygit2.GIT_FILEMODE_TREE)
+    repo.create_commit('HEAD', signature, signature, 'Generated files', builder.write(), [] if repo.head_is_unborn else [repo.head.target])
+
+
+# Get the modification times of the files in a working tree
+def modification_times(path):
+    """Get the modification times of the files in a working tree"""
+    times = {}
+    for root, dirs, files in os.walk(path):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        for name in files:
+            times[os.path.join(root, name)] = os.stat(os.path.join(root, name)).st_mtime_ns
+    return times
+
+
+# Benchmark pulling a few changed files compared to cloning the working tree again
+def bench_pull(files=5000, size=16 * 1024, changed=10):
+    """Benchmark pulling a few changed files compared to cloning the working tree again"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        remote = create_remote(os.path.join(temp_path, 'remote.git'), files, size)
+        clone = GitRepository(os.path.join(temp_path, 'clone'), remote.path)
+        # Push changes to a few files from another clone
+        other = GitRepository(os.path.join(temp_path, 'other'), remote.path)
+        files = {f'assets{i}/part{i}.dwg': os.urandom(size) for i in range(changed)}
+        other.push_commit('origin', other.commit_files(other.head.target, files, 'Change files'), other.head.shorthand)
+        before = modification_times(clone.workdir)
+        start = time.perf_counter()
+        clone.pull()
+        seconds = time.perf_counter() - start
+        after = modification_times(clone.workdir)
+        written = len([path for path in after if after[path] != before.get(path)])
+        print(f'{f"GitRepository.pull {len(before)} files, {changed} changed":<48} {seconds * 1000:>10.1f} ms {written:>6} files written')
+        start = time.perf_counter()
+        clone = GitRepository(os.path.join(temp_path, 'reclone'), remote.path)
+        seconds = time.perf_counter() - start
+        written = len(modification_times(clone.workdir))
+        print(f'{f"GitRepository clone {len(before)} files":<48} {seconds * 1000:>10.1f} ms {written:>6} files written')
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Get the size of the files in a directory
+def disk_usage(path):
+    """Get the size of the files in a directory"""
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+
+# Serve the repositories of a directory with git daemon since the local transport cannot fetch shallow history
+def start_daemon(path):
+    """Serve the repositories of a directory with git daemon since the local transport cannot fetch shallow history"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    daemon = subprocess.Popen(['git', 'daemon', '--export-all', '--reuseaddr', f'--base-path={path}', '--listen=127.0.0.1', f'--port={port}', path], stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return daemon, f'git://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.05)
+
+
+# Benchmark full, shallow and sparse clones of a remote with a long history of binary files
+def bench_clone(commits=10, files=200, size=32 * 1024):
+    """Benchmark full, shallow and sparse clones of a remote with a long history of binary files"""
+    temp_path = tempfile.mkdtemp()
+    daemon = None
+    try:
+        remote = create_remote(os.path.join(temp_path, 'remote.git'), files, size)
+        for i in range(commits - 1):
+            commit_generated(remote, files, size)
+        daemon, url = start_daemon(temp_path)
+        for name, options in [('full', {}), ('depth=1', {'depth': 1}), ('depth=1, sparse_paths=[assets0]', {'depth': 1, 'sparse_paths': ['assets0']})]:
+            path = os.path.join(temp_path, name)
+            start = time.perf_counter()
+            GitManager.clone(f'{url}/remote.git', path, **options)
+            seconds = time.perf_counter() - start
+            print(f'{f"GitManager.clone {name}":<48} {seconds * 1000:>10.1f} ms {disk_usage(path) / 1024 / 1024:>8.1f} MB')
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark the frames of the UI event loop while cloning in the UI thread compared to a worker thread
+def bench_async_clone(files=2000, size=16 * 1024):
+    """Benchmark the frames of the UI event loop while cloning in the UI thread compared to a worker thread"""
+    from PyQt5 import QtCore
+    from meg_runtime.ui.gittask import GitTask
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    temp_path = tempfile.mkdtemp()
+    try:
+        remote = create_remote(os.path.join(temp_path, 'remote.git'), files, size)
+        pool = QtCore.QThreadPool()
+        for worker in [False, True]:
+            # Draw a frame every 60th of a second while cloning
+            frames = []
+            timer = QtCore.QTimer()
+            timer.setTimerType(QtCore.Qt.PreciseTimer)
+            timer.timeout.connect(lambda: frames.append(time.perf_counter()))
+            loop = QtCore.QEventLoop(app)
+            path = os.path.join(temp_path, f'clone{worker}')
+            if worker:
+                task = GitTask(GitManager.clone, f'file://{remote.path}', path)
+                task.signals.finished.connect(loop.quit)
+                task.signals.failed.connect(loop.quit)
+                QtCore.QTimer.singleShot(0, lambda: pool.start(task))
+            else:
+                QtCore.QTimer.singleShot(0, lambda: (GitManager.clone(f'file://{remote.path}', path), loop.quit()))
+            start = time.perf_counter()
+            timer.start(1000 // 60)
+            loop.exec_()
+            seconds = time.perf_counter() - start
+            timer.stop()
+            gaps = [b - a for a, b in zip([start] + frames, frames + [time.perf_counter()])]
+            name = 'GitTask clone in a worker thread' if worker else 'GitManager.clone in the UI thread'
+            print(f'{name:<48} {seconds * 1000:>10.1f} ms {len(frames) / seconds:>6.1f} fps {max(gaps) * 1000:>8.1f} ms longest frame')
+        pool.waitForDone()
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark fetching many repositories concurrently compared to a sequential loop
+def bench_fetch_all(repos=20, files=50, size=16 * 1024):
+    """Benchmark fetching many repositories concurrently compared to a sequential loop"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        remotes = [create_remote(os.path.join(temp_path, f'remote{i}.git'), 1, size) for i in range(repos)]
+        for concurrent in [False, True]:
+            # Clone each remote from a file url and commit new files to the remote to be fetched
+            paths = [GitRepository(os.path.join(temp_path, f'{concurrent}{i}'), f'file://{remote.path}').workdir for i, remote in enumerate(remotes)]
+            for remote in remotes:
+                commit_generated(remote, files, size)
+            start = time.perf_counter()
+            if concurrent:
+                GitManager.fetch_all(paths)
+            else:
+                for path in paths:
+                    GitRepository(path).fetch_all()
+            seconds = time.perf_counter() - start
+            name = 'GitManager.fetch_all' if concurrent else 'GitRepository.fetch_all loop'
+            print(f'{f"{name} {repos} repositories, {files} files":<48} {seconds * 1000:>10.1f} ms')
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark repeatedly opening a repository to read a file compared to acquiring it from the pool
+def bench_pool(files=5000, cycles=1000):
+    """Benchmark repeatedly opening a repository to read a file compared to acquiring it from the pool"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        remote = create_remote(os.path.join(temp_path, 'remote.git'), files, 1024)
+        # Clone from a file url to store the objects in a packfile
+        repo_path = GitRepository(os.path.join(temp_path, 'clone'), f'file://{remote.path}', bare=True).path
+        for pooled in [False, True]:
+            start = time.perf_counter()
+            for i in range(cycles):
+                repo = GitManager.acquire(repo_path) if pooled else GitManager.open(repo_path)
+                repo.read_file(repo.head.target, f'assets{i % (files // 100)}/part{i % 100}.dwg')
+                if pooled:
+                    GitManager.release(repo)
+                else:
+                    repo.free()
+            report(f'  {"GitManager.acquire" if pooled else "GitManager.open"} and read file', time.perf_counter() - start, cycles)
+        GitManager.free_pool()
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+if __name__ == '__main__':
+    bench_pull()
+    bench_fetch_all()
+    bench_pool()
+    bench_clone()
+    bench_async_clone()
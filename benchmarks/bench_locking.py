@@ -0,0 +1,304 @@
+"""Runtime library benchmarks for locking
+
+Run from the repository root with `python benchmarks/bench_locking.py`
+"""
+
+import os
+import sys
+import time
+import shutil
+import timeit
+import pygit2
+import tempfile
+
+# Add the benchmarks parent directory to be able to include runtime module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meg_runtime.locking import LockingManager  # noqa: E402
+from meg_runtime.locking.daemon import LockDaemon, LockClient  # noqa: E402
+from meg_runtime.locking.lockFile import LockFile  # noqa: E402
+
+
+# Report the rate of a benchmarked statement
+def report(name, seconds, count):
+    """Report the rate of a benchmarked statement"""
+    print(f'{name:<56} {count / seconds:>14,.0f} /sec')
+
+
+# Get the path of a generated locked file
+def lock_path(i):
+    """Get the path of a generated locked file"""
+    return f'project{i % 100}/assets{i // 100 % 10}/part{i}.dwg'
+
+
+# Create a lock file with generated locks
+def create_locks(path, size, journal=False):
+    """Create a lock file with generated locks"""
+    lock = LockFile(path, journal)
+    for i in range(size):
+        lock[lock_path(i)] = f'user{i % 1000}'
+    return lock
+
+
+# Benchmark indexed lock queries compared to scanning every lock
+def bench_queries(size=100000, count=1000):
+    """Benchmark indexed lock queries compared to scanning every lock"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        lock = create_locks(os.path.join(temp_path, '.meg', 'locks.json'), size)
+        print(f'LockFile queries with {size} locks')
+        # Directory listing
+        seconds = timeit.timeit(lambda: [p for p in lock if p.startswith('project42/assets3/')], number=count // 100)
+        report('  descendant locks (scan)', seconds, count // 100)
+        seconds = timeit.timeit(lambda: lock.descendantLocks('project42/assets3'), number=count)
+        report('  descendant locks (index)', seconds, count)
+        seconds = timeit.timeit(lambda: lock.hasDescendantLock('project42/assets3'), number=count)
+        report('  has descendant lock (index)', seconds, count)
+        # Ancestor directory check
+        seconds = timeit.timeit(lambda: [p for p in lock if 'project42/assets3/new.dwg'.startswith(p + '/')], number=count // 100)
+        report('  ancestor lock (scan)', seconds, count // 100)
+        seconds = timeit.timeit(lambda: lock.ancestorLock('project42/assets3/new.dwg'), number=count)
+        report('  ancestor lock (index)', seconds, count)
+        # Locks of a user
+        seconds = timeit.timeit(lambda: [p for p, entry in lock.items() if entry['user'] == 'user42'], number=count // 100)
+        report('  user locks (scan)', seconds, count // 100)
+        seconds = timeit.timeit(lambda: lock.userLocks('user42'), number=count)
+        report('  user locks (index)', seconds, count)
+        # Maintaining the index
+        seconds = timeit.timeit(lambda: (lock.__setitem__('project42/new.dwg', 'user42'), lock.__delitem__('project42/new.dwg')), number=count)
+        report('  lock and unlock', seconds, count)
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Create the locking manager for a lock file with generated locks in a temporary working directory
+def create_manager(temp_path, size):
+    """Create the locking manager for a lock file with generated locks in a temporary working directory"""
+    os.chdir(temp_path)
+    create_locks(LockingManager.LOCKFILE_DIR + LockingManager.LOCKFILE_NAME, size).save()
+    LockingManager._LockingManager__instance = None
+    LockingManager()
+    return LockingManager._LockingManager__instance._lockFile
+
+
+# Synchronize the lock file by always writing and reading the whole file, like every sync did before change tracking
+def full_sync(lock):
+    """Synchronize the lock file by always writing and reading the whole file"""
+    lock._dirty = True
+    lock.save()
+    lock.load(lock._filepath)
+
+
+# Benchmark the latency of locking and unlocking with change tracked syncs compared to full syncs
+def bench_sync(sizes=(1000, 10000, 100000), count=20):
+    """Benchmark the latency of locking and unlocking with change tracked syncs compared to full syncs"""
+    cwd = os.getcwd()
+    temp_path = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            lock = create_manager(temp_path, size)
+            # Each lock and unlock synchronized before and after the change
+            start = time.perf_counter()
+            for i in range(count):
+                full_sync(lock)
+                lock[f'new/part{i}.dwg'] = 'user'
+                full_sync(lock)
+                full_sync(lock)
+                del lock[f'new/part{i}.dwg']
+                full_sync(lock)
+            seconds = time.perf_counter() - start
+            print(f'LockingManager lock and unlock with full syncs      ({size:>6} locks) {seconds / count / 2 * 1000:>10.3f} ms/lock')
+            start = time.perf_counter()
+            for i in range(count):
+                LockingManager.addLock(f'new/part{i}.dwg', 'user')
+                LockingManager.removeLock(f'new/part{i}.dwg', 'user')
+            seconds = time.perf_counter() - start
+            print(f'LockingManager lock and unlock with tracked changes ({size:>6} locks) {seconds / count / 2 * 1000:>10.3f} ms/lock')
+            seconds = timeit.timeit(LockingManager.updateLocks, number=count)
+            print(f'LockingManager sync without changes                 ({size:>6} locks) {seconds / count * 1000:>10.3f} ms/sync')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark the throughput of locking and unlocking many paths in batches compared to one at a time
+def bench_batch(size=10000, existing=10000, count=200):
+    """Benchmark the throughput of locking and unlocking many paths in batches compared to one at a time"""
+    cwd = os.getcwd()
+    temp_path = tempfile.mkdtemp()
+    try:
+        create_manager(temp_path, existing)
+        paths = [f'batch/part{i}.dwg' for i in range(size)]
+        # Lock a sample of the paths one at a time
+        start = time.perf_counter()
+        for path in paths[:count]:
+            LockingManager.addLock(path, 'user')
+        seconds = time.perf_counter() - start
+        report(f'LockingManager.addLock ({existing} locks)', seconds, count)
+        start = time.perf_counter()
+        for path in paths[:count]:
+            LockingManager.removeLock(path, 'user')
+        seconds = time.perf_counter() - start
+        report(f'LockingManager.removeLock ({existing} locks)', seconds, count)
+        # Lock and unlock every path in one batch
+        start = time.perf_counter()
+        LockingManager.addLocks(paths, 'user')
+        seconds = time.perf_counter() - start
+        report(f'LockingManager.addLocks {size} paths ({existing} locks)', seconds, size)
+        start = time.perf_counter()
+        LockingManager.removeLocks('batch/*', 'user')
+        seconds = time.perf_counter() - start
+        report(f'LockingManager.removeLocks {size} paths ({existing} locks)', seconds, size)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark finding and reaping expired leases with the expiry index compared to scanning every lock
+def bench_expiry(size=100000, expired=10000, count=1000):
+    """Benchmark finding and reaping expired leases with the expiry index compared to scanning every lock"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        lock = LockFile(os.path.join(temp_path, '.meg', 'locks.json'))
+        for i in range(size):
+            lock.lock(lock_path(i), f'user{i % 1000}', 3600 + i)
+        print(f'LockFile expiry with {size} leases')
+        seconds = timeit.timeit(lambda: min(entry['expires'] for entry in lock.values()), number=count // 100)
+        report('  next expiry (scan)', seconds, count // 100)
+        seconds = timeit.timeit(lock.nextExpiry, number=count)
+        report('  next expiry (index)', seconds, count)
+        now = time.time() + 3600 + expired
+        start = time.perf_counter()
+        reaped = [path for path in list(lock) if lock.expired(path, now)]
+        seconds = time.perf_counter() - start
+        report(f'  find {len(reaped)} expired locks (scan)', seconds, len(reaped))
+        start = time.perf_counter()
+        while lock.reapExpired(now, 1000):
+            pass
+        seconds = time.perf_counter() - start
+        report(f'  reap {size - len(lock)} expired locks (index, batches of 1000)', seconds, size - len(lock))
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark the latency of finding locks through the lock daemon compared to each process reading the lock file
+def bench_daemon(sizes=(1000, 100000), count=10000):
+    """Benchmark the latency of finding locks through the lock daemon compared to each process reading the lock file"""
+    cwd = os.getcwd()
+    temp_path = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            os.makedirs(os.path.join(temp_path, str(size)))
+            lock = create_manager(os.path.join(temp_path, str(size)), size)
+            path = lock_path(size // 2)
+            # A new process reads and parses the whole lock file before its first query
+            seconds = timeit.timeit(lambda: LockFile(lock._filepath)[path], number=max(count // size, 3))
+            print(f'findLock in a new process (read lock file)   ({size:>6} locks) {seconds / max(count // size, 3) * 1000000:>12.1f} us/query')
+            # A running process checks if the lock file changed before each query
+            seconds = timeit.timeit(lambda: (lock.load(), LockingManager.findLock(path)), number=count)
+            print(f'findLock in a running process (reload check) ({size:>6} locks) {seconds / count * 1000000:>12.1f} us/query')
+            daemon = LockDaemon()
+            daemon.start()
+            client = LockClient()
+            seconds = timeit.timeit(lambda: client.request('findLock', path), number=count)
+            print(f'findLock through the daemon socket           ({size:>6} locks) {seconds / count * 1000000:>12.1f} us/query')
+            client.findLock(path)
+            start = time.perf_counter()
+            client = LockClient()
+            client.findLock(path)
+            print(f'findLock in a new process (map snapshot)     ({size:>6} locks) {(time.perf_counter() - start) * 1000000:>12.1f} us/query')
+            seconds = timeit.timeit(lambda: client.findLock(path), number=count)
+            print(f'findLock in the shared memory snapshot       ({size:>6} locks) {seconds / count * 1000000:>12.1f} us/query')
+            client.close()
+            daemon.stop()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_path, True)
+
+
+# Create a bare remote repository with a large tree of generated files and clone it
+def create_remote(temp_path, files):
+    """Create a bare remote repository with a large tree of generated files and clone it"""
+    remote = pygit2.init_repository(os.path.join(temp_path, 'remote.git'), bare=True)
+    signature = pygit2.Signature('bench', 'bench@localhost')
+    projects = {}
+    for i in range(files):
+        projects.setdefault(f'project{i % 100}', {})[f'part{i}.dwg'] = remote.create_blob(os.urandom(1024))
+    root = remote.TreeBuilder()
+    for project, parts in projects.items():
+        builder = remote.TreeBuilder()
+        for name, blob in parts.items():
+            builder.insert(name, blob, pygit2.GIT_FILEMODE_BLOB)
+        root.insert(project, builder.write(), pygit2.GIT_FILEMODE_TREE)
+    remote.create_commit('HEAD', signature, signature, 'Generated files', root.write(), [])
+    return pygit2.clone_repository(remote.path, os.path.join(temp_path, 'clone'))
+
+
+# Synchronize the lock file by checking out the whole fetched remote tree, like a pull of the remote branch
+def checkout_sync(repo):
+    """Synchronize the lock file by checking out the whole fetched remote tree"""
+    repo.remotes['origin'].fetch()
+    commit = repo[repo.references['refs/remotes/origin/' + repo.head.shorthand].target]
+    repo.checkout_tree(commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE)
+    LockingManager.locks().load()
+
+
+# Benchmark the latency of syncing locks with a remote repository with a large working tree
+def bench_remote_sync(files=20000, locks=10000, count=20):
+    """Benchmark the latency of syncing locks with a remote repository with a large working tree"""
+    cwd = os.getcwd()
+    temp_path = tempfile.mkdtemp()
+    try:
+        repo = create_remote(temp_path, files)
+        create_manager(repo.workdir, 0)
+        LockingManager.addLocks([lock_path(i) for i in range(locks)], 'user')
+        seconds = timeit.timeit(lambda: checkout_sync(repo), number=count)
+        print(f'LockingManager sync with checkout  ({files} files, {locks} locks) {seconds / count * 1000:>10.3f} ms/sync')
+        seconds = timeit.timeit(LockingManager.updateLocks, number=count)
+        print(f'LockingManager.updateLocks         ({files} files, {locks} locks) {seconds / count * 1000:>10.3f} ms/sync')
+        start = time.perf_counter()
+        for i in range(count):
+            LockingManager.addLock(f'new/part{i}.dwg', 'user')
+        seconds = time.perf_counter() - start
+        print(f'LockingManager.addLock with push   ({files} files, {locks} locks) {seconds / count * 1000:>10.3f} ms/lock')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark saving single lock changes appended to a journal compared to rewriting the lock file
+def bench_journal(sizes=(1000, 10000, 100000), count=200):
+    """Benchmark saving single lock changes appended to a journal compared to rewriting the lock file"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for journal in [False, True]:
+                path = os.path.join(temp_path, 'journal' if journal else 'snapshot', str(size), 'locks.json')
+                lock = create_locks(path, size, journal)
+                lock.compact()
+                start = time.perf_counter()
+                for i in range(count):
+                    lock[f'new/part{i}.dwg'] = 'user'
+                    lock.save()
+                seconds = time.perf_counter() - start
+                # The journal grows by each change while the lock file is rewritten by each change
+                written = os.path.getsize(path + LockFile.JOURNAL_SUFFIX) if journal else os.path.getsize(path) * count
+                mode = 'journal' if journal else 'snapshot'
+                print(f'LockFile save {mode:<8} ({size:>6} locks) {seconds / count * 1000:>10.3f} ms/lock'
+                      f' {written / count / 1024:>10.3f} KB/lock written')
+                start = time.perf_counter()
+                LockFile(path, journal)
+                seconds = time.perf_counter() - start
+                print(f'LockFile load {mode:<8} ({size:>6} locks) {seconds * 1000:>10.3f} ms')
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+if __name__ == '__main__':
+    bench_queries()
+    bench_sync()
+    bench_batch()
+    bench_journal()
+    bench_expiry()
+    bench_daemon()
+    bench_remote_sync()
@@ -0,0 +1,185 @@
+"""Runtime library benchmarks for permissions
+
+Run from the repository root with `python benchmarks/bench_permissions.py`
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+# Add the benchmarks parent directory to be able to include runtime module
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meg_runtime.permissions import PermissionsManager  # noqa: E402
+
+
+# Report the rate of a benchmarked statement
+def report(name, seconds, count):
+    """Report the rate of a benchmarked statement"""
+    print(f'{name:<56} {count / seconds:>14,.0f} /sec')
+
+
+# Get the path of a generated file
+def file_path(i):
+    """Get the path of a generated file"""
+    return f'project{i % 100}/assets{i // 100 % 10}/part{i}.dwg'
+
+
+# Generate a permissions file
+def create_permissions(path, files, users, roles=50):
+    """Generate a permissions file"""
+    permissions = {
+        'roles': {f'role{r}': [f'user{u}' for u in range(users) if u % roles == r] for r in range(roles)},
+        'files': {file_path(i): {
+            'users_read': [f'user{(i + u) % users}' for u in range(5)],
+            'users_write': [f'user{i % users}'],
+            'roles_read': [f'role{(i + r) % roles}' for r in range(10)],
+            'roles_write': [f'role{i % roles}']
+        } for i in range(files)}
+    }
+    with open(path, 'w') as permissions_file:
+        json.dump(permissions, permissions_file)
+
+
+# Check read permission by scanning the roles and users, like every check did before compiling permissions
+def scan_can_read(perms, path):
+    """Check read permission by scanning the roles and users"""
+    roles = [role for role in perms['roles'] if perms._user in perms['roles'][role]]
+    for role in roles:
+        if role in perms['files'][path]['roles_read']:
+            return True
+    return perms._user in perms['files'][path]['users_read']
+
+
+# Benchmark checking permissions of every file with compiled permissions compared to scanning roles and users
+def bench_check(files=100000, users=1000):
+    """Benchmark checking permissions of every file with compiled permissions compared to scanning roles and users"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_path, 'permissions.json')
+        create_permissions(path, files, users)
+        start = time.perf_counter()
+        perms = PermissionsManager(path, 'user42')
+        seconds = time.perf_counter() - start
+        print(f'PermissionsManager load and compile {files} files, {users} users {seconds:>10.3f} s')
+        paths = [file_path(i) for i in range(files)]
+        start = time.perf_counter()
+        for path in paths[:files // 100]:
+            scan_can_read(perms, path)
+        report('  can_read (scan)', time.perf_counter() - start, files // 100)
+        start = time.perf_counter()
+        for path in paths:
+            perms.can_read(path)
+        report('  can_read (compiled)', time.perf_counter() - start, files)
+        start = time.perf_counter()
+        for path in paths:
+            perms.can_write(path)
+        report('  can_write (compiled)', time.perf_counter() - start, files)
+        start = time.perf_counter()
+        for i in range(100):
+            perms.reload()
+        report('  reload unchanged', time.perf_counter() - start, 100)
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Generate a permissions file with directory and pattern rules for generated files
+def create_rules(path, users=1000, roles=50):
+    """Generate a permissions file with directory and pattern rules for generated files"""
+    def rule(i):
+        return {'users_read': [f'user{i % users}'], 'users_write': [f'user{i % users}'],
+                'roles_read': [f'role{i % roles}'], 'roles_write': [f'role{(i + 1) % roles}']}
+    files = {}
+    for i in range(100):
+        files[f'project{i}'] = rule(i)
+        files[f'project{i}/assets{i % 10}/'] = rule(i + 1)
+    files.update({f'project{i}*/**/*.dwg': rule(i) for i in range(10)})
+    files.update({f'**/assets{i}/*{i}.dwg': rule(i) for i in range(10)})
+    permissions = {
+        'roles': {f'role{r}': [f'user{u}' for u in range(users) if u % roles == r] for r in range(roles)},
+        'files': files
+    }
+    with open(path, 'w') as permissions_file:
+        json.dump(permissions, permissions_file)
+    return len(files)
+
+
+# Benchmark checking permissions of many files matched by directory and pattern rules
+def bench_rules(files=1000000, count=200000):
+    """Benchmark checking permissions of many files matched by directory and pattern rules"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_path, 'permissions.json')
+        rules = create_rules(path)
+        start = time.perf_counter()
+        perms = PermissionsManager(path, 'user42')
+        seconds = time.perf_counter() - start
+        print(f'PermissionsManager load and compile {rules} rules for {files} files {seconds * 1000:>10.3f} ms')
+        # Check a sample of paths spread over all the files
+        paths = [file_path(i * (files // count)) for i in range(count)]
+        start = time.perf_counter()
+        for path in paths:
+            perms.can_read(path)
+        report(f'  can_read {count} paths (uncached rule match)', time.perf_counter() - start, count)
+        paths = paths[-PermissionsManager.DECISION_CACHE_SIZE:]
+        start = time.perf_counter()
+        for path in paths:
+            perms.can_write(path)
+        report(f'  can_write {len(paths)} paths (cached rule match)', time.perf_counter() - start, len(paths))
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark checking the permissions of a directory listing in one pass compared to checking each path
+def bench_listing(entries=50000):
+    """Benchmark checking the permissions of a directory listing in one pass compared to checking each path"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_path, 'permissions.json')
+        create_rules(path)
+        perms = PermissionsManager(path, 'user42')
+        listing = [file_path(i) for i in range(entries)]
+        # Compiling again clears the cached matches of each path
+        perms.compile()
+        start = time.perf_counter()
+        for path in listing:
+            (perms.can_read(path), perms.can_write(path), perms.can_lock(path))
+        report(f'  can_read, can_write, can_lock {entries} entries', time.perf_counter() - start, entries)
+        perms.compile()
+        start = time.perf_counter()
+        perms.check_paths(listing)
+        report(f'  check_paths {entries} entries', time.perf_counter() - start, entries)
+        start = time.perf_counter()
+        perms.filter_paths(listing, 'write')
+        report(f'  filter_paths {entries} entries', time.perf_counter() - start, entries)
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+# Benchmark the cost of collecting permission statistics
+def bench_stats(files=10000, count=200000):
+    """Benchmark the cost of collecting permission statistics"""
+    temp_path = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_path, 'permissions.json')
+        create_permissions(path, files, 1000)
+        paths = [file_path(i % files) for i in range(count)]
+        for stats in [False, True]:
+            perms = PermissionsManager(path, 'user42', stats)
+            start = time.perf_counter()
+            for checked_path in paths:
+                perms.can_read(checked_path)
+            report(f'  can_read (statistics {"enabled" if stats else "disabled"})', time.perf_counter() - start, count)
+        print(json.dumps(perms.stats(), indent=4))
+    finally:
+        shutil.rmtree(temp_path, True)
+
+
+if __name__ == '__main__':
+    bench_check()
+    bench_rules()
+    bench_listing()
+    bench_stats()
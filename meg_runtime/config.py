@@ -5,12 +5,26 @@ Configuration for runtime
 
 import os
 import re
+import sys
 import copy
 import json
 import errno
+import atexit
 import shutil
+import time
+import hashlib
 import pathlib
+import mmap
+import ctypes
+import select
+import struct
+import tempfile
+import functools
+import threading
+import urllib.parse
+import concurrent.futures
 import requests
+import requests.adapters
 from pathlib import Path
 from meg_runtime.logger import Logger
 
@@ -29,13 +43,84 @@ class ConfigException(Exception):
 class Config(dict):
     """Runtime configuration"""
 
+    # The configuration layers, from the lowest to the highest priority
+    # As before the layers, the loaded configuration overrides the paths from the environment, except the blocked paths
+    LAYERS = ['defaults', 'environment', 'user', 'repository']
+    # The configuration layer that is changed, saved and loaded
+    DEFAULT_LAYER = 'user'
+    # The repository configuration path, relative to the repository
+    REPOSITORY_CONFIG_PATH = os.path.join('.meg', 'config.json')
+    # The default size limit of the download cache in bytes
+    DEFAULT_DOWNLOAD_CACHE_SIZE = 1024 * 1024 * 1024
+
     # The singleton configuration instance
     __instance = None
+    # The values of each configuration layer, the configuration instance is the merged values of the layers
+    __layers = {layer: {} for layer in LAYERS}
+    # The environment variables of the paths in the environment layer
+    __environment_paths = {
+        'user': 'MEG_USER_PATH',
+        'config': 'MEG_CONFIG_PATH',
+        'home': 'MEG_HOME_PATH',
+        'cache': 'MEG_CACHE_PATH',
+        'plugins': 'MEG_PLUGINS_PATH',
+        'plugin_cache': 'MEG_PLUGIN_CACHE_PATH',
+        'downloads': 'MEG_DOWNLOADS_PATH',
+        'download_cache': 'MEG_DOWNLOAD_CACHE_PATH'
+    }
     # The block list of keys to prevent setting
     __blocked_keys = [
         'path/config',
         'path/user'
     ]
+    # The configuration reference expression
+    __reference_re = re.compile('[$][(]([^)]+)[)]', re.I+re.S)
+    # The maximum number of requested keys to cache before the cache is reset
+    __max_cached_values = 4096
+    # The resolved value cache by requested key
+    __values = {}
+    # The requested keys of the cached values by compiled key
+    __aliases = {}
+    # The expanded value cache by compiled key
+    __resolved = {}
+    # The configuration references of each referencing compiled key
+    __references = {}
+    # The referencing compiled keys of each referenced compiled key
+    __referrers = {}
+    # The sentinel for a key that is not present in the configuration
+    __missing = object()
+    # The content hash and file status of each configuration path when last saved or loaded
+    __saved = {}
+    # The scheduled save timers by path and overwrite
+    __scheduled = {}
+    # The lock for changing or saving the configuration
+    __lock = threading.RLock()
+    # The top level sections that are always parsed when lazily loading
+    __eager_sections = ['path']
+    # The byte ranges of the lazily loaded top level sections that are not yet parsed
+    __lazy = {}
+    # The callbacks subscribed to each compiled key and the compiled keys changed since the subscribers were notified
+    __subscribers = {}
+    __changed = set()
+    # The configuration file watcher thread and the event to stop watching
+    __watcher = None
+    __watcher_stop = None
+    # The inotify events for a file written or replaced in a watched directory
+    __inotify_mask = 0x00000008 | 0x00000080
+    # The session for downloads, reusing pooled connections
+    __session = None
+    # The size of each chunk of a download written to file and the timeout for connecting or reading
+    __download_chunk_size = 1024 * 1024
+    __download_timeout = 60
+    # The number of pooled connections for each host
+    __download_pool_size = 16
+    # The ioctl request to clone a file as a reflink
+    __ficlone = 0x40049409
+    # The memory map of the lazily loaded configuration file
+    __lazy_map = None
+    # The top level section indentation and key expressions of a lazily loaded configuration file
+    __lazy_indent_re = re.compile(rb'\s*[{][ \t\r]*\n([ \t]+)"')
+    __lazy_key_re = rb'"((?:[^"\\]|\\.)*)"[ \t]*:[ \t]*'
 
     # Configuration constructor
     def __init__(self, **kwargs):
@@ -51,71 +136,121 @@ class Config(dict):
             Config.__instance = self
             # Load the default configuation values
             Config.clear()
+            # Save any scheduled saves before exit
+            atexit.register(Config.flush)
 
     # Load a configuration from file
     @staticmethod
-    def load(path='$(path/config)', clear=True):
-        """Load a configuration from JSON file"""
+    def load(path='$(path/config)', clear=True, lazy=False):
+        """Load a configuration from JSON file, lazily parsing the top level sections on first access, if wanted"""
         # Check there is a configuration instance
         if Config.__instance is None:
             Config()
         if Config.__instance is None:
             return False
-        # Clear the old configuration before loading a new one, if wanted
-        if clear:
-            Config.clear()
-        try:
-            # Get the configuration path
-            expanded_path = Config.expand(path)
-            Logger.debug(f'MEG Config: Loading configuration <{expanded_path}>')
-            # Try to open the configuration file for reading
-            config_file = open(expanded_path, "r")
-            # Try to parse the JSON configuration file
-            config = json.load(config_file)
-            # Overwrite or update the configuration
-            Config.__instance.update(config)
-            # Keep the correct path for configuration
-            if 'path' not in Config.__instance or not isinstance(Config.__instance['path'], dict):
-                Config.__instance._set_defaults()
-            Config.__instance._set_required(expanded_path)
-        except Exception as e:
-            # Do not say there was an error if the file exists
-            if isinstance(e, OSError) and e.errno == errno.ENOENT:
-                return True
-            # Log that loading the configuration failed
-            Logger.warning(f'MEG Config: {e}')
-            Logger.warning(f'MEG Config: Could not load configuration <{expanded_path}>')
-            return False
+        with Config.__lock:
+            # Clear the old configuration before loading a new one, if wanted
+            if clear:
+                Config.clear()
+            previous_layer = None
+            try:
+                # Get the configuration path
+                expanded_path = Config.expand(path)
+                Logger.debug(f'MEG Config: Loading configuration <{expanded_path}>')
+                # Parse any lazily loaded sections so they are updated by the loaded configuration
+                Config._materialize_all()
+                if lazy:
+                    # Try to memory map the configuration file to parse the top level sections on first access
+                    config = Config._load_lazy(expanded_path)
+                else:
+                    # Try to read the configuration file
+                    with open(expanded_path, 'rb') as config_file:
+                        content = config_file.read()
+                        stat = os.fstat(config_file.fileno())
+                    # Try to parse the JSON configuration file
+                    config = json.loads(content)
+                    # Remember the loaded content so saving the same content can be skipped
+                    Config.__saved[expanded_path] = (hashlib.sha256(content).digest(), (stat.st_mtime_ns, stat.st_size))
+                # Keep the previous values of the configuration layer to restore if the loaded configuration is rejected
+                previous_layer = copy.deepcopy(Config.__layers[Config.DEFAULT_LAYER])
+                previous_config_path = Config.__layers['environment'].get('path', {}).get('config')
+                # Overwrite or update the configuration layer, merging the nested dictionaries
+                Config._update(Config.__layers[Config.DEFAULT_LAYER], Config._unblocked(config))
+                # Keep the correct path for configuration
+                if not isinstance(Config.__layers[Config.DEFAULT_LAYER].get('path', {}), dict):
+                    Config.__layers[Config.DEFAULT_LAYER].pop('path')
+                Config.__instance._set_required(expanded_path)
+                # Rebuild the merged configuration and the references, checking for reference cycles
+                Config._rebuild()
+            except Exception as e:
+                # A rejected configuration does not leave any of its values in the configuration layer
+                if previous_layer is not None:
+                    Config.__layers[Config.DEFAULT_LAYER] = previous_layer
+                    environment_path = Config.__layers['environment'].setdefault('path', {})
+                    if previous_config_path is None:
+                        environment_path.pop('config', None)
+                    else:
+                        environment_path['config'] = previous_config_path
+                    if lazy:
+                        Config._unload_lazy()
+                Config._rebuild(False)
+                # Do not say there was an error if the file exists
+                if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                    return True
+                # Log that loading the configuration failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not load configuration <{expanded_path}>')
+                return False
+        # Notify the subscribers of the changed keys
+        Config._notify()
         return True
 
     # Save a configuration to file
     @staticmethod
-    def save(path='$(path/config)', overwrite=True):
-        """Save a configuration to JSON file"""
+    def save(path='$(path/config)', overwrite=True, delay=None):
+        """Save a configuration to JSON file, or coalesce the saves for a delay in seconds"""
         # Check there is a configuration instance
         if Config.__instance is None:
             Config()
         if Config.__instance is None:
             return False
+        # Schedule the save, if wanted, so every save during the delay is only written once
+        if delay is not None:
+            return Config._save_later(path, overwrite, delay)
         try:
-            # Get the expanded path
-            expanded_path = Config.expand(path)
-            Logger.debug(f'MEG Config: Saving configuration <{expanded_path}>')
-            # Check the file exists before overwriting
-            if not overwrite and os.path.exists(expanded_path):
-                raise ConfigException(f'Not overwriting existing file <{expanded_path}>')
-            # Make the path to the containing directory if it does not exist
-            dir_path = os.path.dirname(expanded_path)
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path, exist_ok=True)
-            # Try to open the configuration file for writing
-            config_file = open(expanded_path, "w")
-            # Remove the blocked keys from being saved
-            config_copy = copy.deepcopy(Config.__instance)
-            for blocked_key in Config.__blocked_keys:
-                config_copy._remove(config_copy, [sk for sk in blocked_key.split('/') if sk])
-            # Try to convert configuration to JSON file
-            json.dump(config_copy, config_file, indent=2)
+            with Config.__lock:
+                # Get the expanded path
+                expanded_path = Config.expand(path)
+                Logger.debug(f'MEG Config: Saving configuration <{expanded_path}>')
+                # Check the file exists before overwriting
+                if not overwrite and os.path.exists(expanded_path):
+                    raise ConfigException(f'Not overwriting existing file <{expanded_path}>')
+                # Parse any lazily loaded sections
+                Config._materialize_all()
+                # Try to convert configuration to JSON without the blocked keys
+                content = json.dumps(Config._unblocked(Config.__layers[Config.DEFAULT_LAYER]), indent=2).encode('utf-8')
+                digest = hashlib.sha256(content).digest()
+                # Skip writing if the file still has the same content as when it was last saved or loaded
+                if Config.__saved.get(expanded_path) == (digest, Config._stat(expanded_path)):
+                    Logger.debug(f'MEG Config: Configuration is unchanged <{expanded_path}>')
+                    return True
+                # Make the path to the containing directory if it does not exist
+                dir_path = os.path.dirname(expanded_path)
+                if dir_path and not os.path.exists(dir_path):
+                    os.makedirs(dir_path, exist_ok=True)
+                # Write to a temporary file and rename it to the configuration file, so the file is never partially written
+                temp_file, temp_path = tempfile.mkstemp(prefix=os.path.basename(expanded_path) + '.', suffix='.tmp', dir=dir_path or None)
+                try:
+                    with os.fdopen(temp_file, 'wb') as config_file:
+                        config_file.write(content)
+                        config_file.flush()
+                        os.fsync(config_file.fileno())
+                    os.replace(temp_path, expanded_path)
+                except Exception:
+                    Config.remove_path(temp_path)
+                    raise
+                # Remember the saved content
+                Config.__saved[expanded_path] = (digest, Config._stat(expanded_path))
         except Exception as e:
             # Log that saving the configuration failed
             Logger.warning(f'MEG Config: {e}')
@@ -123,22 +258,196 @@ class Config(dict):
             return False
         return True
 
+    # Save any configuration saves that are scheduled
+    @staticmethod
+    def flush():
+        """Save any configuration saves that are scheduled"""
+        retval = True
+        # Cancel each scheduled save and save now instead
+        with Config.__lock:
+            scheduled = list(Config.__scheduled.items())
+            Config.__scheduled.clear()
+        for (path, overwrite), timer in scheduled:
+            timer.cancel()
+            retval = Config.save(path, overwrite) and retval
+        return retval
+
+    # Load a configuration layer from file, replacing the previous values of the layer
+    @staticmethod
+    def load_layer(layer, path):
+        """Load a configuration layer from JSON file, replacing the previous values of the layer"""
+        # Check there is a configuration instance
+        if Config.__instance is None:
+            Config()
+        if Config.__instance is None or layer not in Config.__layers or layer == Config.DEFAULT_LAYER:
+            return False
+        config = {}
+        try:
+            # Try to read and parse the configuration file, if there is one
+            if path is not None:
+                Logger.debug(f'MEG Config: Loading configuration layer <{layer}> <{path}>')
+                with open(path, 'rb') as config_file:
+                    config = json.load(config_file)
+                if not isinstance(config, dict):
+                    raise ConfigException(f'Configuration is not a dictionary <{path}>')
+        except Exception as e:
+            # Do not say there was an error if the file does not exist
+            if not isinstance(e, OSError) or e.errno != errno.ENOENT:
+                # Log that loading the configuration layer failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not load configuration layer <{layer}> <{path}>')
+                return False
+        # Replace the values of the layer and merge only the changed values
+        Config._set_layer(layer, Config._unblocked(config))
+        # Notify the subscribers of the changed keys
+        Config._notify()
+        return True
+
+    # Load the configuration layer of a repository, replacing the configuration layer of any previous repository
+    @staticmethod
+    def load_repository(repo_path=None):
+        """Load the configuration layer of a repository, replacing the configuration layer of any previous repository"""
+        return Config.load_layer('repository', None if repo_path is None else os.path.join(repo_path, Config.REPOSITORY_CONFIG_PATH))
+
+    # Get the values of a configuration layer
+    @staticmethod
+    def get_layer(layer):
+        """Get the values of a configuration layer"""
+        # Check there is a configuration instance
+        if Config.__instance is None:
+            Config()
+        if Config.__instance is None or layer not in Config.__layers:
+            return None
+        # Parse any lazily loaded sections
+        if layer == Config.DEFAULT_LAYER:
+            Config._materialize_all()
+        return Config.__layers[layer]
+
+    # Reload a configuration file, if changed since it was loaded or saved
+    @staticmethod
+    def reload(path='$(path/config)'):
+        """Reload a configuration file, if changed since it was loaded or saved, merging only the changed values"""
+        # Check there is a configuration instance
+        if Config.__instance is None:
+            Config()
+        if Config.__instance is None:
+            return False
+        with Config.__lock:
+            try:
+                # Get the configuration path
+                expanded_path = Config.expand(path)
+                # Do not read the file if the file status is unchanged
+                saved = Config.__saved.get(expanded_path)
+                if saved is not None and saved[1] == Config._stat(expanded_path):
+                    return True
+                with open(expanded_path, 'rb') as config_file:
+                    content = config_file.read()
+                    stat = os.fstat(config_file.fileno())
+                digest = hashlib.sha256(content).digest()
+                Config.__saved[expanded_path] = (digest, (stat.st_mtime_ns, stat.st_size))
+                # Do not parse the file if the content is unchanged
+                if saved is not None and saved[0] == digest:
+                    return True
+                Logger.debug(f'MEG Config: Reloading configuration <{expanded_path}>')
+                config = json.loads(content)
+                if not isinstance(config, dict):
+                    raise ConfigException(f'Configuration is not a dictionary <{expanded_path}>')
+                # Replace the values of the configuration layer and merge only the changed values
+                Config._materialize_all()
+                Config._set_layer(Config.DEFAULT_LAYER, Config._unblocked(config))
+            except Exception as e:
+                # Keep the current configuration if the file was removed
+                if isinstance(e, OSError) and e.errno == errno.ENOENT:
+                    return True
+                # Log that reloading the configuration failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not reload configuration <{expanded_path}>')
+                return False
+        # Notify the subscribers of the changed keys
+        Config._notify()
+        return True
+
+    # Watch a configuration file and reload it when changed
+    @staticmethod
+    def watch(path='$(path/config)', interval=1.0):
+        """Watch a configuration file and reload it when changed, with inotify on Linux or polling otherwise"""
+        # Check there is a configuration instance
+        if Config.__instance is None:
+            Config()
+        if Config.__instance is None:
+            return False
+        # Stop watching any previous configuration file
+        Config.unwatch()
+        expanded_path = os.path.abspath(Config.expand(path))
+        Logger.debug(f'MEG Config: Watching configuration <{expanded_path}>')
+        # Watch the directory for changes before returning because saving replaces the file
+        inotify = Config._inotify(os.path.dirname(expanded_path))
+        Config.__watcher_stop = threading.Event()
+        Config.__watcher = threading.Thread(target=Config._watch, args=(expanded_path, inotify, interval, Config.__watcher_stop), name='MEG Config watcher', daemon=True)
+        Config.__watcher.start()
+        return True
+
+    # Stop watching the configuration file
+    @staticmethod
+    def unwatch():
+        """Stop watching the configuration file"""
+        watcher = Config.__watcher
+        if watcher is not None:
+            Config.__watcher = None
+            Config.__watcher_stop.set()
+            # The watcher can not wait for itself when stopped by a subscriber
+            if watcher is not threading.current_thread():
+                watcher.join()
+        return True
+
+    # Subscribe a callback to changes of a configuration key
+    @staticmethod
+    def subscribe(key, callback):
+        """Subscribe a callback to changes of a configuration key, called with the key and the new value"""
+        # Check there is a configuration instance
+        if Config.__instance is None:
+            Config()
+        if not isinstance(key, str) or not callable(callback) or Config.__instance is None:
+            return False
+        subkeys = Config._compile(key)
+        if not len(subkeys) > 0:
+            return False
+        with Config.__lock:
+            Config.__subscribers.setdefault(subkeys, []).append((key, callback))
+        return True
+
+    # Unsubscribe a callback from changes of a configuration key
+    @staticmethod
+    def unsubscribe(key, callback):
+        """Unsubscribe a callback from changes of a configuration key"""
+        if not isinstance(key, str):
+            return False
+        subkeys = Config._compile(key)
+        with Config.__lock:
+            subscribers = Config.__subscribers.get(subkeys, [])
+            if (key, callback) not in subscribers:
+                return False
+            subscribers.remove((key, callback))
+            if not subscribers:
+                Config.__subscribers.pop(subkeys)
+        return True
+
     # Expand a configuration value with configuration references
     @staticmethod
     def expand(value, exclude_keys=[]):
         """Expand a configuration value with configuration references"""
         # Only expand strings
         if isinstance(value, str):
-            # Replace any dictionary references
-            matches = re.findall('[$][(]([^)]+)[)]', value, re.I+re.S)
-            if matches is not None:
-                # Remove any duplicates from matches
-                matches = list(dict.fromkeys(matches))
-                # Replace each dictionary references
-                for m in matches:
-                    # Replace the dictionary reference with the value
-                    m_stripped = m.strip()
-                    value = value.replace('$(' + m + ')', '' if m_stripped in exclude_keys else Config.get(m_stripped, exclude_keys=exclude_keys))
+            # Replace each configuration reference with the resolved value
+            for m, subkeys in Config._parse(value):
+                substitute = ''
+                if m.strip() not in exclude_keys:
+                    try:
+                        substitute = Config._substitute(subkeys)
+                    except ConfigException as e:
+                        # Log that the reference could not be resolved and replace it with nothing
+                        Logger.warning(f'MEG Config: {e}')
+                value = value.replace('$(' + m + ')', substitute)
         # Return original value or expanded configuration value
         return value
 
@@ -151,36 +460,30 @@ class Config(dict):
             Config()
         if not isinstance(key, str) or Config.__instance is None:
             return defaultValue
-        # Check the key is in the configuration dictionary by splitting into individual parts
-        current_dict = Config.__instance
-        subkeys = [sk for sk in key.split('/') if sk]
-        # Check to make sure the key was valid or return the default value
-        if not len(subkeys) > 0:
-            return defaultValue
-        # Go through each key and traverse the configuration dictionary
-        for sk in subkeys[:-1]:
-            # Check current key is in current dictionary
-            if sk not in current_dict:
-                return defaultValue
-            # Get the dictionary element by key
-            current_dict = current_dict[sk]
-            # Check the instance of the element is a dictionary or the key cannot be valid
-            if not isinstance(current_dict, dict):
+        # Expanding with excluded keys can not use the resolved value
+        if exclude_keys:
+            value = Config._lookup(Config._compile(key))
+            return defaultValue if value is Config.__missing else Config.expand(value, exclude_keys)
+        try:
+            # Get the cached value for the key, if it was already resolved
+            value = Config.__values[key]
+        except KeyError:
+            try:
+                # Resolve the value of the compiled key
+                subkeys = Config._compile(key)
+                value = Config._resolve(subkeys)
+            except ConfigException as e:
+                # Log that resolving the value failed
+                Logger.warning(f'MEG Config: {e}')
                 return defaultValue
-        # Get the value of the key
-        sk = subkeys[-1]
-        if sk not in current_dict:
-            return defaultValue
-        value = current_dict[sk]
-        # Add the key to the exclude keys list to prevent recursion
-        if isinstance(exclude_keys, list):
-            expanded_keys = exclude_keys.copy()
-        else:
-            expanded_keys = []
-        if key not in expanded_keys:
-            expanded_keys.append(key)
-        # Return the (possibly expanded) dictionary element
-        return Config.expand(value, expanded_keys)
+            # Cache the resolved value, resetting the cache instead of growing without bound
+            if len(Config.__values) >= Config.__max_cached_values:
+                Config.__values.clear()
+                Config.__aliases.clear()
+            Config.__values[key] = value
+            Config.__aliases.setdefault(subkeys, set()).add(key)
+        # Return the default value if the key is not in the configuration
+        return defaultValue if value is Config.__missing else value
 
     # Check a configuration key exists
     @staticmethod
@@ -191,24 +494,8 @@ class Config(dict):
             Config()
         if not isinstance(key, str) or Config.__instance is None:
             return False
-        # Check the key is in the configuration dictionary by splitting into individual parts
-        current_dict = Config.__instance
-        subkeys = [sk for sk in key.split('/') if sk]
-        # Check to make sure the key was valid
-        if not len(subkeys) > 0:
-            return False
-        # Go through each key and traverse the configuration dictionary
-        for sk in subkeys[:-1]:
-            # Check current key is in current dictionary
-            if sk not in current_dict:
-                return False
-            # Get the dictionary element by key
-            current_dict = current_dict[sk]
-            # Check the instance of the element is a dictionary or the key cannot be valid
-            if not isinstance(current_dict, dict):
-                return False
-        # Key was found in configuration if in final dictionary
-        return subkeys[-1] in current_dict
+        # Check the key is in the configuration dictionary by the compiled key
+        return Config._lookup(Config._compile(key)) is not Config.__missing
 
     # Set a configuration value
     @staticmethod
@@ -219,31 +506,50 @@ class Config(dict):
             Config()
         if not isinstance(key, str) or Config.__instance is None:
             return False
-        # Check the value is valid or remove the key
-        if value is None:
-            # Remove the key if the value is invalid
-            return Config.remove(key)
-        # Check the key is in the configuration dictionary by splitting into individual parts
-        current_dict = Config.__instance
-        subkeys = [sk for sk in key.split('/') if sk]
-        # Check to make sure the key was valid or return the default value
-        if not len(subkeys) > 0:
-            return False
-        # Check key is blocked
-        if '/'.join(subkeys) in Config.__blocked_keys:
-            return False
-        # Go through each key and traverse the configuration dictionary
-        for sk in subkeys[:-1]:
-            # Check current key is in current dictionary
-            if sk not in current_dict:
-                current_dict[sk] = {}
-            # Get the dictionary element by key
-            current_dict = current_dict[sk]
-            # Check the instance of the element is a dictionary or the key cannot be valid
-            if not isinstance(current_dict, dict):
+        with Config.__lock:
+            # Check the value is valid or remove the key
+            if value is None:
+                # Remove the key if the value is invalid
+                return Config.remove(key)
+            # Check the key is in the configuration layer by the compiled key
+            current_dict = Config.__layers[Config.DEFAULT_LAYER]
+            subkeys = Config._compile(key)
+            # Check to make sure the key was valid or return the default value
+            if not len(subkeys) > 0:
+                return False
+            # Check key is blocked
+            if '/'.join(subkeys) in Config.__blocked_keys:
                 return False
-        # Set the dictionary element value
-        current_dict[subkeys[-1]] = value
+            # Parse the top level section, if lazily loaded
+            Config._materialize(subkeys[0])
+            # Go through each key and traverse the configuration layer
+            for sk in subkeys[:-1]:
+                # Check current key is in current dictionary
+                if sk not in current_dict:
+                    current_dict[sk] = {}
+                # Get the dictionary element by key
+                current_dict = current_dict[sk]
+                # Check the instance of the element is a dictionary or the key cannot be valid
+                if not isinstance(current_dict, dict):
+                    return False
+            # Set the dictionary element value
+            previous_value = current_dict.get(subkeys[-1], Config.__missing)
+            current_dict[subkeys[-1]] = value
+            try:
+                # Merge the value into the configuration, this fails if a reference cycle would be created
+                Config.__changed.update(Config._merge(subkeys))
+            except ConfigException as e:
+                # Restore the previous value
+                if previous_value is Config.__missing:
+                    Config.__instance._remove(Config.__layers[Config.DEFAULT_LAYER], list(subkeys))
+                else:
+                    current_dict[subkeys[-1]] = previous_value
+                # Log that setting the value failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not set configuration key <{key}>')
+                return False
+        # Notify the subscribers of the changed keys
+        Config._notify()
         return True
 
     # Remove a configuration value
@@ -255,10 +561,20 @@ class Config(dict):
             Config()
         if not isinstance(key, str) or Config.__instance is None:
             return False
-        # Check the key is in the configuration dictionary by splitting into individual parts
-        subkeys = [sk for sk in key.split('/') if sk]
-        # Traverse the configuration dictionary to remove the key and empty parent dictionaries
-        return Config.__instance._remove(Config.__instance, subkeys)
+        with Config.__lock:
+            # Check the key is in the configuration layer by the compiled key
+            subkeys = Config._compile(key)
+            if not len(subkeys) > 0:
+                return True
+            # Parse the top level section, if lazily loaded
+            Config._materialize(subkeys[0])
+            # Traverse the configuration layer to remove the key and empty parent dictionaries
+            retval = Config.__instance._remove(Config.__layers[Config.DEFAULT_LAYER], list(subkeys))
+            # Merge the values of the other layers for the key into the configuration
+            Config.__changed.update(Config._merge(subkeys, False))
+        # Notify the subscribers of the changed keys
+        Config._notify()
+        return retval
 
     # Clear the configuration
     @staticmethod
@@ -269,11 +585,17 @@ class Config(dict):
             Config()
         else:
             # Do not recreate default values because the constructor will set them
-            if Config.__instance is not None:
-                # Clear the dictionary
-                super(Config, Config.__instance).clear()
+            with Config.__lock:
+                # Clear the configuration layers and any lazily loaded sections
+                for layer in Config.__layers.values():
+                    layer.clear()
+                Config._unload_lazy()
                 # Set the default values
                 Config.__instance._set_defaults()
+                # Rebuild the merged configuration and the references of the default values
+                Config._rebuild(False)
+            # Notify the subscribers of the changed keys
+            Config._notify()
 
     # Remove a path (directory or file)
     @staticmethod
@@ -312,7 +634,7 @@ class Config(dict):
         if unique_path:
             # Insert a suffix that represents a unique counter
             suffix = ''.join(pathlib.Path(path).suffixes)
-            original_path = path[:-len(suffix)]
+            original_path = path[:len(path) - len(suffix)]
             # While the path still exists make another unique one (only try 100 or fail)
             for count in range(1, 100):
                 download_path = original_path + '-' + str(count) + suffix
@@ -323,30 +645,947 @@ class Config(dict):
 
     # Attempt to download to a local path from a remote url
     @staticmethod
-    def download(url, path=None, unique_path=True, force=True):
-        """Attempt to download to a local path from a remote url"""
+    def download(url, path=None, unique_path=True, force=True, checksum=None, progress=None, cache=True):
+        """Attempt to download to a local path from a remote url, resuming a partial download, verifying a checksum and using the download cache, if wanted"""
         # Check the configuration dictionary is valid
         if Config.__instance is None:
             Config()
         if not isinstance(url, str) or Config.__instance is None:
             return None
         # Get the download path from the given path or url
-        download_path = Config.unique_path(path if path else os.path.join(Config.get('path/downloads'), os.path.basename(url)), unique_path, force)
-        if download_path:
-            # Log downloading
-            Logger.warning(f'MEG Config: Downloading url <{url}> to <{download_path}>')
+        if not path and not Config._download_name(url):
+            Logger.warning(f'MEG Config: Could not download url <{url}> without a file name')
+            return None
+        download_path = path if path else os.path.join(Config.get('path/downloads'), Config._download_name(url))
+        try:
+            if cache:
+                # Get the cached content, only downloading if not cached or changed, and link or copy it to the download path
+                return Config._place_download(Config._download_cached(url, checksum, progress), download_path, unique_path, force)
+            download_path = Config.unique_path(download_path, unique_path, force)
+            if download_path:
+                # Log downloading
+                Logger.warning(f'MEG Config: Downloading url <{url}> to <{download_path}>')
+                # Stream the remote content to the download path
+                Config._download(url, download_path, checksum, progress)
+        except Exception as e:
+            # Log that downloading failed
+            Logger.warning(f'MEG Config: {e}')
+            Logger.warning(f'MEG Config: Could not download url <{url}> to <{download_path}>')
+            return None
+        # Return the download path on success
+        return download_path
+
+    # Get the file name of a download from a remote url
+    @staticmethod
+    def _download_name(url):
+        """Get the file name of a download from a remote url, the last segment of the url path or the host if the path has no segment"""
+        parts = urllib.parse.urlsplit(url)
+        return os.path.basename(parts.path.rstrip('/')) or parts.hostname or ''
+
+    # Attempt to download to local paths from remote urls concurrently
+    @staticmethod
+    def download_all(urls, path=None, unique_path=True, force=True, checksums=None, progress=None, completed=None, max_workers=8, max_host_workers=4, retries=3, backoff=0.5):
+        """Attempt to download to local paths in a directory from remote urls concurrently, returning the download paths in the same order as the urls"""
+        # Check the configuration dictionary is valid
+        if Config.__instance is None:
+            Config()
+        if Config.__instance is None:
+            return None
+        urls = list(urls)
+        checksums = checksums if checksums else {}
+        directory = path if path else Config.get('path/downloads')
+        results = {}
+        # Limit the concurrent downloads from each host
+        hosts = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='MEG Config download') as executor:
+            futures = {}
+            # Download each url only once
+            for url in dict.fromkeys(url for url in urls if isinstance(url, str)):
+                semaphore = hosts.setdefault(urllib.parse.urlsplit(url).netloc, threading.BoundedSemaphore(max_host_workers))
+                name = Config._download_name(url)
+                if not name:
+                    Logger.warning(f'MEG Config: Could not download url <{url}> without a file name')
+                    continue
+                download_path = os.path.join(directory, name)
+                futures[executor.submit(Config._download_retry, url, download_path, unique_path, force, checksums.get(url), progress, semaphore, retries, backoff)] = url
+            # Get the download paths as the downloads complete
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                results[url] = future.result()
+                if completed is not None:
+                    try:
+                        completed(url, results[url])
+                    except Exception as e:
+                        # Log that the completed download callback failed
+                        Logger.warning(f'MEG Config: {e}')
+                        Logger.warning(f'MEG Config: Could not complete download of url <{url}>')
+        return [results.get(url) for url in urls]
+
+    # Attempt to download to a local path from a remote url, retrying failures that may be temporary
+    @staticmethod
+    def _download_retry(url, download_path, unique_path, force, checksum, progress, semaphore, retries, backoff):
+        """Attempt to download to a local path from a remote url, retrying failures that may be temporary with exponential backoff"""
+        for attempt in range(retries + 1):
             try:
-                # Download remote request content
-                req = requests.get(url, allow_redirects=True)
-                # Save remote request to download path
-                open(download_path, "wb").write(req.content)
+                # Get the cached content, only downloading if not cached or changed, resuming any partial download of a previous attempt
+                with semaphore:
+                    cached_path = Config._download_cached(url, checksum, None if progress is None else functools.partial(progress, url))
+                # Link or copy the cached content to the download path
+                return Config._place_download(cached_path, download_path, unique_path, force)
             except Exception as e:
-                # Log that downloading failed
-                Logger.warning(f'MEG Config: {e}')
-                Logger.warning(f'MEG Config: Could not download url <{url}> to <{download_path}>')
+                # Only connection errors, timeouts and server errors may be temporary
+                temporary = isinstance(e, requests.RequestException) and (not isinstance(e, requests.HTTPError) or e.response is None or e.response.status_code >= 500)
+                if not temporary or attempt >= retries:
+                    # Log that downloading failed
+                    Logger.warning(f'MEG Config: {e}')
+                    Logger.warning(f'MEG Config: Could not download url <{url}> to <{download_path}>')
+                    return None
+                # Log retrying the download
+                Logger.debug(f'MEG Config: {e}')
+                Logger.debug(f'MEG Config: Retrying download of url <{url}> in {backoff * 2 ** attempt} seconds')
+                time.sleep(backoff * 2 ** attempt)
+
+    # Get the session for downloads
+    @staticmethod
+    def _session():
+        """Get the session for downloads, reusing pooled connections"""
+        with Config.__lock:
+            if Config.__session is None:
+                Config.__session = requests.Session()
+                # Keep enough pooled connections for each host for concurrent downloads
+                adapter = requests.adapters.HTTPAdapter(pool_connections=Config.__download_pool_size, pool_maxsize=Config.__download_pool_size)
+                Config.__session.mount('http://', adapter)
+                Config.__session.mount('https://', adapter)
+            return Config.__session
+
+    # Get the hash algorithm and hex digest of a checksum
+    @staticmethod
+    def _checksum(checksum):
+        """Get the hash algorithm and hex digest of a checksum, which is the hex digest optionally prefixed by the hash algorithm"""
+        if not checksum:
+            return ('sha256', None)
+        algorithm, digest = checksum.split(':', 1) if ':' in checksum else ('sha256', checksum)
+        return (algorithm.lower(), digest.lower())
+
+    # Get the hex digest of a file
+    @staticmethod
+    def _hash_file(path, algorithm='sha256', hasher=None):
+        """Get the hex digest of a file"""
+        hasher = hashlib.new(algorithm) if hasher is None else hasher
+        with open(path, 'rb') as hash_file:
+            for chunk in iter(functools.partial(hash_file.read, Config.__download_chunk_size), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    # Stream a remote url to a partial download file and move it to the download path when complete
+    @staticmethod
+    def _download(url, download_path, checksum=None, progress=None, headers=None):
+        """Stream a remote url to a partial download file and move it to the download path when complete, returning the SHA-256 digest and response headers or None if not modified"""
+        part_path = download_path + '.part'
+        resume_path = part_path + '.json'
+        # Hash the content for the content address and to verify the checksum
+        algorithm, digest = Config._checksum(checksum)
+        hashers = [hashlib.sha256()]
+        if digest and algorithm != 'sha256':
+            hashers.append(hashlib.new(algorithm))
+        # Resume the partial download of the same url, only if the content can be checked to be unchanged
+        headers = dict(headers or {})
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        try:
+            with open(resume_path) as resume_file:
+                resume = json.load(resume_file)
+        except (OSError, ValueError):
+            resume = {}
+        if offset > 0 and resume.get('url') == url and resume.get('validator'):
+            # Resuming replaces any conditional request
+            headers = {'Range': f'bytes={offset}-', 'If-Range': resume['validator']}
+        with Config._session().get(url, headers=headers, stream=True, allow_redirects=True, timeout=Config.__download_timeout) as response:
+            # The content is not modified since it was downloaded before
+            if response.status_code == 304:
                 return None
-        # Return the download path on success
-        return download_path
+            # Restart the download if the partial download is not satisfiable
+            if response.status_code == 416 and 'Range' in headers:
+                Config._remove_download(part_path)
+                return Config._download(url, download_path, checksum, progress)
+            response.raise_for_status()
+            # Restart the download unless the content continues from the partial download
+            content_range = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+            if response.status_code != 206 or content_range is None or int(content_range.group(1)) != offset:
+                offset = 0
+            # Remember the url and the validator of the content to resume
+            with open(resume_path, 'w') as resume_file:
+                json.dump({'url': url, 'validator': response.headers.get('ETag', response.headers.get('Last-Modified'))}, resume_file)
+            total = int(response.headers['Content-Length']) + offset if 'Content-Length' in response.headers else None
+            with open(part_path, 'ab' if offset else 'wb') as part_file:
+                # Hash the partial download before resuming
+                if offset:
+                    for hasher in hashers:
+                        Config._hash_file(part_path, hasher=hasher)
+                if progress is not None:
+                    progress(offset, total)
+                # Write and hash each chunk as it is received
+                for chunk in response.iter_content(Config.__download_chunk_size):
+                    part_file.write(chunk)
+                    offset += len(chunk)
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    if progress is not None:
+                        progress(offset, total)
+        # Verify the checksum of the content, a partial download with a different checksum can not be resumed
+        if digest and hashers[-1].hexdigest() != digest:
+            Config._remove_download(part_path)
+            raise ConfigException(f'Checksum {algorithm}:{hashers[-1].hexdigest()} does not match {checksum} <{url}>')
+        # Move the completed download to the download path
+        os.replace(part_path, download_path)
+        Config._remove_download(part_path)
+        return (hashers[0].hexdigest(), response.headers)
+
+    # Remove a partial download and the information to resume it
+    @staticmethod
+    def _remove_download(part_path):
+        """Remove a partial download and the information to resume it"""
+        for path in [part_path, part_path + '.json']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Get the cached content of a remote url, only downloading if not cached or changed
+    @staticmethod
+    def _download_cached(url, checksum=None, progress=None):
+        """Get the path of the cached content of a remote url, only downloading if not cached or changed"""
+        cache_path = Config.get('path/download_cache')
+        algorithm, digest = Config._checksum(checksum)
+        with Config.__lock:
+            index = Config._load_download_index(cache_path)
+            entry = index['urls'].get(url, {})
+            # Content with a SHA-256 checksum is found by the content address without any request
+            sha256 = digest if algorithm == 'sha256' and Config._is_cached(index, cache_path, digest) else None
+            cached = Config._is_cached(index, cache_path, entry.get('sha256'))
+        if sha256 is None:
+            # Only download the content if changed since cached, by the validators of the cached content
+            headers = {}
+            if cached and entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if cached and entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            # Download to a temporary path by url so an interrupted download is resumed
+            download_path = os.path.join(cache_path, 'tmp', hashlib.sha256(url.encode('utf-8')).hexdigest())
+            os.makedirs(os.path.dirname(download_path), exist_ok=True)
+            Logger.debug(f'MEG Config: Downloading url <{url}> to cache <{cache_path}>')
+            downloaded = Config._download(url, download_path, checksum, progress, headers)
+            if downloaded is None:
+                # Verify the checksum of the content that was not modified
+                sha256 = entry['sha256']
+                if digest and (sha256 if algorithm == 'sha256' else Config._hash_file(Config._cached_path(cache_path, sha256), algorithm)) != digest:
+                    raise ConfigException(f'Checksum does not match {checksum} <{url}>')
+            else:
+                # Move the content to the content address
+                sha256, headers = downloaded
+                os.makedirs(os.path.dirname(Config._cached_path(cache_path, sha256)), exist_ok=True)
+                os.replace(download_path, Config._cached_path(cache_path, sha256))
+                entry = {'sha256': sha256, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        cached_path = Config._cached_path(cache_path, sha256)
+        with Config.__lock:
+            # Update the cache index with the used content and evict the least recently used content
+            index = Config._load_download_index(cache_path)
+            if entry.get('sha256') == sha256:
+                index['urls'][url] = entry
+            stat = os.stat(cached_path)
+            index['objects'][sha256] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'used': time.time()}
+            Config._evict_downloads(cache_path, index, sha256)
+            Config._save_download_index(cache_path, index)
+        return cached_path
+
+    # Get the path of cached content by content address
+    @staticmethod
+    def _cached_path(cache_path, sha256):
+        """Get the path of cached content by content address"""
+        return os.path.join(cache_path, sha256[:2], sha256)
+
+    # Check content is cached and unmodified since cached
+    @staticmethod
+    def _is_cached(index, cache_path, sha256):
+        """Check content is cached and unmodified since cached"""
+        if not sha256 or sha256 not in index['objects']:
+            return False
+        stat = Config._stat(Config._cached_path(cache_path, sha256))
+        return stat == (index['objects'][sha256]['mtime'], index['objects'][sha256]['size'])
+
+    # Load the download cache index
+    @staticmethod
+    def _load_download_index(cache_path):
+        """Load the download cache index of the validators by url and the status of content by content address"""
+        try:
+            with open(os.path.join(cache_path, 'index.json')) as index_file:
+                index = json.load(index_file)
+            if isinstance(index.get('urls'), dict) and isinstance(index.get('objects'), dict):
+                return index
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {'urls': {}, 'objects': {}}
+
+    # Save the download cache index
+    @staticmethod
+    def _save_download_index(cache_path, index):
+        """Save the download cache index"""
+        os.makedirs(cache_path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_path, prefix='.index.json.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(index, index_file)
+            os.replace(temp_path, os.path.join(cache_path, 'index.json'))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    # Evict the least recently used content until the download cache is within the size limit
+    @staticmethod
+    def _evict_downloads(cache_path, index, keep=None):
+        """Evict the least recently used content until the download cache is within the size limit"""
+        objects = index['objects']
+        size = sum(entry['size'] for entry in objects.values())
+        limit = Config.get('download/cache_size', Config.DEFAULT_DOWNLOAD_CACHE_SIZE)
+        for sha256 in sorted(objects, key=lambda sha256: objects[sha256]['used']):
+            if size <= limit:
+                break
+            if sha256 == keep:
+                continue
+            Logger.debug(f'MEG Config: Evicting cached download <{sha256}>')
+            try:
+                os.remove(Config._cached_path(cache_path, sha256))
+            except FileNotFoundError:
+                pass
+            size -= objects.pop(sha256)['size']
+        # Remove the validators of the evicted content
+        index['urls'] = {url: entry for url, entry in index['urls'].items() if entry.get('sha256') in objects}
+
+    # Check a path has the same content as cached content
+    @staticmethod
+    def _same_content(path, cached_path):
+        """Check a path has the same content as cached content"""
+        try:
+            if os.path.samefile(path, cached_path):
+                return True
+            return os.path.getsize(path) == os.path.getsize(cached_path) and Config._hash_file(path) == os.path.basename(cached_path)
+        except OSError:
+            return False
+
+    # Link or copy cached content to a download path, unless the download path already has the same content
+    @staticmethod
+    def _place_download(cached_path, download_path, unique_path=True, force=True):
+        """Link or copy cached content to a download path, unless the download path already has the same content"""
+        # Choose the download path and link or copy while locked so concurrent downloads choose different paths
+        with Config.__lock:
+            # Reuse the download path if it already has the same content
+            if Config._same_content(download_path, cached_path):
+                return download_path
+            download_path = Config.unique_path(download_path, unique_path, force)
+            if download_path:
+                Config._materialize_download(cached_path, download_path)
+            return download_path
+
+    # Link or copy cached content to a download path
+    @staticmethod
+    def _materialize_download(cached_path, download_path):
+        """Link or copy cached content to a download path, with a hard link, a reflink or a copy, whichever is possible first"""
+        link_path = download_path + '.link'
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        try:
+            os.link(cached_path, link_path)
+        except OSError:
+            try:
+                # Copy on write clone of the file, if supported
+                import fcntl
+                with open(cached_path, 'rb') as cached_file, open(link_path, 'wb') as link_file:
+                    fcntl.ioctl(link_file.fileno(), Config.__ficlone, cached_file.fileno())
+            except Exception:
+                shutil.copyfile(cached_path, link_path)
+        os.replace(link_path, download_path)
+
+    # Compile a key into the tuple of its individual parts
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _compile(key):
+        """Compile a key into the tuple of its individual parts"""
+        return tuple(sys.intern(sk) for sk in key.split('/') if sk)
+
+    # Lookup the unexpanded value of a compiled key
+    @staticmethod
+    def _lookup(subkeys):
+        """Lookup the unexpanded value of a compiled key"""
+        # Check to make sure the key was valid
+        if not len(subkeys) > 0:
+            return Config.__missing
+        # Parse the top level section, if lazily loaded
+        if Config.__lazy and subkeys[0] in Config.__lazy:
+            Config._materialize(subkeys[0])
+        # Go through each key and traverse the configuration dictionary
+        current_dict = Config.__instance
+        for sk in subkeys[:-1]:
+            # Get the dictionary element by key
+            current_dict = dict.get(current_dict, sk)
+            # Check the instance of the element is a dictionary or the key cannot be valid
+            if not isinstance(current_dict, dict):
+                return Config.__missing
+        # Get the value of the key
+        return dict.get(current_dict, subkeys[-1], Config.__missing)
+
+    # Parse the configuration references of a value
+    @staticmethod
+    def _parse(value):
+        """Parse the configuration references of a value"""
+        # Remove any duplicate references and compile the referenced keys
+        return tuple((m, Config._compile(m.strip())) for m in dict.fromkeys(Config.__reference_re.findall(value)))
+
+    # Substitute the resolved value of a compiled key for a reference
+    @staticmethod
+    def _substitute(subkeys):
+        """Substitute the resolved value of a compiled key for a reference"""
+        value = Config.__resolved[subkeys] if subkeys in Config.__resolved else Config._resolve(subkeys)
+        return '' if value is Config.__missing else str(value)
+
+    # Resolve the expanded value of a compiled key
+    @staticmethod
+    def _resolve(subkeys):
+        """Resolve the expanded value of a compiled key"""
+        if subkeys in Config.__resolved:
+            return Config.__resolved[subkeys]
+        # Only values with references need to be expanded
+        value = Config._lookup(subkeys)
+        if subkeys not in Config.__references:
+            return value
+        # Resolve the references in dependency order, so each referenced value is only expanded once
+        stack = [subkeys]
+        resolving = {subkeys}
+        while stack:
+            current = stack[-1]
+            # Get the next referenced value that still needs to be resolved
+            pending = next((r for (m, r) in Config.__references[current] if r in Config.__references and r not in Config.__resolved), None)
+            if pending is not None:
+                # A reference cycle can not be resolved
+                if pending in resolving:
+                    raise ConfigException(f'Reference cycle <{Config._format_cycle(stack[stack.index(pending):] + [pending])}>')
+                resolving.add(pending)
+                stack.append(pending)
+                continue
+            # Replace each configuration reference with the resolved value
+            value = Config._lookup(current)
+            for m, r in Config.__references[current]:
+                value = value.replace('$(' + m + ')', Config._substitute(r))
+            Config.__resolved[current] = value
+            resolving.discard(current)
+            stack.pop()
+        return Config.__resolved[subkeys]
+
+    # Update the references from a previous value to a new value
+    @staticmethod
+    def _reference(subkeys, previous_value, value, check=True):
+        """Update the references from a previous value to a new value, failing on reference cycles if checking"""
+        # Remove the references of the previous value
+        for leaf_subkeys, leaf_value in Config._leaves(subkeys, previous_value):
+            Config._dereference(leaf_subkeys)
+        # Add the references of the new value
+        referencing = []
+        for leaf_subkeys, leaf_value in Config._leaves(subkeys, value):
+            if Config._add_references(leaf_subkeys, leaf_value):
+                referencing.append(leaf_subkeys)
+        # Check the new references did not create a reference cycle
+        cycle = next((c for c in map(Config._find_referrer_cycle, referencing) if c is not None), None)
+        if cycle is not None and not check:
+            # Log the reference cycle but keep the references
+            Logger.warning(f'MEG Config: Reference cycle <{Config._format_cycle(cycle)}>')
+        elif cycle is not None:
+            # Restore the references of the previous value
+            for leaf_subkeys in referencing:
+                Config._dereference(leaf_subkeys)
+            for leaf_subkeys, leaf_value in Config._leaves(subkeys, previous_value):
+                Config._add_references(leaf_subkeys, leaf_value)
+            raise ConfigException(f'Reference cycle <{Config._format_cycle(cycle)}>')
+
+    # Add the references of a value
+    @staticmethod
+    def _add_references(subkeys, value):
+        """Add the references of a value"""
+        if not isinstance(value, str) or '$(' not in value:
+            return False
+        references = Config._parse(value)
+        if not references:
+            return False
+        Config.__references[subkeys] = references
+        for m, r in references:
+            Config.__referrers.setdefault(r, set()).add(subkeys)
+        return True
+
+    # Remove the references of a compiled key
+    @staticmethod
+    def _dereference(subkeys):
+        """Remove the references of a compiled key"""
+        for m, r in Config.__references.pop(subkeys, ()):
+            referrers = Config.__referrers.get(r)
+            if referrers is not None:
+                referrers.discard(subkeys)
+                if not referrers:
+                    del Config.__referrers[r]
+
+    # Find a reference cycle reachable from the referencing compiled keys
+    @staticmethod
+    def _find_cycle(referencing):
+        """Find a reference cycle reachable from the referencing compiled keys"""
+        # The compiled keys being visited and the compiled keys already visited
+        visiting = set()
+        visited = set()
+        for root in referencing:
+            if root in visited:
+                continue
+            # Depth first search the references
+            path = [root]
+            references = [iter(Config.__references[root])]
+            visiting.add(root)
+            while path:
+                for m, r in references[-1]:
+                    # Only referencing values can be part of a cycle
+                    if r not in Config.__references or r in visited:
+                        continue
+                    # A reference back to the search path is a cycle
+                    if r in visiting:
+                        return path[path.index(r):] + [r]
+                    visiting.add(r)
+                    path.append(r)
+                    references.append(iter(Config.__references[r]))
+                    break
+                else:
+                    # All of the references were visited
+                    visiting.discard(path[-1])
+                    visited.add(path.pop())
+                    references.pop()
+        return None
+
+    # Find a reference cycle through a referencing compiled key by searching its referrers
+    @staticmethod
+    def _find_referrer_cycle(subkeys):
+        """Find a reference cycle through a referencing compiled key by searching its referrers"""
+        # A cycle exists if any referenced key is also a direct or indirect referrer of the key
+        referenced = set(r for m, r in Config.__references[subkeys])
+        if subkeys in referenced:
+            return [subkeys, subkeys]
+        # Search the referrers, keeping the key each referrer references towards the key
+        towards = {subkeys: None}
+        queue = [subkeys]
+        while queue:
+            current = queue.pop()
+            for referrer in Config.__referrers.get(current, ()):
+                if referrer in towards:
+                    continue
+                towards[referrer] = current
+                if referrer in referenced:
+                    # Follow the references from the referrer back to the key
+                    cycle = [subkeys, referrer]
+                    while cycle[-1] != subkeys:
+                        cycle.append(towards[cycle[-1]])
+                    return cycle
+                queue.append(referrer)
+        return None
+
+    # Format a reference cycle for logging
+    @staticmethod
+    def _format_cycle(cycle):
+        """Format a reference cycle for logging"""
+        return ' -> '.join('/'.join(subkeys) for subkeys in cycle)
+
+    # Invalidate the resolved values that depend on a compiled key
+    @staticmethod
+    def _invalidate(subkeys, *values):
+        """Invalidate the resolved values that depend on a compiled key, returning the invalidated keys"""
+        # The key itself and every parent dictionary of the key are changed
+        changed = [subkeys[:i] for i in range(1, len(subkeys) + 1)]
+        # Every key inside a previous or new dictionary value is changed
+        for value in values:
+            if isinstance(value, dict):
+                changed.extend(sk_subkeys for sk_subkeys, sk_value in Config._walk(subkeys, value))
+        # Remove the resolved values of the changed keys and every key that depends on them
+        invalidated = set(changed)
+        while changed:
+            changed_subkeys = changed.pop()
+            Config.__resolved.pop(changed_subkeys, None)
+            for key in Config.__aliases.pop(changed_subkeys, ()):
+                Config.__values.pop(key, None)
+            for referrer in Config.__referrers.get(changed_subkeys, ()):
+                if referrer not in invalidated:
+                    invalidated.add(referrer)
+                    changed.append(referrer)
+        return invalidated
+
+    # Walk a dictionary value to get the compiled keys and values it contains
+    @staticmethod
+    def _walk(subkeys, value):
+        """Walk a dictionary value to get the compiled keys and values it contains"""
+        for sk, sk_value in value.items():
+            sk_subkeys = subkeys + (sys.intern(sk),)
+            yield sk_subkeys, sk_value
+            if isinstance(sk_value, dict):
+                yield from Config._walk(sk_subkeys, sk_value)
+
+    # Get the compiled keys and values of the non-dictionary values in a value
+    @staticmethod
+    def _leaves(subkeys, value):
+        """Get the compiled keys and values of the non-dictionary values in a value"""
+        if isinstance(value, dict):
+            return ((sk_subkeys, sk_value) for sk_subkeys, sk_value in Config._walk(subkeys, value) if not isinstance(sk_value, dict))
+        return () if value is Config.__missing else ((subkeys, value),)
+
+    # Get the values of a compiled key in each layer that are merged, from the highest priority layer
+    @staticmethod
+    def _layer_values(subkeys):
+        """Get the values of a compiled key in each layer that are merged, from the highest priority layer"""
+        values = []
+        for layer in reversed(Config.LAYERS):
+            value = Config.__layers[layer]
+            for sk in subkeys:
+                # A parent value that is not a dictionary hides the values of the lower priority layers
+                if not isinstance(value, dict):
+                    return values
+                value = value.get(sk, Config.__missing)
+                if value is Config.__missing:
+                    break
+            else:
+                # A value that is not a dictionary hides the values of the lower priority layers
+                if values and not isinstance(value, dict):
+                    return values
+                values.append(value)
+                if not isinstance(value, dict):
+                    return values
+        return values
+
+    # Merge the values of the layers, from the highest priority layer
+    @staticmethod
+    def _merge_values(values):
+        """Merge the values of the layers, from the highest priority layer"""
+        if not values:
+            return Config.__missing
+        # The highest priority value that is not a dictionary is not merged
+        if not isinstance(values[0], dict):
+            return values[0]
+        # Merge each key of the dictionaries, keeping the order of the lowest priority layer
+        merged = {}
+        for value in reversed(values):
+            merged.update(dict.fromkeys(value))
+        for sk in merged:
+            sk_values = []
+            for value in values:
+                if sk in value:
+                    # A value that is not a dictionary hides the values of the lower priority layers
+                    if sk_values and not isinstance(value[sk], dict):
+                        break
+                    sk_values.append(value[sk])
+                    if not isinstance(value[sk], dict):
+                        break
+            merged[sk] = Config._merge_values(sk_values)
+        return merged
+
+    # Merge the values of a compiled key from the layers into the configuration
+    @staticmethod
+    def _merge(subkeys, check=True):
+        """Merge the values of a compiled key from the layers into the configuration, returning the invalidated keys"""
+        # Merge from the first parent that is no longer a dictionary in the layers, if any
+        for i in range(1, len(subkeys)):
+            values = Config._layer_values(subkeys[:i])
+            if not values or not isinstance(values[0], dict):
+                subkeys = subkeys[:i]
+                break
+        # Merge the value, updating the references and invalidating the resolved values that depend on the value
+        previous_value = Config._lookup(subkeys)
+        value = Config._merge_values(Config._layer_values(subkeys))
+        Config._reference(subkeys, previous_value, value, check)
+        invalidated = Config._invalidate(subkeys, previous_value, value)
+        # Go through each key and traverse the configuration dictionary
+        current_dict = Config.__instance
+        for sk in subkeys[:-1]:
+            if not isinstance(dict.get(current_dict, sk), dict):
+                dict.__setitem__(current_dict, sk, {})
+            current_dict = dict.__getitem__(current_dict, sk)
+        # Set or remove the merged value
+        if value is Config.__missing:
+            dict.pop(current_dict, subkeys[-1], None)
+            # Remove the parent dictionaries that are no longer in any layer
+            for i in range(len(subkeys) - 1, 0, -1):
+                if Config._layer_values(subkeys[:i]):
+                    break
+                Config.__instance._remove(Config.__instance, list(subkeys[:i]))
+        else:
+            dict.__setitem__(current_dict, subkeys[-1], value)
+        return invalidated
+
+    # Replace the values of a layer, merging only the changed values into the configuration
+    @staticmethod
+    def _set_layer(layer, values):
+        """Replace the values of a layer, merging only the changed values into the configuration"""
+        with Config.__lock:
+            previous_values = Config.__layers[layer]
+            Config.__layers[layer] = values
+            for subkeys in list(Config._diff((), previous_values, values)):
+                Config.__changed.update(Config._merge(subkeys, False))
+
+    # Get the compiled keys of the values that differ between two dictionaries
+    @staticmethod
+    def _diff(subkeys, previous_values, values):
+        """Get the compiled keys of the values that differ between two dictionaries"""
+        for sk in dict.fromkeys(list(previous_values) + list(values)):
+            previous_value = previous_values.get(sk, Config.__missing)
+            value = values.get(sk, Config.__missing)
+            if isinstance(previous_value, dict) and isinstance(value, dict):
+                yield from Config._diff(subkeys + (sys.intern(sk),), previous_value, value)
+            elif previous_value is not value and (previous_value is Config.__missing or value is Config.__missing or previous_value != value):
+                yield subkeys + (sys.intern(sk),)
+
+    # Update a dictionary, merging the nested dictionaries
+    @staticmethod
+    def _update(values, update_values):
+        """Update a dictionary, merging the nested dictionaries"""
+        for sk, value in update_values.items():
+            if isinstance(value, dict) and isinstance(values.get(sk), dict):
+                Config._update(values[sk], value)
+            else:
+                values[sk] = value
+        return values
+
+    # Rebuild the merged configuration and the references and reset the resolved values
+    @staticmethod
+    def _rebuild(check=True):
+        """Rebuild the merged configuration and the references and reset the resolved values"""
+        # Merge every layer into the configuration
+        super(Config, Config.__instance).clear()
+        Config.__instance.update(Config._merge_values([Config.__layers[layer] for layer in reversed(Config.LAYERS)]))
+        # Any subscribed key may have changed
+        Config.__changed.update(Config.__subscribers)
+        Config.__values.clear()
+        Config.__aliases.clear()
+        Config.__resolved.clear()
+        Config.__references.clear()
+        Config.__referrers.clear()
+        # Add the references of every value in the configuration
+        for subkeys, value in Config._leaves((), Config.__instance):
+            Config._add_references(subkeys, value)
+        # Check the configuration has no reference cycles
+        if check:
+            cycle = Config._find_cycle(list(Config.__references))
+            if cycle is not None:
+                raise ConfigException(f'Reference cycle <{Config._format_cycle(cycle)}>')
+
+    # Schedule a save, unless the same save is already scheduled
+    @staticmethod
+    def _save_later(path, overwrite, delay):
+        """Schedule a save, unless the same save is already scheduled"""
+        with Config.__lock:
+            # The scheduled save will save the configuration as it is when the delay ends
+            if (path, overwrite) not in Config.__scheduled:
+                timer = threading.Timer(delay, Config._save_scheduled, (path, overwrite))
+                timer.daemon = True
+                Config.__scheduled[(path, overwrite)] = timer
+                timer.start()
+        return True
+
+    # Save a scheduled save
+    @staticmethod
+    def _save_scheduled(path, overwrite):
+        """Save a scheduled save"""
+        with Config.__lock:
+            Config.__scheduled.pop((path, overwrite), None)
+            Config.save(path, overwrite)
+
+    # Get configuration values without the blocked keys, only copying the dictionaries that contain blocked keys
+    @staticmethod
+    def _unblocked(values):
+        """Get configuration values without the blocked keys, only copying the dictionaries that contain blocked keys"""
+        unblocked = dict(values)
+        for blocked_key in Config.__blocked_keys:
+            # Copy each dictionary that contains the blocked key
+            subkeys = Config._compile(blocked_key)
+            current_dict = unblocked
+            parents = []
+            for sk in subkeys[:-1]:
+                if not isinstance(current_dict.get(sk), dict):
+                    break
+                current_dict[sk] = dict(current_dict[sk])
+                parents.append((current_dict, sk))
+                current_dict = current_dict[sk]
+            else:
+                # Remove the blocked key and the parent dictionaries that are now empty
+                current_dict.pop(subkeys[-1], None)
+                for parent_dict, sk in reversed(parents):
+                    if parent_dict[sk]:
+                        break
+                    parent_dict.pop(sk)
+        return unblocked
+
+    # Call the callbacks subscribed to the changed keys
+    @staticmethod
+    def _notify():
+        """Call the callbacks subscribed to the changed keys"""
+        with Config.__lock:
+            changed = Config.__changed
+            Config.__changed = set()
+            # The changed keys include the parent dictionaries and the contents of replaced dictionaries of each changed key
+            callbacks = [subscriber for subkeys, subscribers in Config.__subscribers.items() if subkeys in changed for subscriber in subscribers]
+        # Call the callbacks without holding the lock
+        for key, callback in callbacks:
+            try:
+                callback(key, Config.get(key, None))
+            except Exception as e:
+                # Log that the callback failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not notify change of configuration key <{key}>')
+
+    # Watch a configuration file until stopped
+    @staticmethod
+    def _watch(path, inotify, interval, stop):
+        """Watch a configuration file until stopped, polling if there is no inotify instance"""
+        try:
+            while not stop.is_set():
+                if inotify is None:
+                    # Poll the file status
+                    stop.wait(interval)
+                elif not select.select([inotify], [], [], interval)[0]:
+                    # Wait again for changes
+                    continue
+                elif os.path.basename(path) not in Config._inotify_names(os.read(inotify, 65536)):
+                    # Only reload for changes to the configuration file
+                    continue
+                if not stop.is_set():
+                    Config.reload(path)
+        finally:
+            if inotify is not None:
+                os.close(inotify)
+
+    # Create an inotify instance watching a directory, if supported
+    @staticmethod
+    def _inotify(path):
+        """Create an inotify instance watching a directory, if supported"""
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if inotify < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(inotify, os.fsencode(path), Config.__inotify_mask) < 0:
+                e = OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+                os.close(inotify)
+                raise e
+            return inotify
+        except Exception as e:
+            # Log that polling is used instead
+            Logger.debug(f'MEG Config: {e}')
+            Logger.debug(f'MEG Config: Polling for changes to <{path}>')
+            return None
+
+    # Get the file names of inotify events
+    @staticmethod
+    def _inotify_names(events):
+        """Get the file names of inotify events"""
+        names = set()
+        offset = 0
+        while offset + 16 <= len(events):
+            # Each event is the watch descriptor, mask, cookie and name length followed by the padded name
+            length = struct.unpack_from('iIII', events, offset)[3]
+            names.add(os.fsdecode(events[offset + 16:offset + 16 + length].rstrip(b'\0')))
+            offset += 16 + length
+        return names
+
+    # Get the status of a file to detect changes
+    @staticmethod
+    def _stat(path):
+        """Get the status of a file to detect changes"""
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    # Memory map a configuration file and index the top level sections to parse on first access
+    @staticmethod
+    def _load_lazy(path):
+        """Memory map a configuration file and index the top level sections to parse on first access"""
+        with open(path, 'rb') as config_file:
+            # Empty files can not be memory mapped
+            if os.fstat(config_file.fileno()).st_size == 0:
+                return json.loads(b'')
+            lazy_map = mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Only indented files can be indexed without parsing, by the indentation of the top level keys
+        indent = Config.__lazy_indent_re.match(lazy_map)
+        end = lazy_map.rfind(b'}')
+        if indent is None or end < 0:
+            try:
+                return json.loads(lazy_map[:])
+            finally:
+                lazy_map.close()
+        key_re = re.compile(b'\n' + re.escape(indent.group(1)) + Config.__lazy_key_re)
+        # Get the byte range of each top level section value, ending at the next top level key or the end of the file
+        keys = list(key_re.finditer(lazy_map, indent.start(1) - 1, end))
+        config = {}
+        for i, key in enumerate(keys):
+            sk = sys.intern(json.loads(b'"' + key.group(1) + b'"'))
+            Config.__lazy[sk] = (key.end(), keys[i + 1].start() if i + 1 < len(keys) else end)
+        Config.__lazy_map = lazy_map
+        Logger.debug(f'MEG Config: Lazily loading {len(Config.__lazy)} sections <{path}>')
+        # Parse the sections that are always needed
+        for sk in Config.__eager_sections:
+            if sk in Config.__lazy:
+                config[sk] = Config._parse_lazy(sk)
+        return config
+
+    # Parse a lazily loaded top level section
+    @staticmethod
+    def _parse_lazy(key):
+        """Parse a lazily loaded top level section"""
+        start, end = Config.__lazy.pop(key)
+        try:
+            # Remove the separator between the section and the next section
+            content = Config.__lazy_map[start:end].rstrip()
+            if content.endswith(b','):
+                content = content[:-1]
+            return json.loads(content)
+        finally:
+            # Unmap the file when all the sections are parsed
+            if not Config.__lazy:
+                Config._unload_lazy()
+
+    # Parse a lazily loaded top level section into the configuration
+    @staticmethod
+    def _materialize(key):
+        """Parse a lazily loaded top level section into the configuration"""
+        with Config.__lock:
+            # Check the section was not already parsed
+            if key not in Config.__lazy:
+                return
+            try:
+                value = Config._parse_lazy(key)
+            except Exception as e:
+                # Log that parsing the section failed
+                Logger.warning(f'MEG Config: {e}')
+                Logger.warning(f'MEG Config: Could not load configuration section <{key}>')
+                return
+            # Update the configuration layer and merge the section into the configuration
+            Config._update(Config.__layers[Config.DEFAULT_LAYER], {key: value})
+            Config._merge((key,), False)
+
+    # Parse every lazily loaded top level section into the configuration
+    @staticmethod
+    def _materialize_all():
+        """Parse every lazily loaded top level section into the configuration"""
+        with Config.__lock:
+            for key in list(Config.__lazy):
+                Config._materialize(key)
+
+    # Unmap the lazily loaded configuration file, discarding the sections not yet parsed
+    @staticmethod
+    def _unload_lazy():
+        """Unmap the lazily loaded configuration file, discarding the sections not yet parsed"""
+        Config.__lazy.clear()
+        if Config.__lazy_map is not None:
+            Config.__lazy_map.close()
+            Config.__lazy_map = None
 
     # Remove a key and all empty parent dictionaries that contain that key
     def _remove(self, current_dict, subkeys):
@@ -362,7 +1601,7 @@ class Config(dict):
         # Check if this is the value to remove
         if len(subkeys) == 1:
             # Remove the key value
-            current_dict.pop(sk)
+            current_dict.pop(sk, None)
         # Check if the subkey is in the current dictionary
         elif sk in current_dict:
             # Recurse the next subkey and dictionary
@@ -373,40 +1612,42 @@ class Config(dict):
         # Removed the key
         return True
 
-    # Set the default values
+    # Set the required values
     def _set_required(self, config_path):
-        """Set the default values"""
-        # Get the user path from the environment, if present, otherwise use the default path
-        self['path']['user'] = str(Path.home()) if 'MEG_USER_PATH' not in os.environ else os.environ['MEG_USER_PATH']
-        # Load configuration from the environment, if present, otherwise use the default path
-        self['path']['config'] = config_path
-        # Get the default downloads path, if not already present
-        if 'downloads' not in self['path']:
-            # Get the default downloads path
-            downloads_path = os.path.join('$(path/user)', 'Downloads')
-            if os.name == 'nt':
-                try:
-                    import winreg
-                    # For windows, the registry must be queried for the correct default downloads path
-                    with winreg.OpenKey(winreg.HKEY_CURRENT_USER, 'SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders') as key:
-                        downloads_path = winreg.QueryValueEx(key, '{374DE290-123F-4565-9164-39C4925E467B}')[0]
-                except Exception as e:
-                    Logger.warning(f'MEG Config: {e}')
-            # Get the downloads directory from the environment, if present, otherwise use the default path
-            self['path']['downloads'] = downloads_path if 'MEG_DOWNLOADS_PATH' not in os.environ else os.environ['MEG_DOWNLOADS_PATH']
+        """Set the required values"""
+        # The path of the loaded configuration overrides the default path and the path from the environment
+        Config.__layers['environment'].setdefault('path', {})['config'] = config_path
 
     # Set the default values
     def _set_defaults(self):
         """Set the default values"""
-        # Create the path dictionary
-        self['path'] = {}
-        # Set the required values
-        self._set_required(os.path.join('$(path/home)', 'config.json') if 'MEG_CONFIG_PATH' not in os.environ else os.environ['MEG_CONFIG_PATH'])
-        # Get the home path from the environment, if present, otherwise use the default path
-        self['path']['home'] = os.path.join('$(path/user)', '.meg') if 'MEG_HOME_PATH' not in os.environ else os.environ['MEG_HOME_PATH']
-        # Get the cache path from the environment, if present, otherwise use the default path
-        self['path']['cache'] = os.path.join('$(path/home)', 'cache') if 'MEG_CACHE_PATH' not in os.environ else os.environ['MEG_CACHE_PATH']
-        # Get the plugins path from the environment, if present, otherwise use the default path
-        self['path']['plugins'] = os.path.join('$(path/home)', 'plugins') if 'MEG_PLUGINS_PATH' not in os.environ else os.environ['MEG_PLUGINS_PATH']
-        # Get the plugin cache path from the environment, if present, otherwise use the default path
-        self['path']['plugin_cache'] = os.path.join('$(path/home)', 'plugin_cache') if 'MEG_PLUGIN_CACHE_PATH' not in os.environ else os.environ['MEG_PLUGIN_CACHE_PATH']
+        defaults = Config.__layers['defaults'].setdefault('path', {})
+        environment = Config.__layers['environment'].setdefault('path', {})
+        # Get the default user path
+        defaults['user'] = str(Path.home())
+        # Get the default configuration path
+        defaults['config'] = os.path.join('$(path/home)', 'config.json')
+        # Get the default home path
+        defaults['home'] = os.path.join('$(path/user)', '.meg')
+        # Get the default cache path
+        defaults['cache'] = os.path.join('$(path/home)', 'cache')
+        # Get the default plugins path
+        defaults['plugins'] = os.path.join('$(path/home)', 'plugins')
+        # Get the default plugin cache path
+        defaults['plugin_cache'] = os.path.join('$(path/home)', 'plugin_cache')
+        # Get the default download cache path
+        defaults['download_cache'] = os.path.join('$(path/cache)', '.downloads')
+        # Get the default downloads path
+        defaults['downloads'] = os.path.join('$(path/user)', 'Downloads')
+        if os.name == 'nt':
+            try:
+                import winreg
+                # For windows, the registry must be queried for the correct default downloads path
+                with winreg.OpenKey(winreg.HKEY_CURRENT_USER, 'SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Explorer\\Shell Folders') as key:
+                    defaults['downloads'] = winreg.QueryValueEx(key, '{374DE290-123F-4565-9164-39C4925E467B}')[0]
+            except Exception as e:
+                Logger.warning(f'MEG Config: {e}')
+        # Get the paths from the environment, if present, which are overridden by the paths of the user configuration
+        for key, variable in Config.__environment_paths.items():
+            if variable in os.environ:
+                environment[key] = os.environ[variable]
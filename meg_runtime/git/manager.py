@@ -4,9 +4,16 @@ Git repository manager for runtime
 """
 
 import os
+import time
 import pathlib
+import functools
+import threading
+import contextlib
+import collections
+import concurrent.futures
+from pygit2 import discover_repository
 from meg_runtime.config import Config
-from meg_runtime.git.repository import GitRepository, GitException
+from meg_runtime.git.repository import GitRepository, GitRemoteCallbacks, GitException
 from meg_runtime.logger import Logger
 
 
@@ -16,6 +23,18 @@ class GitManager(dict):
 
     # The git repository manager instance
     __instance = None
+    # The default path for cloned repositories
+    __repos_path = None
+    # The default maximum number of idle repositories kept open in the pool
+    DEFAULT_POOL_SIZE = 16
+    # The idle pooled repositories by canonical repository path, least recently used first
+    __pool = collections.OrderedDict()
+    # The number of idle pooled repositories
+    __pool_idle = 0
+    # The number of acquired repositories by canonical repository path
+    __pool_acquired = {}
+    # The lock of the pool
+    __pool_lock = threading.Lock()
 
     # Git repository manager constructor
     def __init__(self, **kwargs):
@@ -29,6 +48,10 @@ class GitManager(dict):
             super().__init__(**kwargs)
             # Set this as the current git repository manager instance
             GitManager.__instance = self
+            # Update the default path for cloned repositories when the configuration changes
+            GitManager._repos_path_changed()
+            Config.subscribe('path/repos', GitManager._repos_path_changed)
+            Config.subscribe('path/user', GitManager._repos_path_changed)
 
     # Initialize local git repository
     @staticmethod
@@ -70,8 +93,8 @@ class GitManager(dict):
 
     # Clone a remote git repository to a local repository
     @staticmethod
-    def clone(repo_url, repo_path=None, checkout_branch=None, bare=False, *args, **kwargs):
-        """Clone a remote git repository to a local repository"""
+    def clone(repo_url, repo_path=None, checkout_branch=None, bare=False, depth=0, sparse_paths=None, callbacks=None, *args, **kwargs):
+        """Clone a remote git repository to a local repository, only the last depth commits if depth is not zero and only checking out the files matching the sparse paths if any"""
         # Check there is git repository manager instance
         if GitManager.__instance is None:
             GitManager()
@@ -85,7 +108,7 @@ class GitManager(dict):
                     #  1. The configured repositories directory path
                     #  2. The configured user directory path
                     #  3. The current working directory path
-                    repo_prefix = Config.get('path/repos', Config.get('path/user', os.curdir))
+                    repo_prefix = GitManager.__repos_path
                     # Append the name of the repository to the path
                     if isinstance(repo_url, str):
                         repo_path = os.path.join(repo_prefix, pathlib.Path(repo_url).stem)
@@ -94,7 +117,7 @@ class GitManager(dict):
                     else:
                         raise GitException(f'No local repository path was provided and the path could not be determined from the remote <{repo_url}>')
                 # Clone the repository by creating a repository instance
-                return GitRepository(repo_path, repo_url, checkout_branch=checkout_branch, bare=bare, *args, **kwargs)
+                return GitRepository(repo_path, repo_url, checkout_branch=checkout_branch, bare=bare, depth=depth, sparse_paths=sparse_paths, callbacks=callbacks, *args, **kwargs)
             except Exception as e:
                 # Log that cloning the repo failed
                 Logger.warning(f'MEG Git: {e}')
@@ -103,9 +126,171 @@ class GitManager(dict):
 
     # Open local git repository or clone a remote git repository to a local repository
     @staticmethod
-    def open_or_clone(repo_path, repo_url, checkout_branch=None, bare=False, *args, **kwargs):
-        """Open local git repository or clone a remote git repository to a local repository"""
+    def open_or_clone(repo_path, repo_url, checkout_branch=None, bare=False, depth=0, sparse_paths=None, *args, **kwargs):
+        """Open local git repository or clone a remote git repository to a local repository, with the clone options of clone"""
         repo = GitManager.open(repo_path, checkout_branch=checkout_branch, bare=bare, *args, **kwargs)
         if repo is None:
-            repo = GitManager.clone(repo_url, repo_path=repo_path, checkout_branch=checkout_branch, bare=bare, *args, **kwargs)
+            repo = GitManager.clone(repo_url, repo_path=repo_path, checkout_branch=checkout_branch, bare=bare, depth=depth, sparse_paths=sparse_paths, *args, **kwargs)
         return repo
+
+    # Acquire an open local git repository from the pool
+    @staticmethod
+    def acquire(repo_path):
+        """Acquire an open local git repository from the pool, opening the repository if no idle repository is pooled, or None if it could not be opened"""
+        # Check there is git repository manager instance
+        if GitManager.__instance is None:
+            GitManager()
+        if GitManager.__instance is None:
+            return None
+        # Different paths of the same repository share the pooled repositories
+        path = discover_repository(repo_path) if os.path.exists(repo_path) else None
+        if path is None:
+            return GitManager.open(repo_path)
+        key = os.path.realpath(path)
+        with GitManager.__pool_lock:
+            idle = GitManager.__pool.get(key)
+            repo = idle.pop() if idle else None
+            if repo is not None:
+                GitManager.__pool_idle -= 1
+                if not idle:
+                    del GitManager.__pool[key]
+                GitManager.__pool_acquired[key] = GitManager.__pool_acquired.get(key, 0) + 1
+                return repo
+        # Open the repository without holding the lock of the pool
+        repo = GitManager.open(repo_path)
+        if repo is not None:
+            with GitManager.__pool_lock:
+                GitManager.__pool_acquired[key] = GitManager.__pool_acquired.get(key, 0) + 1
+        return repo
+
+    # Release an acquired local git repository to the pool
+    @staticmethod
+    def release(repo):
+        """Release an acquired local git repository to the pool, freeing the least recently used idle repositories beyond the pool size"""
+        if repo is None:
+            return
+        key = os.path.realpath(repo.path)
+        pool_size = Config.get('git/pool_size', GitManager.DEFAULT_POOL_SIZE)
+        evicted = []
+        with GitManager.__pool_lock:
+            acquired = GitManager.__pool_acquired.get(key, 0) - 1
+            if acquired > 0:
+                GitManager.__pool_acquired[key] = acquired
+            else:
+                GitManager.__pool_acquired.pop(key, None)
+            GitManager.__pool.setdefault(key, []).append(repo)
+            GitManager.__pool.move_to_end(key)
+            GitManager.__pool_idle += 1
+            while GitManager.__pool_idle > pool_size:
+                evicted_key, idle = next(iter(GitManager.__pool.items()))
+                evicted.append(idle.pop(0))
+                GitManager.__pool_idle -= 1
+                if not idle:
+                    del GitManager.__pool[evicted_key]
+        # Free the evicted repositories without holding the lock of the pool
+        for evicted_repo in evicted:
+            evicted_repo.free()
+
+    # Acquire an open local git repository from the pool for the duration of a with statement
+    @staticmethod
+    @contextlib.contextmanager
+    def repository(repo_path):
+        """Acquire an open local git repository from the pool for the duration of a with statement, releasing it afterward"""
+        repo = GitManager.acquire(repo_path)
+        try:
+            yield repo
+        finally:
+            GitManager.release(repo)
+
+    # Free the idle repositories of the pool
+    @staticmethod
+    def free_pool():
+        """Free the idle repositories of the pool, acquired repositories are pooled again when released"""
+        with GitManager.__pool_lock:
+            evicted = [repo for idle in GitManager.__pool.values() for repo in idle]
+            GitManager.__pool.clear()
+            GitManager.__pool_idle = 0
+        for repo in evicted:
+            repo.free()
+
+    # Get the number of idle and acquired repositories of the pool
+    @staticmethod
+    def pool_stats():
+        """Get the number of idle and acquired repositories of the pool"""
+        with GitManager.__pool_lock:
+            return {'idle': GitManager.__pool_idle, 'acquired': sum(GitManager.__pool_acquired.values())}
+
+    # Fetch the remotes of many local git repositories concurrently
+    @staticmethod
+    def fetch_all(repos, remote_names=None, max_workers=8, timeout=None, progress=None, completed=None):
+        """Fetch the remotes of many local git repositories concurrently, returning the received objects of each remote of each repository in the same order as the repositories"""
+        # Check there is git repository manager instance
+        if GitManager.__instance is None:
+            GitManager()
+        if GitManager.__instance is None:
+            return None
+        # Open each repository again in its fetch thread since repository handles are not shared between threads
+        repo_paths = [repo.path if isinstance(repo, GitRepository) else repo for repo in repos]
+        results = {}
+        started = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='MEG Git fetch')
+        try:
+            futures = {executor.submit(GitManager._fetch_repo, repo_path, remote_names, timeout, progress, started): repo_path
+                       for repo_path in dict.fromkeys(repo_paths)}
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=None if timeout is None else 0.1,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                finished = [(future, future.result()) for future in done]
+                # Stop waiting for fetches that did not abort at their deadline, like a connection that stopped responding
+                if timeout is not None:
+                    now = time.monotonic()
+                    for future in [future for future in pending if futures[future] in started and now > started[futures[future]] + timeout]:
+                        Logger.warning(f'MEG Git: Fetching git repository <{futures[future]}> timed out')
+                        pending.remove(future)
+                        finished.append((future, None))
+                for future, result in finished:
+                    repo_path = futures[future]
+                    results[repo_path] = result
+                    if completed is not None:
+                        try:
+                            completed(repo_path, result)
+                        except Exception as e:
+                            # Log that the completed fetch callback failed
+                            Logger.warning(f'MEG Git: {e}')
+                            Logger.warning(f'MEG Git: Could not complete fetch of git repository <{repo_path}>')
+        finally:
+            # Do not wait for fetches that timed out
+            executor.shutdown(wait=False)
+        return [results.get(repo_path) for repo_path in repo_paths]
+
+    # Fetch the remotes of a local git repository
+    @staticmethod
+    def _fetch_repo(repo_path, remote_names, timeout, progress, started):
+        """Fetch the remotes of a local git repository, returning the received objects of each remote or None if the remote could not be fetched"""
+        started[repo_path] = time.monotonic()
+        deadline = None if timeout is None else started[repo_path] + timeout
+        # Reuse a pooled repository, which is opened and logged by the pool if there is none
+        with GitManager.repository(repo_path) as repo:
+            if repo is None:
+                return None
+            fetched = {}
+            for remote in repo.remotes:
+                if remote_names is not None and remote.name not in remote_names:
+                    continue
+                callbacks = GitRemoteCallbacks(None if progress is None else functools.partial(progress, repo_path, remote.name), deadline)
+                try:
+                    fetched[remote.name] = remote.fetch(callbacks=callbacks).received_objects
+                except Exception as e:
+                    # Log that fetching the remote failed
+                    Logger.warning(f'MEG Git: {e}')
+                    Logger.warning(f'MEG Git: Could not fetch remote <{remote.name}> of git repository <{repo_path}>')
+                    fetched[remote.name] = None
+            return fetched
+
+    # Update the default path for cloned repositories
+    @staticmethod
+    def _repos_path_changed(key=None, path=None):
+        """Update the default path for cloned repositories"""
+        GitManager.__repos_path = Config.get('path/repos', Config.get('path/user', os.curdir))
+        Logger.debug(f'MEG Git: Default repositories path <{GitManager.__repos_path}>')
@@ -1,6 +1,17 @@
 """Git repository"""
 
-from pygit2 import init_repository, clone_repository, Repository
+import os
+import time
+import shutil
+import inspect
+from pygit2 import init_repository, clone_repository, Repository, Remote, RemoteCallbacks, Signature, IndexEntry, GitError
+from pygit2 import GIT_DELTA_DELETED, GIT_FILEMODE_BLOB, GIT_FILEMODE_TREE, GIT_MERGE_ANALYSIS_UP_TO_DATE, GIT_MERGE_ANALYSIS_FASTFORWARD
+
+
+# Whether the installed pygit2 can clone and fetch only the last commits, which needs pygit2 1.14 or later
+SHALLOW_SUPPORTED = 'depth' in inspect.signature(clone_repository).parameters and 'depth' in inspect.signature(Remote.fetch).parameters
+# The files in the working tree that are rewritten by the runtime, which are kept as they are by pulls
+RUNTIME_PATHS = ('.meg/locks.json', '.meg/locks.json.journal')
 
 
 # Git exception
@@ -13,39 +24,314 @@ class GitException(Exception):
         super().__init__(message, **kwargs)
 
 
+# Git remote callbacks
+class GitRemoteCallbacks(RemoteCallbacks):
+    """Git remote callbacks reporting transfer progress and aborting transfers after a deadline or when cancelled"""
+
+    # Git remote callbacks constructor
+    def __init__(self, progress=None, deadline=None, cancelled=None, *args, **kwargs):
+        """Git remote callbacks constructor, the deadline is a time.monotonic() value and cancelled is a threading.Event"""
+        super().__init__(*args, **kwargs)
+        self.progress = progress
+        self.deadline = deadline
+        self.cancelled = cancelled
+
+    # Report the progress of a transfer
+    def transfer_progress(self, stats):
+        """Report the received and total objects of a transfer, aborting the transfer after the deadline or when cancelled"""
+        self.check_aborted()
+        if self.progress is not None:
+            self.progress(stats.received_objects, stats.total_objects)
+
+    # Check the transfer is not aborted while the remote is sending progress messages
+    def sideband_progress(self, string):
+        """Check the transfer is not aborted while the remote is sending progress messages"""
+        self.check_aborted()
+
+    # Abort the transfer after the deadline or when cancelled
+    def check_aborted(self):
+        """Abort the transfer after the deadline or when cancelled by raising an exception"""
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise GitException('Transfer cancelled')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise GitException('Transfer timed out')
+
+
 # Git repository
 class GitRepository(Repository):
     """Git repository"""
 
     # Git repository constructor
-    def __init__(self, path, url=None, checkout_branch=None, bare=False, init=False, *args, **kwargs):
-        """Git repository constructor"""
+    def __init__(self, path, url=None, checkout_branch=None, bare=False, init=False, *args, depth=0, sparse_paths=None, callbacks=None, **kwargs):
+        """Git repository constructor, cloning only the last depth commits if depth is not zero and only checking out the files matching the sparse paths if any"""
         # Check for special construction
+        if depth and url is not None and not init and not SHALLOW_SUPPORTED:
+            raise GitException('Shallow clones are not supported by the installed pygit2')
         if init:
             # Initialize a new repository
             self.__dict__ = init_repository(path, bare=bare, workdir_path=path, origin_url=url).__dict__
+        elif url is not None and sparse_paths is not None and not bare:
+            # Clone a repository without writing the files outside of the sparse paths
+            self.__dict__ = GitRepository.__clone_sparse(url, path, checkout_branch, depth, sparse_paths, callbacks).__dict__
         elif url is not None:
             # Clone a repository
-            self.__dict__ = clone_repository(url, path, bare=bare, checkout_branch=checkout_branch).__dict__
+            self.__dict__ = clone_repository(url, path, bare=bare, checkout_branch=checkout_branch, **GitRepository.__transfer_options(depth, callbacks)).__dict__
         # Initialize the git repository super class
         super().__init__(path, *args, **kwargs)
 
+    # Clone a repository only checking out the files matching the sparse paths
+    @staticmethod
+    def __clone_sparse(url, path, checkout_branch, depth, sparse_paths, callbacks):
+        """Clone a repository only checking out the files matching the sparse paths, the other files are tracked without being written"""
+        created = not os.path.exists(path)
+        repo = init_repository(path, origin_url=url)
+        remote = repo.remotes['origin']
+        try:
+            if checkout_branch is None and hasattr(remote, 'list_heads'):
+                # Check out the default branch of the remote
+                head = next((head.symref_target for head in remote.list_heads(callbacks=callbacks) if head.name == 'HEAD' and head.symref_target), 'refs/heads/master')
+                checkout_branch = head[len('refs/heads/'):]
+            remote.fetch(**GitRepository.__transfer_options(depth, callbacks))
+            if checkout_branch is None:
+                # Older pygit2 cannot list the remote head, so check out the main or master branch or else the first branch
+                branches = sorted(name[len('origin/'):] for name in repo.branches.remote if name.startswith('origin/') and name != 'origin/HEAD')
+                checkout_branch = next((name for name in ['main', 'master'] if name in branches), branches[0] if branches else None)
+            reference = repo.references.get(f'refs/remotes/origin/{checkout_branch}')
+            if reference is None:
+                raise GitException(f'Remote branch <{checkout_branch}> was not found')
+        except Exception:
+            # Remove the repository of a failed clone like clone_repository
+            repo.free()
+            shutil.rmtree(path if created else repo.path, True)
+            raise
+        commit = repo[reference.target]
+        # Track every file in the index before checking out only the matching files
+        repo.index.read_tree(commit.tree)
+        repo.index.write()
+        repo.checkout_tree(commit.tree, paths=list(sparse_paths))
+        branch = repo.branches.local.create(checkout_branch, commit)
+        branch.upstream = repo.branches.remote[f'origin/{checkout_branch}']
+        repo.set_head(branch.name)
+        # Save the sparse paths where git saves the patterns of a sparse checkout
+        repo.config['core.sparseCheckout'] = True
+        with open(os.path.join(repo.path, 'info', 'sparse-checkout'), 'w') as sparse_file:
+            sparse_file.writelines(f'{sparse_path}\n' for sparse_path in sparse_paths)
+        return repo
+
+    # Get the keyword arguments of a clone or fetch supported by the installed pygit2
+    @staticmethod
+    def __transfer_options(depth, callbacks):
+        """Get the keyword arguments of a clone or fetch supported by the installed pygit2, only passing the options that are used"""
+        options = {}
+        if depth:
+            options['depth'] = depth
+        if callbacks is not None:
+            options['callbacks'] = callbacks
+        return options
+
+    # Get the paths of the files checked out by a sparse checkout
+    def sparse_paths(self):
+        """Get the paths of the files checked out by a sparse checkout, or None if every file is checked out"""
+        if 'core.sparseCheckout' not in self.config or not self.config.get_bool('core.sparseCheckout'):
+            return None
+        try:
+            with open(os.path.join(self.path, 'info', 'sparse-checkout')) as sparse_file:
+                return [line.strip() for line in sparse_file if line.strip() and not line.startswith('#')]
+        except OSError:
+            return None
+
     # Git repository destructor
     def __del__(self):
         # Free the repository references
         self.free()
 
     # Fetch remote
-    def fetch(self, remote_name='origin'):
+    def fetch(self, remote_name='origin', callbacks=None):
         for remote in self.remotes:
             if remote.name == remote_name:
-                remote.fetch()
+                remote.fetch(callbacks=callbacks)
 
     # Fetch all remotes
-    def fetch_all(self):
+    def fetch_all(self, callbacks=None):
         for remote in self.remotes:
-            remote.fetch()
+            remote.fetch(callbacks=callbacks)
+
+    # Get the remote name and branch name tracked by the current branch
+    def upstream(self):
+        """Get the remote name and branch name tracked by the current branch, or None if no upstream branch is configured"""
+        if self.head_is_unborn or self.head_is_detached:
+            return None
+        branch = self.branches.local.get(self.head.shorthand)
+        upstream = branch.upstream if branch is not None else None
+        if upstream is None:
+            return None
+        return (upstream.remote_name, upstream.branch_name[len(upstream.remote_name) + 1:])
+
+    # Fetch only one branch of a remote
+    def fetch_branch(self, remote_name, branch, callbacks=None):
+        """Fetch only one branch of a remote, returning the fetched commit id or None if the branch does not exist"""
+        return self.fetch_reference(remote_name, f'refs/heads/{branch}', f'refs/remotes/{remote_name}/{branch}', callbacks)
+
+    # Fetch only one reference of a remote
+    def fetch_reference(self, remote_name, remote_ref, tracking_ref, callbacks=None):
+        """Fetch only one reference of a remote into a tracking reference, returning the fetched commit id or None if the reference does not exist"""
+        self.remotes[remote_name].fetch([f'+{remote_ref}:{tracking_ref}'], callbacks=callbacks)
+        reference = self.references.get(tracking_ref)
+        return reference.target if reference is not None else None
+
+    # Get the commit id of a remote tracking branch
+    def branch_commit(self, remote_name, branch):
+        """Get the commit id of a remote tracking branch, or None if the branch was never fetched"""
+        reference = self.references.get(f'refs/remotes/{remote_name}/{branch}')
+        return reference.target if reference is not None else None
+
+    # Read the content of a file in a commit without checking it out
+    def read_file(self, commit_id, path):
+        """Read the content of a file in a commit without checking it out, or None if the file does not exist"""
+        if commit_id is None:
+            return None
+        try:
+            return self[self[commit_id].tree[path].id].data
+        except (KeyError, AttributeError):
+            return None
+
+    # Commit files on top of a commit without checking it out
+    def commit_files(self, parent_id, files, message):
+        """Commit files on top of a commit without checking it out, or as a root commit if there is no parent, the files map paths to content or None to remove them"""
+        tree_id = self.__write_tree(self[parent_id].tree if parent_id is not None else None, files)
+        signature = self.__signature()
+        return self.create_commit(None, signature, signature, message, tree_id, [parent_id] if parent_id is not None else [])
+
+    # Push a commit to a remote branch
+    def push_commit(self, remote_name, commit_id, branch):
+        """Push a commit to a remote branch and update the remote tracking branch"""
+        self.push_reference(remote_name, commit_id, f'refs/heads/{branch}', f'refs/remotes/{remote_name}/{branch}')
+
+    # Push a commit to a remote reference
+    def push_reference(self, remote_name, commit_id, remote_ref, tracking_ref):
+        """Push a commit to a remote reference and update the tracking reference"""
+        local_ref = 'refs/meg/push/' + remote_ref[len('refs/'):]
+        self.references.create(local_ref, commit_id, force=True)
+        try:
+            self.remotes[remote_name].push([f'{local_ref}:{remote_ref}'])
+        finally:
+            self.references.delete(local_ref)
+        self.references.create(tracking_ref, commit_id, force=True)
+
+    # Get the signature of commits made by the runtime
+    def __signature(self):
+        """Get the signature of commits made by the runtime, the configured signature if there is one"""
+        try:
+            return self.default_signature
+        except (KeyError, GitError):
+            return Signature('MEG', 'meg@localhost')
+
+    # Write a tree with files replaced
+    def __write_tree(self, tree, files):
+        """Write a tree with files replaced, recursively writing the subtrees of the files"""
+        builder = self.TreeBuilder(tree) if tree is not None else self.TreeBuilder()
+        subtrees = {}
+        for path, content in files.items():
+            name, _, subpath = path.partition('/')
+            if subpath:
+                subtrees.setdefault(name, {})[subpath] = content
+            elif content is None:
+                if builder.get(name) is not None:
+                    builder.remove(name)
+            else:
+                builder.insert(name, self.create_blob(content), GIT_FILEMODE_BLOB)
+        for name, subtree_files in subtrees.items():
+            entry = builder.get(name)
+            subtree = self[entry.id] if entry is not None and entry.type_str == 'tree' else None
+            builder.insert(name, self.__write_tree(subtree, subtree_files), GIT_FILEMODE_TREE)
+        return builder.write()
+
+    # Pull the remote repository
+    def pull(self, remote_name=None, callbacks=None):
+        """Pull the tracked branch of a remote, fast-forwarding or merging in memory, and return the paths of the updated files, keeping the changed files of the runtime"""
+        upstream = self.upstream()
+        if upstream is None:
+            raise GitException('Pull requires a current branch and a remote')
+        remote_name = upstream[0] if remote_name is None else remote_name
+        branch = upstream[1]
+        remote_id = self.fetch_branch(remote_name, branch, callbacks)
+        if remote_id is None:
+            return []
+        analysis, _ = self.merge_analysis(remote_id)
+        if analysis & GIT_MERGE_ANALYSIS_UP_TO_DATE:
+            return []
+        head = self[self.head.target]
+        if analysis & GIT_MERGE_ANALYSIS_FASTFORWARD:
+            commit_id = remote_id
+        else:
+            # Merge without touching the working tree so a conflicting pull leaves it as it was
+            index = self.merge_commits(head, remote_id)
+            if index.conflicts is not None:
+                # The files of the runtime are rewritten by the runtime, so their conflicts are resolved with the remote version
+                for path in RUNTIME_PATHS:
+                    try:
+                        ancestor, ours, theirs = index.conflicts[path]
+                    except KeyError:
+                        continue
+                    del index.conflicts[path]
+                    if theirs is not None:
+                        index.add(theirs)
+            if index.conflicts is not None:
+                paths = sorted({next(entry for entry in conflict if entry is not None).path for conflict in index.conflicts})
+                raise GitException(f'Pull of {remote_name}/{branch} conflicts in {", ".join(paths)}')
+            signature = self.__signature()
+            commit_id = self.create_commit(None, signature, signature, f'Merge {remote_name}/{branch}',
+                                           index.write_tree(self), [head.id, remote_id])
+        # Checkout against the current head only writes the files whose blobs changed
+        tree = self[commit_id].tree
+        deltas = list(head.tree.diff_to_tree(tree).deltas)
+        sparse_paths = self.sparse_paths()
+        # Reset the changed files of the runtime so the checkout does not conflict with them, then restore them
+        kept = self.__reset_runtime_files(head.tree, deltas)
+        try:
+            if sparse_paths is None:
+                self.checkout_tree(tree)
+            else:
+                removed = [delta for delta in deltas if delta.status == GIT_DELTA_DELETED and os.path.lexists(os.path.join(self.workdir, delta.old_file.path))]
+                self.checkout_tree(tree, paths=sparse_paths)
+                # Track the changes to the files outside of the sparse paths which were not checked out
+                for delta in deltas:
+                    if delta.status == GIT_DELTA_DELETED:
+                        if delta.old_file.path in self.index:
+                            self.index.remove(delta.old_file.path)
+                    elif not os.path.lexists(os.path.join(self.workdir, delta.new_file.path)):
+                        self.index.add(IndexEntry(delta.new_file.path, delta.new_file.id, delta.new_file.mode))
+                self.index.write()
+                deltas = removed + [delta for delta in deltas if delta.status != GIT_DELTA_DELETED and os.path.lexists(os.path.join(self.workdir, delta.new_file.path))]
+        finally:
+            for path, content in kept.items():
+                os.makedirs(os.path.dirname(os.path.join(self.workdir, path)), exist_ok=True)
+                with open(os.path.join(self.workdir, path), 'wb') as runtime_file:
+                    runtime_file.write(content)
+        self.head.set_target(commit_id)
+        return [delta.new_file.path for delta in deltas if delta.new_file.path not in kept]
 
-    # TODO: Pull the remote repository
-    def pull(self, remote_name='origin'):
-        pass
+    # Reset the changed files of the runtime that are changed by a checkout
+    def __reset_runtime_files(self, tree, deltas):
+        """Reset the files of the runtime that differ from a tree and are changed by a checkout from the tree, returning their content"""
+        kept = {}
+        changed = {delta.new_file.path for delta in deltas} | {delta.old_file.path for delta in deltas}
+        for path in RUNTIME_PATHS:
+            file_path = os.path.join(self.workdir, path)
+            if path not in changed or not os.path.isfile(file_path):
+                continue
+            with open(file_path, 'rb') as runtime_file:
+                content = runtime_file.read()
+            try:
+                original = self[tree[path].id].data
+            except KeyError:
+                original = None
+            if content == original:
+                continue
+            kept[path] = content
+            if original is None:
+                os.remove(file_path)
+            else:
+                with open(file_path, 'wb') as runtime_file:
+                    runtime_file.write(original)
+        return kept
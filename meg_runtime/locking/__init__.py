@@ -1,3 +1,12 @@
 """Multimedia Extensible Git File Locking"""
 
+import socketserver
+
 from meg_runtime.locking.manager import LockingManager
+
+__all__ = ['LockingManager']
+
+# The lock daemon requires Unix domain sockets, which are not available on Windows
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    from meg_runtime.locking.daemon import LockDaemon, LockClient
+    __all__ += ['LockDaemon', 'LockClient']
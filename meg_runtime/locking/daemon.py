@@ -0,0 +1,436 @@
+"""MEG system lock query daemon
+
+Owns the lock state of a repository and serves locking operations to other local processes over a Unix domain socket
+Publishes a read-only snapshot of the locks in shared memory, so readers can find locks without any requests or parsing
+The socket and snapshot are in a runtime directory private to the user, so other users cannot read or replace them
+Run in the repository directory with `python -m meg_runtime.locking.daemon`
+
+All file paths are relitive to the repository directory
+Working directory should be changed by the git module
+"""
+
+import os
+import json
+import math
+import mmap
+import stat
+import zlib
+import socket
+import struct
+import hashlib
+import tempfile
+import functools
+import threading
+import socketserver
+from meg_runtime.locking.manager import LockingManager
+from meg_runtime.config import Config
+from meg_runtime.logger import Logger
+
+
+class LockSnapshot:
+    """Read-only snapshot of the locks published by the lock daemon
+    The snapshot is a header, a hash table of the offsets of the lock records, and the lock records:
+        header: magic, format version, generation, number of locks, number of hash table slots, process id of the daemon
+        hash table: offsets of the lock records, by CRC-32 of their path with linear probing, 0 if empty
+        lock record: path length, user length, date, expiry time (NaN if never), path, user
+    """
+    MAGIC = b"MEGL"
+    FORMAT = 2
+    HEADER = struct.Struct("<4sIQQQQ")
+    OFFSET = struct.Struct("<Q")
+    RECORD = struct.Struct("<IIdd")
+
+    def __init__(self, filepath):
+        """Open a published snapshot, which is mapped when it is first read
+        Args:
+            filepath (string): path to the snapshot
+        """
+        self._filepath = filepath
+        self._map = None
+        self._status = None
+        self._count = 0
+        self._slots = 0
+        self._pid = None
+        self.generation = None
+
+    def available(self):
+        """Check if a snapshot is published by a running daemon, mapping the latest published snapshot
+        Returns:
+            (bool): a snapshot is published and the daemon that published it is running
+        """
+        if self._filepath is None:
+            return False
+        try:
+            status = os.stat(self._filepath)
+        except OSError:
+            self.close()
+            return False
+        status = (status.st_ino, status.st_mtime_ns, status.st_size)
+        if status != self._status:
+            # Snapshots are replaced and never changed in place, so a mapped snapshot stays consistent
+            self.close()
+            try:
+                with open(self._filepath, 'rb') as snapshotFile:
+                    snapshotMap = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return False
+            if len(snapshotMap) < self.HEADER.size:
+                snapshotMap.close()
+                return False
+            magic, version, generation, count, slots, pid = self.HEADER.unpack_from(snapshotMap)
+            if magic != self.MAGIC or version != self.FORMAT:
+                snapshotMap.close()
+                return False
+            self._map = snapshotMap
+            self._status = status
+            self._count = count
+            self._slots = slots
+            self._pid = pid
+            self.generation = generation
+        # A daemon that crashed leaves its last snapshot, which is no longer updated
+        return LockSnapshot._running(self._pid)
+
+    @staticmethod
+    def _running(pid):
+        """Check if a process of the current user is running"""
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def findLock(self, filepath):
+        """Find the lock entry of a file in the hash table of the snapshot
+        Args:
+            filepath (string): path of file that may be locked
+        Returns:
+            (dictionary): lockfile entry for the file, None if the file is not locked or there is no snapshot
+        """
+        if not self.available():
+            return None
+        key = filepath.encode("utf-8")
+        slot = zlib.crc32(key) % self._slots
+        while True:
+            offset = self.OFFSET.unpack_from(self._map, self.HEADER.size + slot * self.OFFSET.size)[0]
+            if offset == 0:
+                return None
+            pathLength, userLength, date, expires = self.RECORD.unpack_from(self._map, offset)
+            pathOffset = offset + self.RECORD.size
+            if self._map[pathOffset:pathOffset + pathLength] == key:
+                entry = {"user": self._map[pathOffset + pathLength:pathOffset + pathLength + userLength].decode("utf-8"), "date": date}
+                if not math.isnan(expires):
+                    entry["expires"] = expires
+                return entry
+            slot = (slot + 1) % self._slots
+
+    def __len__(self):
+        return self._count if self.available() else 0
+
+    def close(self):
+        """Unmap the snapshot"""
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._status = None
+        self._count = 0
+
+    @staticmethod
+    def write(filepath, lockFile, generation):
+        """Publish a snapshot of the locks of a lockfile, replacing the previous snapshot
+        Args:
+            filepath (string): path to the snapshot
+            lockFile (LockFile): lockfile to publish
+            generation (int): number of the snapshot
+        """
+        records = []
+        # Keep the hash table at most half full so lookups probe few slots
+        slots = [0] * max(2 * len(lockFile), 8)
+        offset = LockSnapshot.HEADER.size + LockSnapshot.OFFSET.size * len(slots)
+        for path, entry in lockFile._lockData.items():
+            encodedPath = path.encode("utf-8")
+            encodedUser = str(entry.get("user")).encode("utf-8")
+            expires = entry.get("expires")
+            record = LockSnapshot.RECORD.pack(len(encodedPath), len(encodedUser), entry.get("date", 0),
+                                              math.nan if expires is None else expires) + encodedPath + encodedUser
+            slot = zlib.crc32(encodedPath) % len(slots)
+            while slots[slot] != 0:
+                slot = (slot + 1) % len(slots)
+            slots[slot] = offset
+            offset += len(record)
+            records.append(record)
+        content = LockSnapshot.HEADER.pack(LockSnapshot.MAGIC, LockSnapshot.FORMAT, generation, len(records), len(slots),
+                                           os.getpid()) + \
+            struct.pack("<{0}Q".format(len(slots)), *slots) + b"".join(records)
+        tempFilepath = filepath + ".tmp"
+        with open(tempFilepath, 'wb') as snapshotFile:
+            snapshotFile.write(content)
+        os.replace(tempFilepath, filepath)
+
+
+class LockDaemon:
+    """Owns the lock state of the repository in the working directory and serves locking operations to local processes
+    Only one daemon can serve a repository
+    """
+    OPERATIONS = {"addLock", "removeLock", "addLocks", "removeLocks", "renewLock", "renewLocks", "updateLocks",
+                  "findLock", "findPrefixLocks", "findDescendantLocks", "hasDescendantLock", "findAncestorLock", "findUserLocks"}
+    DEFAULT_SYNC_INTERVAL = 5
+
+    def __init__(self, interval=None):
+        """
+        Args:
+            interval (float): seconds between syncs of the locks, the configured locking/daemon_interval if None
+        """
+        self._interval = interval if interval is not None else Config.get('locking/daemon_interval', LockDaemon.DEFAULT_SYNC_INTERVAL)
+        self._socketPath = LockDaemon.socketPath()
+        self._snapshotPath = LockDaemon.snapshotPath()
+        self._server = None
+        self._stop = threading.Event()
+        self._generation = 0
+        self._published = None
+
+    @staticmethod
+    def socketPath(repoPath=None):
+        """Get the path of the socket of the daemon of a repository
+        Args:
+            repoPath (string): path to the repository, the working directory if None
+        Returns:
+            (string): path to the socket, None if there is no runtime directory private to the user
+        """
+        directory = LockDaemon.runtimeDirectory()
+        return os.path.join(directory, LockDaemon._name(repoPath) + ".sock") if directory is not None else None
+
+    @staticmethod
+    def snapshotPath(repoPath=None):
+        """Get the path of the published snapshot of the daemon of a repository
+        Args:
+            repoPath (string): path to the repository, the working directory if None
+        Returns:
+            (string): path to the snapshot, None if there is no runtime directory private to the user
+        """
+        directory = LockDaemon.runtimeDirectory()
+        return os.path.join(directory, LockDaemon._name(repoPath) + ".snapshot") if directory is not None else None
+
+    @staticmethod
+    def runtimeDirectory():
+        """Get the runtime directory of the daemons of the user, in XDG_RUNTIME_DIR if set, created only accessible by the user
+        Returns:
+            (string): path to the directory, None if the directory is not a directory only accessible by the user
+        """
+        if not hasattr(os, "getuid"):
+            return None
+        base = os.environ.get("XDG_RUNTIME_DIR")
+        if base and os.path.isdir(base):
+            directory = os.path.join(base, "meg-locks")
+        else:
+            directory = os.path.join(tempfile.gettempdir(), "meg-locks-{0}".format(os.getuid()))
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            Logger.warning("MEG Locking: Unable to create lock daemon directory {0}: {1}".format(directory, e))
+            return None
+        # Another user may have created the directory first to read or replace the sockets and snapshots
+        status = os.lstat(directory)
+        if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+            Logger.warning("MEG Locking: Lock daemon directory {0} is not private to the user".format(directory))
+            return None
+        return directory
+
+    @staticmethod
+    def _name(repoPath):
+        """Get the name of the daemon of a repository"""
+        repoPath = os.path.realpath(repoPath if repoPath is not None else os.getcwd())
+        return "meg-locks-" + hashlib.sha1(repoPath.encode("utf-8")).hexdigest()[:16]
+
+    def start(self):
+        """Start serving locking operations and publishing snapshots in background threads
+        Returns:
+            (bool): False if the daemon cannot be started, another daemon may already serve the repository
+        """
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+            Logger.warning("MEG Locking: Lock daemon requires Unix domain sockets")
+            return False
+        if self._socketPath is None:
+            return False
+        if os.path.exists(self._socketPath):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self._socketPath)
+                Logger.warning("MEG Locking: Lock daemon is already running at {0}".format(self._socketPath))
+                return False
+            except OSError:
+                # Remove the socket left by a daemon that is no longer running
+                os.remove(self._socketPath)
+        LockingManager.updateLocks()
+        self._publish()
+        self._stop.clear()
+        self._server = socketserver.ThreadingUnixStreamServer(self._socketPath, _LockRequestHandler)
+        self._server.daemon_threads = True
+        self._server.lockDaemon = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._sync, daemon=True).start()
+        return True
+
+    def stop(self):
+        """Stop serving and remove the socket and snapshot"""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for path in [self._socketPath, self._snapshotPath]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def serveForever(self):
+        """Serve locking operations until interrupted"""
+        if self.start():
+            try:
+                self._stop.wait()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.stop()
+
+    def handle(self, request):
+        """Run a locking operation and publish the changed locks before responding
+        Args:
+            request (dictionary): name of the operation and list of its arguments
+        Returns:
+            (dictionary): result of the operation, or an error
+        """
+        operation = request.get("operation")
+        if operation not in LockDaemon.OPERATIONS:
+            return {"error": "Unknown locking operation {0}".format(operation)}
+        try:
+            result = getattr(LockingManager, operation)(*request.get("args", []))
+        except Exception as e:
+            Logger.warning("MEG Locking: Lock daemon operation {0} failed: {1}".format(operation, e))
+            return {"error": str(e)}
+        self._publish()
+        return {"result": result}
+
+    def _publish(self):
+        """Publish a snapshot of the locks if they changed since the last published snapshot"""
+        with LockingManager._mutex:
+            lockFile = LockingManager.locks()
+            if self._published == (id(lockFile), lockFile._version):
+                return
+            self._generation += 1
+            LockSnapshot.write(self._snapshotPath, lockFile, self._generation)
+            self._published = (id(lockFile), lockFile._version)
+
+    def _sync(self):
+        """Periodically sync the locks, removing expired locks, and publish the changes"""
+        while not self._stop.wait(self._interval):
+            try:
+                LockingManager.updateLocks()
+                self._publish()
+            except Exception as e:
+                Logger.warning("MEG Locking: Lock daemon sync failed: {0}".format(e))
+
+
+class _LockRequestHandler(socketserver.StreamRequestHandler):
+    """Handle the requests of a client connection, one JSON request per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.lockDaemon.handle(json.loads(line))
+            except (json.decoder.JSONDecodeError, AttributeError):
+                response = {"error": "Invalid request"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class LockClient:
+    """Locking operations of a process served by the lock daemon of a repository
+    Finds locks in the published snapshot without any requests, other operations are requests to the daemon
+    Operations are run by the LockingManager of this process if the daemon is not running
+    """
+
+    def __init__(self, repoPath=None):
+        """
+        Args:
+            repoPath (string): path to the repository, the working directory if None
+        """
+        self._socketPath = LockDaemon.socketPath(repoPath)
+        self._snapshot = LockSnapshot(LockDaemon.snapshotPath(repoPath))
+        self._connection = None
+        self._mutex = threading.Lock()
+
+    def findLock(self, filepath):
+        """Find the lock of a file in the published snapshot, or by the daemon or this process if the daemon is not running
+        Args:
+            filepath (string): path of file that may be locked
+        Returns:
+            (dictionary): lockfile entry for the file, None if the file is not locked
+        """
+        if self._snapshot.available():
+            return self._snapshot.findLock(filepath)
+        return self.request("findLock", filepath)
+
+    def request(self, operation, *args):
+        """Run a locking operation by the daemon, or by this process if the daemon is not running
+        Once a request is sent the daemon may have run it, so a failure after sending is not run again by this process
+        Args:
+            operation (string): name of the LockingManager operation
+            args: arguments of the operation
+        Returns:
+            result of the operation, None if the daemon failed to run it or did not respond
+        """
+        with self._mutex:
+            while True:
+                reused = self._connection is not None
+                if not reused:
+                    try:
+                        if self._socketPath is None:
+                            raise OSError("No lock daemon directory")
+                        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        try:
+                            connection.connect(self._socketPath)
+                        except OSError:
+                            connection.close()
+                            raise
+                        self._connection = (connection, connection.makefile('rwb'))
+                    except OSError:
+                        return getattr(LockingManager, operation)(*args)
+                stream = self._connection[1]
+                try:
+                    stream.write(json.dumps({"operation": operation, "args": list(args)}).encode("utf-8") + b"\n")
+                    stream.flush()
+                except OSError as e:
+                    self.close()
+                    # A daemon that stopped since the connection was last used never received the request, so it is sent again
+                    if reused:
+                        continue
+                    Logger.warning("MEG Locking: Unable to send lock daemon operation {0}: {1}".format(operation, e))
+                    return None
+                try:
+                    response = json.loads(stream.readline())
+                except (OSError, ValueError) as e:
+                    self.close()
+                    Logger.warning("MEG Locking: No response from lock daemon for operation {0}: {1}".format(operation, e))
+                    return None
+                break
+        if "error" in response:
+            Logger.warning("MEG Locking: Lock daemon operation {0} failed: {1}".format(operation, response["error"]))
+            return None
+        return response["result"]
+
+    def close(self):
+        """Close the connection to the daemon and unmap the snapshot"""
+        if self._connection is not None:
+            self._connection[1].close()
+            self._connection[0].close()
+            self._connection = None
+        self._snapshot.close()
+
+    def __getattr__(self, name):
+        if name in LockDaemon.OPERATIONS:
+            return functools.partial(self.request, name)
+        raise AttributeError(name)
+
+
+if __name__ == '__main__':
+    LockDaemon().serveForever()
@@ -6,11 +6,20 @@ Does not check permissions before actions are taken
 
 All file paths are relitive to the repository directory
 Working directory should be changed by the git module
+
+A lockfile can optionally be journaled, then every lock and unlock is appended as a record
+to a journal file next to the lockfile instead of rewriting the whole lockfile. The journal
+is replayed on load and compacted into the lockfile when it grows larger than the locks
+
+Locks can be leases that expire after a time to live, expired locks are removed when reaped
 """
 
 import json
 import os.path
 import time
+import heapq
+import bisect
+import hashlib
 from meg_runtime.logger import Logger
 from collections.abc import MutableMapping
 
@@ -18,13 +27,26 @@ from collections.abc import MutableMapping
 class LockFile(MutableMapping):
     """Parse a lockfile and preform locking operations
     """
+    JOURNAL_SUFFIX = ".journal"
+    JOURNAL_COMPACT_RECORDS = 1000
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, journal=False):
         """Open a lockfile and initalize class with it
         Args:
             filepath (string): path to the lockfile
+            journal (bool): append changes to a journal instead of rewriting the lockfile on every save
         """
         self._lockData = {}
+        self._paths = []
+        self._userPaths = {}
+        self._expiry = []
+        self._version = 0
+        self._dirty = False
+        self._fileState = None
+        self._journal = journal
+        self._journalChanges = []
+        self._journalState = None
+        self._journalRecords = 0
         self.load(filepath)
 
     def __getitem__(self, filepath):
@@ -45,7 +67,72 @@ class LockFile(MutableMapping):
             filepath (string): path of file to add lock to
             username (string): name of locking user
         """
-        self._lockData[filepath] = {"user": username, "date": time.time()}
+        self.lock(filepath, username)
+
+    def lock(self, filepath, username, ttl=None):
+        """Add or change a lock file entry, which expires after a time to live if given
+        Args:
+            filepath (string): path of file to add lock to
+            username (string): name of locking user
+            ttl (float): seconds until the lock expires, never if None
+        """
+        entry = {"user": username, "date": time.time()}
+        if ttl is not None:
+            entry["expires"] = entry["date"] + ttl
+        self._setEntry(filepath, entry)
+
+    def renew(self, filepath, ttl):
+        """Renew the lease of a lock for another time to live from now
+        Args:
+            filepath (string): path of the locked file
+            ttl (float): seconds until the lock expires, never if None
+        Returns:
+            (bool): False if the file is not locked
+        """
+        entry = self._lockData.get(filepath)
+        if entry is None:
+            return False
+        entry = dict(entry)
+        entry.pop("expires", None)
+        if ttl is not None:
+            entry["expires"] = time.time() + ttl
+        self._setEntry(filepath, entry)
+        return True
+
+    def expired(self, filepath, now=None):
+        """Check if the lock of a file expired
+        Args:
+            filepath (string): path of the locked file
+            now (float): time to check expiry at, the current time if None
+        Returns:
+            (bool): the file is locked and its lock expired
+        """
+        expires = self._lockData.get(filepath, {}).get("expires")
+        return expires is not None and expires <= (time.time() if now is None else now)
+
+    def nextExpiry(self):
+        """Get the next lock to expire
+        Returns:
+            (tuple): expiry time and path of the next lock to expire, None if no lock expires
+        """
+        self._discardStaleExpiry()
+        return self._expiry[0] if self._expiry else None
+
+    def reapExpired(self, now=None, limit=None):
+        """Remove expired locks in expiry order
+        Args:
+            now (float): time to check expiry at, the current time if None
+            limit (int): maximum number of locks to remove, all expired locks if None
+        Returns:
+            (list): paths of the removed locks
+        """
+        now = time.time() if now is None else now
+        reaped = []
+        while (limit is None or len(reaped) < limit) and self.nextExpiry() is not None and self._expiry[0][0] <= now:
+            filepath = heapq.heappop(self._expiry)[1]
+            del self[filepath]
+            reaped.append(filepath)
+        return reaped
 
     def __delitem__(self, filepath):
         """Delete lockfile entry
@@ -53,7 +140,11 @@ class LockFile(MutableMapping):
             filepath (string): path of file to add lock to
         """
         if filepath in self._lockData:
+            self._unindex(filepath)
             del self._lockData[filepath]
+            self._dirty = True
+            if self._journal:
+                self._journalChanges.append(["unlock", filepath])
 
     def __iter__(self):
         return iter(self._lockData)
@@ -64,44 +155,438 @@ class LockFile(MutableMapping):
     def __len__(self):
         return len(self._lockData)
 
+    def prefixLocks(self, prefix):
+        """Get the entries of all locked paths starting with a prefix, in path order
+        Args:
+            prefix (string): start of the paths, such as a directory followed by a separator
+        Returns:
+            (dictionary): lockfile entries by path
+        """
+        start = bisect.bisect_left(self._paths, prefix)
+        # The paths starting with the prefix are sorted after the prefix and before the prefix followed by the highest character
+        end = bisect.bisect_left(self._paths, prefix + chr(0x10ffff), start)
+        return {path: self._lockData[path] for path in self._paths[start:end]}
+
+    def descendantLocks(self, dirpath):
+        """Get the entries of all locked paths inside a directory, in path order
+        Args:
+            dirpath (string): path of the directory
+        Returns:
+            (dictionary): lockfile entries by path
+        """
+        return self.prefixLocks(dirpath.rstrip("/") + "/")
+
+    def hasDescendantLock(self, dirpath):
+        """Check if any path inside a directory is locked
+        Args:
+            dirpath (string): path of the directory
+        Returns:
+            (bool): is any path inside the directory locked
+        """
+        prefix = dirpath.rstrip("/") + "/"
+        index = bisect.bisect_left(self._paths, prefix)
+        return index < len(self._paths) and self._paths[index].startswith(prefix)
+
+    def ancestorLock(self, filepath):
+        """Find the closest locked directory containing a path
+        Args:
+            filepath (string): path of file that may be inside a locked directory
+        Returns:
+            (tuple): path of the locked directory and its lockfile entry
+            (None): no directory containing the path is locked
+        """
+        dirpath = filepath.rstrip("/")
+        while "/" in dirpath:
+            dirpath = dirpath.rsplit("/", 1)[0]
+            if dirpath in self._lockData:
+                return (dirpath, self._lockData[dirpath])
+        return None
+
+    def _setEntry(self, filepath, entry):
+        """Set a lock file entry, updating the indexes and journal"""
+        self._unindex(filepath)
+        self._lockData[filepath] = entry
+        self._index(filepath)
+        self._dirty = True
+        if self._journal:
+            self._journalChanges.append(self._entryRecord(filepath, entry))
+
+    def userLocks(self, username):
+        """Get the paths locked by a user
+        Args:
+            username (string): name of locking user
+        Returns:
+            (list): locked paths, in path order
+        """
+        return sorted(self._userPaths.get(username, ()))
+
     def save(self):
         """Saves current data into the lockfile, overriding its contents
         Must be ran to save any new or removed locks
         Will create file if it doesn't already exist
+        Does not write the file if there are no changes, reloading it instead if it was changed by someone else
+        A journaled lockfile appends only the changes to the journal, unless the lockfile or journal were changed by someone else
         """
-        fileData = {
-                    "comment": "MEG System locking file, do not manually editing",
-                    "locks": self._lockData
-                }
-        json.dump(fileData, open(self._filepath, 'w'))
+        if not self._dirty and self._fileStatus(self._filepath) is not None:
+            # Writing unchanged locks would overwrite the locks saved by someone else since the lockfile was read
+            self.load()
+            return
+        if self._journal and self._fileState is not None and self._fileState[0] == self._fileStatus(self._filepath) and \
+                self._journalUnchanged():
+            self._appendJournal()
+            if self._journalRecords > max(self.JOURNAL_COMPACT_RECORDS, len(self._lockData)):
+                self.compact()
+            return
+        content = self.serialize(self._lockData)
+        # Replace the file with a completely written file so every change is saved at once
+        tempFilepath = self._filepath + ".tmp"
+        with open(tempFilepath, 'wb') as lockFile:
+            lockFile.write(content)
+            if self._journal:
+                # The journal is emptied after the lockfile is replaced, so the lockfile must be on disk first
+                lockFile.flush()
+                os.fsync(lockFile.fileno())
+        os.replace(tempFilepath, self._filepath)
+        self._dirty = False
+        self._fileState = (self._fileStatus(self._filepath), hashlib.sha256(content).digest())
+        if self._journal:
+            self._syncDirectory()
+            self._truncateJournal()
+
+    def store(self, content, journalContent=None):
+        """Replace the lockfile and its journal with synchronized contents and load them
+        Args:
+            content (bytes): serialized lockfile
+            journalContent (bytes): journal records, the journal is removed if None
+        """
+        self._replaceFile(self._filepath, content)
+        if journalContent is not None:
+            self._replaceFile(self._journalPath(), journalContent)
+        elif os.path.exists(self._journalPath()):
+            os.remove(self._journalPath())
+        self._fileState = None
+        self.load(self._filepath)
+
+    def compact(self):
+        """Write all locks into the lockfile and empty the journal
+        Replaying the journal over the lockfile gives the same locks at every point of the compaction,
+        so a crash during compaction does not lose or revive any locks
+        """
+        self._dirty = True
+        self._fileState = None
+        self.save()
 
     def load(self, filepath=None):
         """Loads this object with the current data in the lockfile, overrideing its current data
         If the file doesn't exist, create one
+        Reloading the same lockfile does not read or parse the file if it was not changed since it was last read or written
+        A journaled lockfile is replayed from its journal after reading the lockfile
         Args:
             filepath (string): path to the lockfile
         Returns:
             (bool): False if lockfile cannot be read
         """
-        self._lockData = {}
         if(filepath is None):
             filepath = self._filepath
+            if self._reloadUnchanged(filepath):
+                return True
         else:
             self._filepath = filepath
             if(not os.path.exists(filepath)):
+                self._lockData = {}
                 self._createLockFile(filepath)
+        self._lockData = {}
+        self._dirty = False
+        self._journalChanges = []
         try:
-            self._lockData = json.load(open(filepath))["locks"]
+            self._lockData = self._read(filepath)["locks"]
         except (json.decoder.JSONDecodeError, KeyError):
             self._createLockFile(filepath)
             try:
-                self._lockData = json.load(open(filepath))["locks"]
+                self._lockData = self._read(filepath)["locks"]
             except (json.decoder.JSONDecodeError, KeyError):
                 Logger.warning("MEG Locking: Unable to read contents of lock file at {0}".format(self._filepath))
+                self._reindex()
                 return False
+        if self._journal:
+            self._journalState = None
+            self._journalRecords = 0
+            self._replayJournal(False)
+        self._reindex()
         return True
 
+    @staticmethod
+    def serialize(lockData):
+        """Serialize lock entries into the lockfile format
+        Args:
+            lockData (dictionary): lock entries by path
+        Returns:
+            (bytes): lockfile contents
+        """
+        fileData = {
+                    "comment": "MEG System locking file, do not manually editing",
+                    "locks": lockData
+                }
+        return json.dumps(fileData).encode("utf-8")
+
+    @staticmethod
+    def parse(content, journalContent=None):
+        """Parse lockfile contents and replay journal records over them
+        Args:
+            content (bytes): lockfile contents, no locks if None
+            journalContent (bytes): journal records, if any
+        Returns:
+            (dictionary): lock entries by path, None if the lockfile contents cannot be read
+        """
+        lockData = {}
+        if content is not None:
+            try:
+                lockData = json.loads(content)["locks"]
+            except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                return None
+        if journalContent:
+            for record in LockFile._records(journalContent[:journalContent.rfind(b"\n") + 1]):
+                if record[0] == "lock":
+                    lockData[record[1]] = LockFile._recordEntry(record)
+                elif record[0] == "unlock":
+                    lockData.pop(record[1], None)
+        return lockData
+
+    @staticmethod
+    def journalRecords(lockData, newLockData):
+        """Get the journal records that change lock entries into new lock entries
+        Args:
+            lockData (dictionary): lock entries by path
+            newLockData (dictionary): changed lock entries by path
+        Returns:
+            (bytes): journal records
+        """
+        records = [LockFile._entryRecord(filepath, entry) for filepath, entry in newLockData.items() if lockData.get(filepath) != entry]
+        records.extend(["unlock", filepath] for filepath in lockData if filepath not in newLockData)
+        return "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+
+    @staticmethod
+    def merge(base, local, remote):
+        """Three-way merge of lock entries changed locally and remotely since they were last synchronized
+        A path changed both locally and remotely keeps the remote entry, the remote lock was taken first
+        Args:
+            base (dictionary): lock entries by path when last synchronized
+            local (dictionary): local lock entries by path
+            remote (dictionary): remote lock entries by path
+        Returns:
+            (dictionary): merged lock entries by path
+        """
+        merged = dict(remote)
+        for filepath in set(base).union(local):
+            entry = local.get(filepath)
+            if entry == base.get(filepath) or remote.get(filepath) != base.get(filepath):
+                continue
+            if entry is None:
+                merged.pop(filepath, None)
+            else:
+                merged[filepath] = entry
+        return merged
+
+    def _index(self, filepath):
+        """Add a locked path to the sorted path index and the user index"""
+        self._version += 1
+        bisect.insort(self._paths, filepath)
+        self._userPaths.setdefault(self._lockData[filepath].get("user"), set()).add(filepath)
+        if self._lockData[filepath].get("expires") is not None:
+            heapq.heappush(self._expiry, (self._lockData[filepath]["expires"], filepath))
+            # Removed and renewed locks are left in the expiry index until they would expire, unless there are too many
+            if len(self._expiry) > 2 * len(self._lockData) + 64:
+                self._reindexExpiry()
+
+    def _unindex(self, filepath):
+        """Remove a locked path from the sorted path index and the user index"""
+        if filepath in self._lockData:
+            self._version += 1
+            del self._paths[bisect.bisect_left(self._paths, filepath)]
+            userPaths = self._userPaths.get(self._lockData[filepath].get("user"))
+            userPaths.discard(filepath)
+            if not userPaths:
+                del self._userPaths[self._lockData[filepath].get("user")]
+
+    def _reindex(self):
+        """Rebuild the sorted path index and the user index from the lock data"""
+        self._version += 1
+        self._paths = sorted(self._lockData)
+        self._userPaths = {}
+        for filepath, entry in self._lockData.items():
+            self._userPaths.setdefault(entry.get("user"), set()).add(filepath)
+        self._reindexExpiry()
+
+    def _reindexExpiry(self):
+        """Rebuild the expiry index from the lock data"""
+        self._expiry = [(entry["expires"], filepath) for filepath, entry in self._lockData.items() if entry.get("expires") is not None]
+        heapq.heapify(self._expiry)
+
+    def _discardStaleExpiry(self):
+        """Remove expiry index entries of removed or renewed locks from the top of the expiry index"""
+        while self._expiry:
+            expires, filepath = self._expiry[0]
+            entry = self._lockData.get(filepath)
+            if entry is not None and entry.get("expires") == expires:
+                return
+            heapq.heappop(self._expiry)
+
+    def _journalPath(self):
+        """Get the path of the journal of the lockfile"""
+        return self._filepath + self.JOURNAL_SUFFIX
+
+    def _journalUnchanged(self):
+        """Check if the journal was not changed since it was last read or written"""
+        status = self._fileStatus(self._journalPath())
+        if status is None:
+            return self._journalState is None
+        return self._journalState is not None and status[1:] == self._journalState
+
+    def _appendJournal(self):
+        """Append the changes to the journal and wait until they are on disk"""
+        if self._journalChanges:
+            content = "".join(json.dumps(record) + "\n" for record in self._journalChanges).encode("utf-8")
+            with open(self._journalPath(), 'ab') as journalFile:
+                journalFile.write(content)
+                journalFile.flush()
+                os.fsync(journalFile.fileno())
+                status = self._fileStatus(journalFile.fileno())
+            self._journalRecords += len(self._journalChanges)
+            self._journalState = status[1:]
+        self._journalChanges = []
+        self._dirty = False
+
+    def _truncateJournal(self):
+        """Empty the journal after its records were written into the lockfile"""
+        if self._fileStatus(self._journalPath()) is not None:
+            with open(self._journalPath(), 'r+b') as journalFile:
+                journalFile.truncate()
+                os.fsync(journalFile.fileno())
+        self._journalChanges = []
+        self._journalRecords = 0
+        self._journalState = None
+        status = self._fileStatus(self._journalPath())
+        if status is not None:
+            self._journalState = status[1:]
+
+    def _replayJournal(self, index):
+        """Apply the journal records that were not yet read, ignoring a partially written last record
+        Args:
+            index (bool): maintain the path and user indexes while applying records
+        """
+        offset = 0 if self._journalState is None else self._journalState[0]
+        try:
+            with open(self._journalPath(), 'rb') as journalFile:
+                journalFile.seek(offset)
+                content = journalFile.read()
+                inode = self._fileStatus(journalFile.fileno())[2]
+        except OSError:
+            return
+        end = content.rfind(b"\n") + 1
+        for record in self._records(content[:end]):
+            if index:
+                self._unindex(record[1])
+            if record[0] == "lock":
+                self._lockData[record[1]] = self._recordEntry(record)
+                if index:
+                    self._index(record[1])
+            elif record[0] == "unlock":
+                self._lockData.pop(record[1], None)
+            self._journalRecords += 1
+        self._journalState = (offset + end, inode)
+
+    @staticmethod
+    def _records(content):
+        """Parse the complete journal records in journal contents, ignoring unreadable records"""
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                Logger.warning("MEG Locking: Ignoring unreadable record in lock file journal")
+                continue
+            yield record
+
+    @staticmethod
+    def _entryRecord(filepath, entry):
+        """Get the journal record of a lock file entry"""
+        record = ["lock", filepath, entry.get("user"), entry.get("date")]
+        if entry.get("expires") is not None:
+            record.append(entry["expires"])
+        return record
+
+    @staticmethod
+    def _recordEntry(record):
+        """Get the lock file entry of a journal lock record"""
+        entry = {"user": record[2], "date": record[3]}
+        if len(record) > 4:
+            entry["expires"] = record[4]
+        return entry
+
+    @staticmethod
+    def _replaceFile(filepath, content):
+        """Replace a file with a completely written file"""
+        tempFilepath = filepath + ".tmp"
+        with open(tempFilepath, 'wb') as tempFile:
+            tempFile.write(content)
+        os.replace(tempFilepath, filepath)
+
+    def _syncDirectory(self):
+        """Wait until the replaced lockfile is on disk"""
+        try:
+            directory = os.open(os.path.dirname(os.path.abspath(self._filepath)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
+
     def _createLockFile(self, filepath):
         self._locks = {}
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._dirty = True
         self.save()
+
+    def _read(self, filepath):
+        """Read and parse the lockfile, remembering the file state to detect changes"""
+        with open(filepath, 'rb') as lockFile:
+            content = lockFile.read()
+            self._fileState = (self._fileStatus(lockFile.fileno()), hashlib.sha256(content).digest())
+        return json.loads(content)
+
+    def _reloadUnchanged(self, filepath):
+        """Check if the lockfile does not need reloading because it is unchanged since last read or written
+        Returns:
+            (bool): the lockfile is unchanged
+        """
+        if self._dirty or self._fileState is None:
+            return False
+        if self._journal and not self._journalUnchanged():
+            # Only records appended to the same journal can be replayed without reading the lockfile
+            status = self._fileStatus(self._journalPath())
+            if status is None or self._journalState is None or status[2] != self._journalState[1] or \
+                    status[1] < self._journalState[0] or self._fileStatus(filepath) != self._fileState[0]:
+                return False
+            self._replayJournal(True)
+            return True
+        status = self._fileStatus(filepath)
+        if status is None or status == self._fileState[0]:
+            return status is not None
+        # The file status changed, but the content may be the same
+        with open(filepath, 'rb') as lockFile:
+            content = lockFile.read()
+        if hashlib.sha256(content).digest() != self._fileState[1]:
+            return False
+        self._fileState = (self._fileStatus(filepath), self._fileState[1])
+        return True
+
+    @staticmethod
+    def _fileStatus(filepath):
+        """Get the modification time, size and inode of the lockfile, or None if it does not exist"""
+        try:
+            status = os.stat(filepath)
+        except OSError:
+            return None
+        return (status.st_mtime_ns, status.st_size, status.st_ino)
@@ -2,16 +2,34 @@
 
 To be used to lock files, unlock files, override locks, and view locks
 Will confirm user roles and preform required git operations
+Locks can be leases that expire, expired locks are removed in batches when syncing or by a background reaper
 
 All file paths are relitive to the repository directory
 Working directory should be changed by the git module
 """
 
 import os
+import glob
+import time
+import fnmatch
+import functools
+import threading
+from pygit2 import discover_repository, GitError
 from meg_runtime.locking.lockFile import LockFile
+from meg_runtime.git.repository import GitRepository
+from meg_runtime.config import Config
 from meg_runtime.logger import Logger
 
 
+def _synchronized(method):
+    """Run a locking operation while holding the locking manager mutex, so it does not interleave with the reaper"""
+    @functools.wraps(method)
+    def synchronized(*args, **kwargs):
+        with LockingManager._mutex:
+            return method(*args, **kwargs)
+    return synchronized
+
+
 class LockingManager:
     """Used to prefrom all locking operations
     To be used to lock files, unlock files, override locks, and view locks
@@ -19,6 +37,13 @@ class LockingManager:
     """
     LOCKFILE_DIR = ".meg" + os.sep
     LOCKFILE_NAME = "locks.json"
+    SYNC_RETRIES = 3
+    LOCKS_REF = "refs/meg/locks/"
+    TRACKING_REF = "refs/meg/remotes/"
+    SYNCED_REF = "refs/meg/locks-synced/"
+    REAP_BATCH = 1000
+    DEFAULT_REAP_INTERVAL = 60
+    _mutex = threading.RLock()
     __instance = None
 
     def __init__(self):
@@ -30,28 +55,38 @@ class LockingManager:
             raise Exception("Trying to create a second instance of LockingManager, which is a singleton")
         else:
             LockingManager.__instance = self
-            LockingManager.__instance._lockFile = LockFile(LockingManager.LOCKFILE_DIR + LockingManager.LOCKFILE_NAME)
+            LockingManager.__instance._lockFile = LockFile(LockingManager.LOCKFILE_DIR + LockingManager.LOCKFILE_NAME,
+                                                           Config.get('locking/journal', False))
+            LockingManager.__instance._repo = LockingManager._openRepository()
+            LockingManager.__instance._synced = (None, {})
+            if LockingManager.__instance._repo is not None:
+                LockingManager._excludeLockFile(LockingManager.__instance._repo, LockingManager.__instance._lockFile)
+            LockingManager.__instance._reaper = None
 
     @staticmethod
-    def addLock(filepath, username):
+    @_synchronized
+    def addLock(filepath, username, ttl=None):
         """Sync the repo, adds the lock, sync the repo
         Args:
             filepath (string): path to the file to lock
             username (string): username of cuerrent user
+            ttl (float): seconds until the lock expires, the configured locking/ttl if None
         Returns:
             (bool): was lock sucessfuly added
         """
         if LockingManager.__instance is None:
             LockingManager()
         LockingManager.__instance.updateLocks()
-        if filepath in LockingManager.__instance._lockFile:
+        lockFile = LockingManager.__instance._lockFile
+        if filepath in lockFile and not lockFile.expired(filepath):
             return False
         else:
-            LockingManager.__instance._lockFile[filepath] = username
+            lockFile.lock(filepath, username, LockingManager._ttl(ttl))
             LockingManager.__instance.updateLocks()
             return True
         
     @staticmethod
+    @_synchronized
     def removeLock(filepath, username):
         """Sync the repo, remove a lock from a file, and sync again
         Args:
@@ -66,13 +101,154 @@ class LockingManager:
         lock = LockingManager.__instance._lockFile[filepath]
         if(lock is None):
             return True
-        elif(lock["user"] == username or False): #TODO check that user role can remove other user's locks
-            del LockingManager.__instance._lockFile[filepath] 
+        elif(lock["user"] == username or False):  # TODO check that user role can remove other user's locks
+            del LockingManager.__instance._lockFile[filepath]
         else:
             return False
         LockingManager.__instance.updateLocks()
         return True
         
+    @staticmethod
+    @_synchronized
+    def addLocks(filepaths, username, ttl=None):
+        """Add locks to many files, evaluating all conflicts against one snapshot and syncing once for the whole batch
+        Args:
+            filepaths (list or string): paths of files to lock, or glob patterns of paths in the working directory
+            username (string): username of cuerrent user
+            ttl (float): seconds until the locks expire, the configured locking/ttl if None
+        Returns:
+            (dictionary): was each lock sucessfuly added, by path
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        lockFile = LockingManager.__instance._lockFile
+        lockFile.load()
+        results = {}
+        ttl = LockingManager._ttl(ttl)
+        for filepath in LockingManager._expandPaths(filepaths, LockingManager._globWorkingTree):
+            results[filepath] = lockFile[filepath] is None or lockFile.expired(filepath)
+            if results[filepath]:
+                lockFile.lock(filepath, username, ttl)
+        LockingManager.__instance.updateLocks()
+        # A lock is only added if it is still held after syncing
+        for filepath, added in results.items():
+            results[filepath] = added and lockFile[filepath] is not None and lockFile[filepath]["user"] == username
+        return results
+
+    @staticmethod
+    @_synchronized
+    def removeLocks(filepaths, username):
+        """Remove locks from many files, evaluating all conflicts against one snapshot and syncing once for the whole batch
+        Like removeLock, only the locks of the user are removed, the locks of other users are kept
+        Args:
+            filepaths (list or string): paths of files to unlock, or glob patterns of locked paths
+            username (string): username of current user
+        Returns:
+            (dictionary): is there no longer a lock (was the user permitted to remove the lock), by path
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        lockFile = LockingManager.__instance._lockFile
+        lockFile.load()
+        results = {}
+        for filepath in LockingManager._expandPaths(filepaths, LockingManager._globLocks):
+            lock = lockFile[filepath]
+            results[filepath] = lock is None or lock["user"] == username
+            if lock is not None and results[filepath]:
+                del lockFile[filepath]
+        LockingManager.__instance.updateLocks()
+        # A lock is only removed if it is still not there after syncing
+        for filepath, removed in results.items():
+            results[filepath] = removed and lockFile[filepath] is None
+        return results
+
+    @staticmethod
+    @_synchronized
+    def renewLock(filepath, username, ttl=None):
+        """Sync the repo, renew the lease of a lock of the user, and sync again
+        Args:
+            filepath (string): path to the locked file
+            username (string): username of current user
+            ttl (float): seconds from now until the lock expires, the configured locking/ttl if None
+        Returns:
+            (bool): was the lock renewed, False if the file is not locked by the user
+        """
+        return LockingManager.renewLocks(username, [filepath], ttl) == [filepath]
+
+    @staticmethod
+    @_synchronized
+    def renewLocks(username, filepaths=None, ttl=None):
+        """Renew the leases of many locks of a user, syncing once for the whole batch
+        Args:
+            username (string): username of current user
+            filepaths (list): paths of the locked files, all locks of the user if None
+            ttl (float): seconds from now until the locks expire, the configured locking/ttl if None
+        Returns:
+            (list): paths of the renewed locks
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        LockingManager.__instance.updateLocks()
+        lockFile = LockingManager.__instance._lockFile
+        ttl = LockingManager._ttl(ttl)
+        if filepaths is None:
+            filepaths = lockFile.userLocks(username)
+        renewed = [filepath for filepath in filepaths if lockFile[filepath] is not None and lockFile[filepath]["user"] == username]
+        for filepath in renewed:
+            lockFile.renew(filepath, ttl)
+        LockingManager.__instance.updateLocks()
+        # A lock is only renewed if it is still held after syncing
+        return [filepath for filepath in renewed if lockFile[filepath] is not None and lockFile[filepath]["user"] == username]
+
+    @staticmethod
+    def startReaper(interval=None):
+        """Start a background thread that syncs the locks when the next lock expires, removing expired locks in batches
+        Args:
+            interval (float): maximum seconds between syncs, the configured locking/reap_interval if None
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        LockingManager.stopReaper()
+        if interval is None:
+            interval = Config.get('locking/reap_interval', LockingManager.DEFAULT_REAP_INTERVAL)
+        stop = threading.Event()
+        thread = threading.Thread(target=LockingManager._reap, args=(LockingManager.__instance, stop, interval), daemon=True)
+        LockingManager.__instance._reaper = (thread, stop)
+        thread.start()
+
+    @staticmethod
+    def stopReaper():
+        """Stop the background reaper thread, if it is running"""
+        if LockingManager.__instance is not None and LockingManager.__instance._reaper is not None:
+            thread, stop = LockingManager.__instance._reaper
+            LockingManager.__instance._reaper = None
+            stop.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    @staticmethod
+    def _reap(instance, stop, interval):
+        """Sync the locks whenever the next lock expires or the interval passes, until stopped or the manager is replaced"""
+        synced = time.time()
+        while not stop.is_set() and LockingManager.__instance is instance:
+            with LockingManager._mutex:
+                nextExpiry = instance._lockFile.nextExpiry()
+                if (nextExpiry is not None and nextExpiry[0] <= time.time()) or time.time() - synced >= interval:
+                    LockingManager.updateLocks()
+                    synced = time.time()
+                    nextExpiry = instance._lockFile.nextExpiry()
+            # Reap the next batch right away if there are more expired locks
+            wait = interval - (time.time() - synced)
+            if nextExpiry is not None:
+                wait = min(wait, nextExpiry[0] - time.time())
+            if wait > 0:
+                stop.wait(wait)
+
+    @staticmethod
+    def _ttl(ttl):
+        """Get the time to live of new or renewed locks"""
+        return ttl if ttl is not None else Config.get('locking/ttl', None)
+
     @staticmethod
     def findLock(filepath):
         """Find if there is a lock on the file, does not automatily sync the lock file
@@ -86,24 +262,248 @@ class LockingManager:
             LockingManager()
         return LockingManager.__instance._lockFile[filepath]
 
+    @staticmethod
+    def findPrefixLocks(prefix):
+        """Find the locks on all paths starting with a prefix, does not automatily sync the lock file
+        Args:
+            prefix (string): start of the paths, such as a directory followed by a separator
+        Returns:
+            (dictionary): lockfile entries by path
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        return LockingManager.__instance._lockFile.prefixLocks(prefix)
+
+    @staticmethod
+    def findDescendantLocks(dirpath):
+        """Find the locks on all paths inside a directory, does not automatily sync the lock file
+        Args:
+            dirpath (string): path of the directory
+        Returns:
+            (dictionary): lockfile entries by path
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        return LockingManager.__instance._lockFile.descendantLocks(dirpath)
+
+    @staticmethod
+    def hasDescendantLock(dirpath):
+        """Find if there is a lock on any path inside a directory, does not automatily sync the lock file
+        Args:
+            dirpath (string): path of the directory
+        Returns:
+            (bool): is any path inside the directory locked
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        return LockingManager.__instance._lockFile.hasDescendantLock(dirpath)
+
+    @staticmethod
+    def findAncestorLock(filepath):
+        """Find the closest locked directory containing a path, does not automatily sync the lock file
+        Args:
+            filepath (string): path of file that may be inside a locked directory
+        Returns:
+            (tuple): path of the locked directory and its lockfile entry
+            (None): no directory containing the path is locked
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        return LockingManager.__instance._lockFile.ancestorLock(filepath)
+
+    @staticmethod
+    def findUserLocks(username):
+        """Find the paths locked by a user, does not automatily sync the lock file
+        Args:
+            username (string): name of locking user
+        Returns:
+            (list): locked paths, in path order
+        """
+        if LockingManager.__instance is None:
+            LockingManager()
+        return LockingManager.__instance._lockFile.userLocks(username)
+
+    @staticmethod
+    def _expandPaths(filepaths, globPaths):
+        """Expand the glob patterns in paths, keeping the order and removing duplicates
+        Args:
+            filepaths (list or string): paths or glob patterns
+            globPaths (function): get the paths matching a glob pattern
+        Returns:
+            (list): expanded paths
+        """
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        expanded = {}
+        for filepath in filepaths:
+            if glob.has_magic(filepath):
+                expanded.update(dict.fromkeys(globPaths(filepath)))
+            else:
+                expanded[filepath] = None
+        return list(expanded)
+
+    @staticmethod
+    def _globWorkingTree(pattern):
+        """Get the paths in the working directory matching a glob pattern, with the separators used by the lock file"""
+        return sorted(path.replace(os.sep, "/") for path in glob.glob(pattern, recursive=True))
+
+    @staticmethod
+    def _globLocks(pattern):
+        """Get the locked paths matching a glob pattern, only matching the locks starting with the pattern before any wildcards"""
+        prefix = pattern[:min(pattern.find(c) if c in pattern else len(pattern) for c in "*?[")]
+        return [path for path in LockingManager.__instance._lockFile.prefixLocks(prefix) if fnmatch.fnmatchcase(path, pattern)]
+
     @staticmethod
     def locks():
         return LockingManager.__instance._lockFile
 
     @staticmethod
+    @_synchronized
     def updateLocks():
         """Syncronizes the local locks with the remote locks, manually merge local data with remote
-        """
-        #TODO Sync with repo, as described below
-        """
-        https://www.quora.com/How-can-I-pull-one-file-from-a-Git-repository-instead-of-the-entire-project/answer/Aarti-Dwivedi
-        fetch
-        checkout from latest commit lock and permissions files
-        create new LockFile object off of it and merge with current object
-        save date
-        if lockfile has changed stage, commit, and push it
+        Fetches only the locks reference of the tracked remote branch and reads the remote lockfile from the fetched tree without a checkout,
+        then merges the lock entries changed since the commit last synced by this client and pushes the merged lockfile if it differs from the remote
+        The locks are committed on their own reference, so the checked out branch and working tree are never changed by a sync
+        Locks are only saved and reloaded if the working directory is not in a repository or its branch has no configured upstream branch
+        A batch of expired locks is removed before syncing
         """
         if LockingManager.__instance is None:
             LockingManager()
-        LockingManager.__instance._lockFile.save()
-        LockingManager.__instance._lockFile.load()
+        lockFile = LockingManager.__instance._lockFile
+        lockFile.reapExpired(limit=LockingManager.REAP_BATCH)
+        lockFile.save()
+        lockFile.load()
+        repo = LockingManager.__instance._repo
+        if repo is None:
+            return
+        upstream = repo.upstream()
+        lockPath = LockingManager._lockPath(repo, lockFile)
+        if upstream is None or lockPath is None:
+            return
+        try:
+            for attempt in range(LockingManager.SYNC_RETRIES):
+                if LockingManager._syncRemote(repo, upstream, lockPath):
+                    return
+            Logger.warning("MEG Locking: Unable to push locks, the remote locks changed during every sync")
+        except GitError as e:
+            Logger.warning("MEG Locking: Unable to sync locks with remote: {0}".format(e))
+
+    @staticmethod
+    def _openRepository():
+        """Open the repository of the working directory
+        Returns:
+            (GitRepository): the repository, None if the working directory is not in a repository with a working tree
+        """
+        path = discover_repository(os.getcwd())
+        if path is None:
+            return None
+        try:
+            repo = GitRepository(path)
+        except GitError as e:
+            Logger.warning("MEG Locking: Unable to open repository at {0}: {1}".format(path, e))
+            return None
+        return None if repo.is_bare else repo
+
+    @staticmethod
+    def _lockPath(repo, lockFile):
+        """Get the path of the lockfile in the repository
+        Returns:
+            (string): path of the lockfile relative to the working tree, None if the lockfile is outside of the working tree
+        """
+        lockPath = os.path.relpath(os.path.abspath(lockFile._filepath), repo.workdir).replace(os.sep, "/")
+        return None if lockPath.startswith("../") else lockPath
+
+    @staticmethod
+    def _excludeLockFile(repo, lockFile):
+        """Exclude the lockfile and its journal from the working tree status, so they are never committed to a branch
+        Args:
+            repo (GitRepository): repository of the lockfile
+            lockFile (LockFile): lockfile to exclude
+        """
+        lockPath = LockingManager._lockPath(repo, lockFile)
+        if lockPath is None:
+            return
+        pattern = "/" + lockPath + "*"
+        excludePath = os.path.join(repo.path, "info", "exclude")
+        try:
+            with open(excludePath, "a+") as excludeFile:
+                excludeFile.seek(0)
+                content = excludeFile.read()
+                if pattern not in content.splitlines():
+                    excludeFile.write(("" if not content or content.endswith("\n") else "\n") + pattern + "\n")
+        except OSError as e:
+            Logger.warning("MEG Locking: Unable to exclude lock file from repository at {0}: {1}".format(repo.path, e))
+
+    @staticmethod
+    def _syncRemote(repo, upstream, lockPath):
+        """Merge the local locks with the fetched remote locks and push the merged locks if they differ from the remote
+        The locks of a branch are committed on the locks reference of the branch, whose first commit has no parent
+        Args:
+            repo (GitRepository): repository of the lockfile
+            upstream (tuple): remote name and branch name to sync with
+            lockPath (string): path of the lockfile in the repository
+        Returns:
+            (bool): False if the remote changed before the merged locks were pushed
+        """
+        remoteName, branch = upstream
+        lockFile = LockingManager.__instance._lockFile
+        journalPath = lockPath + LockFile.JOURNAL_SUFFIX
+        # The merge base is the commit last synced by this client, the tracking reference is also moved by other fetches
+        syncedRef = LockingManager.SYNCED_REF + remoteName + "/" + branch
+        synced = repo.references.get(syncedRef)
+        baseId = synced.target if synced is not None else None
+        locksRef = LockingManager.LOCKS_REF + branch
+        trackingRef = LockingManager.TRACKING_REF + remoteName + "/locks/" + branch
+        remoteId = repo.fetch_reference(remoteName, locksRef, trackingRef)
+        base = LockingManager._remoteLocks(repo, baseId, lockPath)
+        remote = LockingManager._remoteLocks(repo, remoteId, lockPath)
+        local = dict(lockFile.items())
+        merged = LockFile.merge(base, local, remote)
+        if merged != remote:
+            if lockFile._journal:
+                # Append only the changed entries to the remote journal so the commit diff stays small
+                journal = repo.read_file(remoteId, journalPath) or b""
+                journal = journal[:journal.rfind(b"\n") + 1] + LockFile.journalRecords(remote, merged)
+                files = {journalPath: journal}
+                if repo.read_file(remoteId, lockPath) is None:
+                    files[lockPath] = LockFile.serialize({})
+                if journal.count(b"\n") > max(LockFile.JOURNAL_COMPACT_RECORDS, len(merged)):
+                    files = {lockPath: LockFile.serialize(merged), journalPath: b""}
+            else:
+                files = {lockPath: LockFile.serialize(merged), journalPath: None}
+            commitId = repo.commit_files(remoteId, files, "MEG: Update locks")
+            try:
+                repo.push_reference(remoteName, commitId, locksRef, trackingRef)
+            except GitError as e:
+                Logger.debug("MEG Locking: Push of locks rejected, syncing again: {0}".format(e))
+                return False
+            remoteId = commitId
+        if remoteId is None:
+            # There are no locks on the remote or in this client
+            return True
+        repo.references.create(syncedRef, remoteId, force=True)
+        LockingManager.__instance._synced = (remoteId, merged)
+        if merged != local:
+            content = repo.read_file(remoteId, lockPath)
+            if content is None or not lockFile._journal:
+                lockFile.store(LockFile.serialize(merged))
+            else:
+                lockFile.store(content, repo.read_file(remoteId, journalPath))
+        return True
+
+    @staticmethod
+    def _remoteLocks(repo, commitId, lockPath):
+        """Read the lock entries of a commit, reusing the entries of the last synced commit
+        Returns:
+            (dictionary): lock entries by path, empty if there is no commit or lockfile
+        """
+        if commitId is None:
+            return {}
+        if LockingManager.__instance._synced[0] == commitId:
+            return LockingManager.__instance._synced[1]
+        locks = LockFile.parse(repo.read_file(commitId, lockPath), repo.read_file(commitId, lockPath + LockFile.JOURNAL_SUFFIX))
+        if locks is None:
+            Logger.warning("MEG Locking: Unable to read contents of remote lock file {0}".format(lockPath))
+            return {}
+        LockingManager.__instance._synced = (commitId, locks)
+        return locks
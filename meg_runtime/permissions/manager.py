@@ -1,49 +1,389 @@
 """Multimedia Extensible Git (MEG) permissions manager"""
 
+import os
+import re
 import json
+import time
+import fnmatch
+import functools
+import collections
 from meg_runtime.logger import Logger
 
 
+class _RuleTrie:
+    """Trie of the path segments of permission rules
+
+    A rule applies to the paths it matches and all their descendants, or only to the descendants
+    if its path ends with '/'. Segments of a rule path can be literal, glob patterns like '*.psd',
+    or '**' to match any number of segments. The most specific rule matching a path is the one
+    with the most literal segments, then the most pattern segments, then the last one defined.
+    """
+    __slots__ = ('literals', 'patterns', 'any_segments', 'repeats', 'rule', 'descendants_rule')
+
+    def __init__(self, repeats=False):
+        self.literals = {}
+        self.patterns = []
+        self.any_segments = None
+        self.repeats = repeats
+        self.rule = None
+        self.descendants_rule = None
+
+    def insert(self, path, rule, order):
+        """Insert a rule for a path"""
+        descendants_only = path.endswith('/')
+        segments = [segment for segment in path.split('/') if segment and segment != '.']
+        node = self
+        literal_count = pattern_count = 0
+        for segment in segments:
+            if segment == '**':
+                if node.any_segments is None:
+                    node.any_segments = _RuleTrie(True)
+                node = node.any_segments
+            elif any(character in segment for character in '*?['):
+                pattern_count += 1
+                child = next((child for pattern, match, child in node.patterns if pattern == segment), None)
+                if child is None:
+                    child = _RuleTrie()
+                    node.patterns.append((segment, re.compile(fnmatch.translate(segment)).match, child))
+                node = child
+            else:
+                literal_count += 1
+                node = node.literals.setdefault(segment, _RuleTrie())
+        ranked_rule = ((literal_count, pattern_count, order), rule)
+        node.descendants_rule = ranked_rule
+        if not descendants_only:
+            node.rule = ranked_rule
+
+    def match(self, segments):
+        """Get the most specific rule matching the path segments, or None"""
+        state = self.start()
+        for segment in segments:
+            state = self.advance(state, segment)
+        return self.result(state)
+
+    def start(self):
+        """Get the match state of the root path, the matching nodes and the best rule inherited so far"""
+        return (_RuleTrie._closure([self]), None)
+
+    def advance(self, state, segment):
+        """Get the match state after matching one more path segment"""
+        nodes, best = state
+        next_nodes = []
+        for node in nodes:
+            best = _RuleTrie._best(best, node.descendants_rule)
+            # A '**' node matches any number of segments, so it matches this segment too
+            if node.repeats:
+                next_nodes.append(node)
+            if segment in node.literals:
+                next_nodes.append(node.literals[segment])
+            next_nodes.extend(child for pattern, match, child in node.patterns if match(segment))
+        return (_RuleTrie._closure(next_nodes), best)
+
+    @staticmethod
+    def result(state):
+        """Get the most specific rule of a path from its match state, or None"""
+        nodes, best = state
+        for node in nodes:
+            best = _RuleTrie._best(best, node.rule)
+        return best[1] if best is not None else None
+
+    @staticmethod
+    def _best(best, ranked_rule):
+        """Get the more specific of two ranked rules"""
+        return ranked_rule if ranked_rule is not None and (best is None or ranked_rule[0] > best[0]) else best
+
+    @staticmethod
+    def _closure(nodes):
+        """Add the '**' nodes following the nodes, which also match no segments"""
+        closure = []
+        for node in nodes:
+            while node is not None and node not in closure:
+                closure.append(node)
+                node = node.any_segments
+        return tuple(closure)
+
+
 class PermissionsManager(dict):
-    """Permissions manager - one for each repository"""
+    """Permissions manager - one for each repository
 
-    def __init__(self, path, user):
-        """Load the repository permission file"""
+    The permissions file is compiled when loaded into role bitmasks and user sets for each path,
+    so checking a path does not scan the roles and users. The compiled permissions are rebuilt
+    when the permissions file changes. Changes made to this dictionary are compiled by compile()
+
+    Paths in the permissions file can be files, directories whose permissions are inherited by
+    their descendants, or glob patterns like 'assets/**/*.psd'. A file path is permitted by its
+    own entry, otherwise by the most specific matching directory or pattern entry
+
+    Statistics of the permission checks, decision cache, loading and compiling can be collected
+    by enabling them, they cost only a check per permission check when disabled
+    """
+
+    # Seconds between checks for changes of the permissions file
+    RELOAD_INTERVAL = 1.0
+    # Number of paths whose matching directory or pattern entry is cached
+    DECISION_CACHE_SIZE = 1 << 16
+    # Seconds a permission check takes to be sampled as slow, and the number of slow checks sampled
+    SLOW_THRESHOLD = 0.001
+    SLOW_SAMPLES = 100
+
+    def __init__(self, path, user, stats=False):
+        """Load the repository permission file, collecting statistics if enabled"""
+        self._stats = None
+        if stats:
+            self.enable_stats()
         self._user = user
+        self._path = path
+        self._file_status = None
+        self._reload_checked = 0
+        self._user_roles = {}
+        self._user_mask = 0
+        self._rules = {}
+        self._trie = None
+        self._match = None
+        self.load()
+
+    def load(self):
+        """Load and compile the permissions file, return False if it could not be loaded"""
+        self._reload_checked = time.monotonic()
+        start = time.perf_counter()
         try:
-            self.update(json.load(open(path)))
+            with open(self._path) as permissions_file:
+                status = PermissionsManager._file_status_of(permissions_file.fileno())
+                permissions = json.load(permissions_file)
+            if self._stats is not None:
+                self._stats['load'] += 1
+                self._stats['load_seconds'] += time.perf_counter() - start
         except Exception as e:
             # Log that loading the configuration failed
             Logger.warning('MEG Permission: {0}'.format(e))
-            Logger.warning('MEG Permission: Could not load permissions file <' + path + '>')
+            Logger.warning('MEG Permission: Could not load permissions file <' + self._path + '>')
+            self.compile()
+            return False
+        self.clear()
+        self.update(permissions)
+        self._file_status = status
+        self.compile()
+        return True
+
+    def reload(self):
+        """Load the permissions file again only if it changed since it was loaded, return True if it was loaded"""
+        self._reload_checked = time.monotonic()
+        try:
+            status = PermissionsManager._file_status_of(self._path)
+        except OSError:
+            return False
+        if status == self._file_status:
+            return False
+        return self.load()
+
+    def compile(self):
+        """Compile the roles of each user and the role bitmasks and user sets of each path"""
+        start = time.perf_counter()
+        roles = self.get('roles', {})
+        role_bits = {role: 1 << bit for bit, role in enumerate(roles)}
+        # Keep the roles of each user in definition order
+        user_roles = {}
+        for role, users in roles.items():
+            for user in users:
+                user_roles.setdefault(user, {})[role] = None
+        self._user_roles = {user: tuple(user_roles[user]) for user in user_roles}
+
+        # Roles that are not defined have no users and no bit
+        def roles_mask(path_roles):
+            mask = 0
+            for role in path_roles:
+                mask |= role_bits.get(role, 0)
+            return mask
+
+        self._user_mask = roles_mask(self._user_roles.get(self._user, ()))
+        self._rules = {}
+        trie = _RuleTrie()
+        for order, (path, rules) in enumerate(self.get('files', {}).items()):
+            rule = (roles_mask(rules.get('roles_read', [])), roles_mask(rules.get('roles_write', [])),
+                    frozenset(rules.get('users_read', [])), frozenset(rules.get('users_write', [])))
+            if not path.endswith('/') and not any(character in path for character in '*?['):
+                self._rules[path] = rule
+            trie.insert(path, rule, order)
+        self._trie = trie
+        if self._stats is not None:
+            self._count_cache()
+        # Rebuilding the matcher also clears the cached matches
+        self._match = functools.lru_cache(maxsize=PermissionsManager.DECISION_CACHE_SIZE)(
+            functools.partial(PermissionsManager._match_path, trie))
+        if self._stats is not None:
+            self._stats['compile'] += 1
+            self._stats['compile_seconds'] += time.perf_counter() - start
 
     def can_lock(self, path):
         """Return True if the current user can lock a specific path"""
-        return PermissionsManager.can_read() and PermissionsManager.can_write()
+        if self._stats is not None:
+            return self._timed('lock', path, 1, self._can_lock, path)
+        return self._can_lock(path)
+
+    def _can_lock(self, path):
+        """Return True if the current user can read and write to a specific path"""
+        return self.can_read(path) and self.can_write(path)
+
+    def check_paths(self, paths):
+        """Return the read, write and lock permissions of the current user for many paths, by path
+
+        Paths in the same directory share matching the directory, so a whole directory listing is
+        checked in one pass. Paths that do not exist in the permissions file are not permitted
+        """
+        if self._stats is not None:
+            paths = list(paths)
+            return self._timed('bulk', '<{0} paths>'.format(len(paths)), len(paths), self._check_paths, paths)
+        return self._check_paths(paths)
+
+    def _check_paths(self, paths):
+        """Return the read, write and lock permissions of the current user for many paths, by path"""
+        if time.monotonic() - self._reload_checked > PermissionsManager.RELOAD_INTERVAL:
+            self.reload()
+        directory_states = {}
+        permissions = {}
+        for path in paths:
+            rule = self._rules.get(path)
+            if rule is None:
+                segments = [segment for segment in path.replace(os.sep, '/').split('/') if segment and segment != '.']
+                if segments:
+                    state = self._directory_state('/'.join(segments[:-1]), directory_states)
+                    rule = self._trie.result(self._trie.advance(state, segments[-1]))
+            if rule is None:
+                permissions[path] = (False, False, False)
+            else:
+                read = bool(rule[0] & self._user_mask) or self._user in rule[2]
+                write = bool(rule[1] & self._user_mask) or self._user in rule[3]
+                permissions[path] = (read, write, read and write)
+        return permissions
+
+    def filter_paths(self, paths, access='read'):
+        """Return the paths the current user can access, where the access is 'read', 'write' or 'lock'"""
+        index = ('read', 'write', 'lock').index(access)
+        return [path for path, permissions in self.check_paths(paths).items() if permissions[index]]
 
     def can_read(self, path):
         """Return True if the current user can read a specific path"""
-        if 'files' not in self or path not in self['files']:
-            Logger.warning('MEG Permission: Path <' + path + '> does not exist in the permissions file.')
-            return False
-        roles = self._get_roles()
-        for role in roles:
-            if role in self['files'][path]['roles_read']:
-                return True
-        return self._user in self['files'][path]['users_read']
+        if self._stats is not None:
+            return self._timed('read', path, 1, self._can, path, 0)
+        return self._can(path, 0)
 
     def can_write(self, path):
         """Return True if the current user can write to a specific path"""
-        if 'files' not in self or path not in self['files']:
+        if self._stats is not None:
+            return self._timed('write', path, 1, self._can, path, 1)
+        return self._can(path, 1)
+
+    def enable_stats(self, slow_threshold=None):
+        """Start collecting statistics from zero, sampling checks slower than the threshold in seconds"""
+        self._stats = {
+            'checks': dict.fromkeys(['read', 'write', 'lock', 'bulk'], 0),
+            'paths': dict.fromkeys(['read', 'write', 'lock', 'bulk'], 0),
+            'seconds': dict.fromkeys(['read', 'write', 'lock', 'bulk'], 0.0),
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'load': 0,
+            'load_seconds': 0.0,
+            'compile': 0,
+            'compile_seconds': 0.0,
+            'slow_threshold': slow_threshold if slow_threshold is not None else PermissionsManager.SLOW_THRESHOLD,
+            'slow': 0,
+            'slow_samples': collections.deque(maxlen=PermissionsManager.SLOW_SAMPLES)
+        }
+        # Only count the decision cache hits and misses from now
+        if getattr(self, '_match', None) is not None:
+            info = self._match.cache_info()
+            self._stats['cache_hits'] -= info.hits
+            self._stats['cache_misses'] -= info.misses
+
+    def disable_stats(self):
+        """Stop collecting statistics"""
+        self._stats = None
+
+    def stats(self):
+        """Return a snapshot of the collected statistics, or None if they are not enabled
+
+        The snapshot has the number of checks, checked paths and seconds spent checking by operation
+        ('read', 'write', 'lock' and 'bulk', where locking also checks reading and writing), the hits,
+        misses and hit rate of the decision cache, the number and seconds of loads and compiles of the
+        permissions file, and the number and most recent samples of slow checks
+        """
+        if self._stats is None:
+            return None
+        stats = self._stats
+        info = self._match.cache_info()
+        hits = stats['cache_hits'] + info.hits
+        misses = stats['cache_misses'] + info.misses
+        return {
+            'checks': dict(stats['checks']),
+            'paths': dict(stats['paths']),
+            'seconds': dict(stats['seconds']),
+            'cache': {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else None,
+                      'size': info.currsize},
+            'load': {'count': stats['load'], 'seconds': stats['load_seconds']},
+            'compile': {'count': stats['compile'], 'seconds': stats['compile_seconds']},
+            'slow': {'threshold': stats['slow_threshold'], 'count': stats['slow'], 'samples': list(stats['slow_samples'])}
+        }
+
+    def _timed(self, operation, path, paths, check, *args):
+        """Run a permission check, counting it and sampling it if it is slow"""
+        start = time.perf_counter()
+        result = check(*args)
+        seconds = time.perf_counter() - start
+        stats = self._stats
+        if stats is not None:
+            stats['checks'][operation] += 1
+            stats['paths'][operation] += paths
+            stats['seconds'][operation] += seconds
+            # Checks of many paths are slow if they take longer than the threshold for each path
+            if seconds >= stats['slow_threshold'] * max(paths, 1):
+                stats['slow'] += 1
+                stats['slow_samples'].append({'operation': operation, 'path': path, 'seconds': seconds, 'time': time.time()})
+        return result
+
+    def _count_cache(self):
+        """Keep the decision cache hits and misses before the cache is rebuilt"""
+        if self._match is not None:
+            info = self._match.cache_info()
+            self._stats['cache_hits'] += info.hits
+            self._stats['cache_misses'] += info.misses
+
+    def _can(self, path, access):
+        """Return True if the current user has read (0) or write (1) access to a specific path"""
+        if time.monotonic() - self._reload_checked > PermissionsManager.RELOAD_INTERVAL:
+            self.reload()
+        rule = self._rules.get(path)
+        if rule is None:
+            rule = self._match(path)
+            if rule is None:
+                return False
+        return bool(rule[access] & self._user_mask) or self._user in rule[access + 2]
+
+    def _directory_state(self, directory, directory_states):
+        """Get the match state of a normalized directory path, matching each parent directory once"""
+        state = directory_states.get(directory)
+        if state is None:
+            if directory:
+                parent, _, name = directory.rpartition('/')
+                state = self._trie.advance(self._directory_state(parent, directory_states), name)
+            else:
+                state = self._trie.start()
+            directory_states[directory] = state
+        return state
+
+    @staticmethod
+    def _match_path(trie, path):
+        """Get the compiled entry of the most specific directory or pattern matching a path"""
+        rule = trie.match([segment for segment in path.replace(os.sep, '/').split('/') if segment and segment != '.'])
+        if rule is None:
             Logger.warning('MEG Permission: Path <' + path + '> does not exist in the permissions file.')
-            return False
-        roles = self._get_roles()
-        for role in roles:
-            if role in self['files'][path]['roles_write']:
-                return True
-        return self._user in self['files'][path]['users_write']
+        return rule
 
     def _get_roles(self):
         """Get a list of users from the configuration file."""
-        return [role for role in self['roles']
-                if self._user in self['roles'][role]]
+        return list(self._user_roles.get(self._user, ()))
+
+    @staticmethod
+    def _file_status_of(file):
+        """Get the modification time, size and inode of the permissions file"""
+        status = os.stat(file)
+        return (status.st_mtime_ns, status.st_size, status.st_ino)
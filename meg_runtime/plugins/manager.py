@@ -27,6 +27,8 @@ class PluginManager(dict):
 
     # The plugin manager instance
     __instance = None
+    # The configured paths in python path for import
+    __paths = {}
 
     # Plugin manager constructor
     def __init__(self, update=True, **kwargs):
@@ -41,8 +43,13 @@ class PluginManager(dict):
             # Set this as the current plugin manager instance
             PluginManager.__instance = self
             # Set plugin and cache paths in python path for import
-            sys.path.append(Config.get('path/plugins'))
-            sys.path.append(Config.get('path/cache'))
+            for key in ['path/plugins', 'path/cache']:
+                PluginManager.__paths[key] = Config.get(key)
+                sys.path.append(PluginManager.__paths[key])
+                # Update the python path when the configured path changes
+                Config.subscribe(key, PluginManager._path_changed)
+            # Unload the plugins that are disabled when the configuration changes
+            Config.subscribe('plugins', PluginManager._enabled_changed)
             # Load information about plugins
             if update:
                 PluginManager.update()
@@ -138,8 +145,11 @@ class PluginManager(dict):
         # Get the plugin cache path and create if needed
         cache_path = os.path.join(Config.get('path/plugin_cache'), 'remote')
         os.makedirs(cache_path, exist_ok=True)
-        # Open or clone the plugins repository with the plugin cache path
-        cache = GitManager.open_or_clone(os.path.join(cache_path, PluginManager.DEFAULT_BARE_REPO_PATH), Config.get('plugins/url', PluginManager.DEFAULT_CACHE_URL), bare=True)
+        # Open the pooled plugins repository or clone it to the plugin cache path
+        repo_path = os.path.join(cache_path, PluginManager.DEFAULT_BARE_REPO_PATH)
+        cache = GitManager.acquire(repo_path)
+        if cache is None:
+            cache = GitManager.clone(Config.get('plugins/url', PluginManager.DEFAULT_CACHE_URL), repo_path=repo_path, bare=True)
         if cache is None:
             # Log that loading the plugin cache information failed
             Logger.warning(f'MEG Plugins: Could not update plugin cache information')
@@ -159,6 +169,9 @@ class PluginManager(dict):
             Logger.warning(f'MEG Plugins: {e}')
             Logger.warning(f'MEG Plugins: Could not update plugin cache information')
             return False
+        finally:
+            # Return the plugins repository to the pool
+            GitManager.release(cache)
         # Log updating plugin cache information
         return PluginManager._update_cache(cache_path, update)
 
@@ -192,15 +205,15 @@ class PluginManager(dict):
             # Remove the previous plugin path, if necessary
             if not Config.remove_path(plugin_path):
                 return False
-            # Open the local plugin cache repository
+            # Open the pooled local plugin cache repository
             cache_path = os.path.join(Config.get('path/plugin_cache'), 'remote', PluginManager.DEFAULT_BARE_REPO_PATH)
-            cache = GitManager.open(cache_path, bare=True)
-            if cache is None:
-                raise GitException(f'Could not open local plugin cache <{cache_path}>')
-            # Log installing plugin
-            Logger.debug(f'MEG Plugins: Installing plugin <{plugin_path}>')
-            # Install plugin by checking out
-            cache.checkout_head(directory=plugins_path, paths=[plugin_basename + '/*'])
+            with GitManager.repository(cache_path) as cache:
+                if cache is None:
+                    raise GitException(f'Could not open local plugin cache <{cache_path}>')
+                # Log installing plugin
+                Logger.debug(f'MEG Plugins: Installing plugin <{plugin_path}>')
+                # Install plugin by checking out
+                cache.checkout_head(directory=plugins_path, paths=[plugin_basename + '/*'])
             # Load (or update) plugin information
             plugin = PluginManager._update(plugin_path, force)
             if plugin is not None:
@@ -299,20 +312,37 @@ class PluginManager(dict):
 
     # Install plugin archive from url
     @staticmethod
-    def install_archive_from_url(url, force=False):
-        """Install plugin archive from url"""
+    def install_archive_from_url(url, force=False, checksum=None):
+        """Install plugin archive from url, verifying the checksum of the archive, if given"""
         # Check there is plugin manager instance
         if PluginManager.__instance is None:
             PluginManager()
         if PluginManager.__instance is None:
             return False
         # Download archive
-        archive_path = Config.download(url)
+        archive_path = Config.download(url, checksum=checksum)
         if not archive_path:
             return False
         # Install from downloaded archive
         return PluginManager.install_archive(archive_path, force)
 
+    # Install plugin archives from urls
+    @staticmethod
+    def install_archives_from_urls(urls, force=False, checksums=None):
+        """Install plugin archives from urls, downloading concurrently and installing each archive as it is downloaded"""
+        # Check there is plugin manager instance
+        if PluginManager.__instance is None:
+            PluginManager()
+        if PluginManager.__instance is None:
+            return False
+        # Download archives and install from each downloaded archive
+        installed = []
+        paths = Config.download_all(urls, checksums=checksums, completed=lambda url, archive_path: installed.append(
+            archive_path is not None and PluginManager.install_archive(archive_path, force)
+        ))
+        # Urls that were not downloaded have no path and are never completed, so every url must have a path
+        return bool(paths) and all(path is not None for path in paths) and all(installed)
+
     # Uninstall plugin by name
     @staticmethod
     def uninstall(name):
@@ -640,6 +670,35 @@ class PluginManager(dict):
             retval = PluginManager.unload(name) and retval
         return retval
 
+    # Update the python path, and plugin information for the plugins path, when a configured path changes
+    @staticmethod
+    def _path_changed(key, path):
+        """Update the python path, and plugin information for the plugins path, when a configured path changes"""
+        previous_path = PluginManager.__paths.get(key)
+        if path == previous_path:
+            return
+        # Log the changed path
+        Logger.debug(f'MEG Plugins: Configured path <{key}> changed to <{path}>')
+        # Replace the previous path in python path
+        if previous_path in sys.path:
+            sys.path.remove(previous_path)
+        PluginManager.__paths[key] = path
+        if path is not None:
+            sys.path.append(path)
+        # Load information about the plugins in the new plugins path
+        if key == 'path/plugins':
+            PluginManager.update()
+
+    # Unload the plugins that are no longer enabled when the enabled plugins change
+    @staticmethod
+    def _enabled_changed(key, enabled_plugins):
+        """Unload the plugins that are no longer enabled when the enabled plugins change"""
+        if not isinstance(enabled_plugins, list):
+            enabled_plugins = []
+        for name in list(PluginManager.get_names()):
+            if name not in enabled_plugins:
+                PluginManager.unload(name)
+
     # Create plugin information from plugin path
     @staticmethod
     def _update(plugin_path, force=False):
@@ -1,5 +1,7 @@
 
 from meg_runtime.ui.clonepanel import ClonePanel
 from meg_runtime.ui.repopanel import RepoPanel
+from meg_runtime.ui.gittask import GitTask
 from meg_runtime.ui.manager import UIManager, ui_run
 
+__all__ = ['ClonePanel', 'RepoPanel', 'GitTask', 'UIManager', 'ui_run']
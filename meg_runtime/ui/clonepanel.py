@@ -15,18 +15,54 @@ class ClonePanel(BasePanel):
         super().__init__(**kwargs)
         self.manager = manager
 
+        self.server = self.findChild(QtWidgets.QTextEdit, 'server')
+        self.depth = self.findChild(QtWidgets.QSpinBox, 'depth')
+        self.sparse_paths = self.findChild(QtWidgets.QTextEdit, 'sparsePaths')
+        self.progress = self.findChild(QtWidgets.QProgressBar, 'progress')
         self.ok_button = self.findChild(QtWidgets.QPushButton, 'okButton')
         self.ok_button.clicked.connect(self.clone)
         self.back_button = self.findChild(QtWidgets.QPushButton, 'backButton')
         self.back_button.clicked.connect(self.return_to_main_menu)
+        # The clone in progress, if any
+        self.task = None
 
     def clone(self):
         """Clone the repository."""
-        # Pass control to the manager
-        self.manager.clone()
+        # Only check out the files matching the sparse paths, if any
+        sparse_paths = [line.strip() for line in self.sparse_paths.toPlainText().splitlines() if line.strip()]
+        # Pass control to the manager, which clones in a worker thread
+        self.task = self.manager.clone(self.server.toPlainText().strip(), depth=self.depth.value(), sparse_paths=sparse_paths or None)
+        self.task.signals.progress.connect(self.show_progress)
+        self.task.signals.finished.connect(self.clone_finished)
+        self.task.signals.failed.connect(self.clone_failed)
+        self.ok_button.setEnabled(False)
+        self.progress.setValue(0)
+        self.statusBar().showMessage('Cloning...')
+
+    def show_progress(self, received_objects, total_objects, indexed_objects, received_bytes):
+        """Show the progress of the clone."""
+        # Receiving and indexing the objects are each half of the progress
+        self.progress.setMaximum(max(2 * total_objects, 1))
+        self.progress.setValue(received_objects + indexed_objects)
+        self.statusBar().showMessage(f'Received {received_objects}/{total_objects} objects ({received_bytes / 1024 / 1024:.1f} MB)')
+
+    def clone_finished(self, repo):
+        """Reset the panel after the clone finished."""
+        self.task = None
+        self.ok_button.setEnabled(True)
+        self.statusBar().clearMessage()
+
+    def clone_failed(self, message):
+        """Show why the clone failed."""
+        self.task = None
+        self.ok_button.setEnabled(True)
+        self.progress.setValue(0)
+        self.statusBar().showMessage(message)
 
     def return_to_main_menu(self):
-        """Return to the main menu."""
+        """Return to the main menu, cancelling the clone in progress."""
+        if self.task is not None:
+            self.task.cancel()
         self.manager.return_to_main_menu()
 
 
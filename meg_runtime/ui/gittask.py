@@ -0,0 +1,93 @@
+"""MEG UI Git Task
+"""
+from PyQt5 import QtCore
+
+import time
+import threading
+
+from meg_runtime.git import GitManager, GitException
+from meg_runtime.git.repository import GitRemoteCallbacks
+from meg_runtime.logger import Logger
+
+
+class GitTaskSignals(QtCore.QObject):
+    """Signals of a git task, delivered on the thread of the connected receivers."""
+
+    # The received objects, total objects, indexed objects and received bytes of the transfer
+    progress = QtCore.pyqtSignal(int, int, int, 'qint64')
+    # The result of the git operation
+    finished = QtCore.pyqtSignal(object)
+    # The message of the failed or cancelled git operation
+    failed = QtCore.pyqtSignal(str)
+
+
+class GitTaskCallbacks(GitRemoteCallbacks):
+    """Remote callbacks emitting the transfer progress of a git task."""
+
+    # The minimum seconds between progress signals, one frame at 60 frames per second
+    PROGRESS_INTERVAL = 1 / 60
+
+    def __init__(self, signals, cancelled):
+        """Git task callbacks constructor."""
+        super().__init__(cancelled=cancelled)
+        self.signals = signals
+        self.last_progress = None
+
+    def transfer_progress(self, stats):
+        """Emit the transfer progress at most once per frame, aborting the transfer when cancelled."""
+        self.check_aborted()
+        # Emitting every update would flood the event loop of the UI with millions of signals for large transfers
+        now = time.monotonic()
+        if self.last_progress is None or now - self.last_progress >= self.PROGRESS_INTERVAL or stats.indexed_objects == stats.total_objects:
+            self.last_progress = now
+            self.signals.progress.emit(stats.received_objects, stats.total_objects, stats.indexed_objects, stats.received_bytes)
+
+
+class GitTask(QtCore.QRunnable):
+    """Run a git operation in a worker thread, reporting the progress with signals."""
+
+    def __init__(self, operation, *args, **kwargs):
+        """Git task constructor, the operation is called with the remote callbacks of the task as the callbacks keyword argument."""
+        super().__init__()
+        # The task is kept by its owner so it can be cancelled after it finished
+        self.setAutoDelete(False)
+        self.operation = operation
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = GitTaskSignals()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Cancel the git operation, aborting the transfer in progress."""
+        self.cancelled.set()
+
+    def run(self):
+        """Run the git operation in the worker thread."""
+        try:
+            if self.cancelled.is_set():
+                raise GitException('Transfer cancelled')
+            result = self.operation(*self.args, callbacks=GitTaskCallbacks(self.signals, self.cancelled), **self.kwargs)
+            if result is None:
+                raise GitException('Transfer cancelled' if self.cancelled.is_set() else 'Git operation failed')
+        except Exception as e:
+            Logger.warning(f'MEG UI: {e}')
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(result)
+
+
+def fetch_repository(repo_path, callbacks=None):
+    """Fetch the remotes of a local git repository."""
+    with GitManager.repository(repo_path) as repo:
+        if repo is None:
+            raise GitException(f'Could not open git repository <{repo_path}>')
+        repo.fetch_all(callbacks=callbacks)
+    return repo_path
+
+
+def pull_repository(repo_path, callbacks=None):
+    """Pull the tracked branch of a local git repository, returning the paths of the updated files."""
+    with GitManager.repository(repo_path) as repo:
+        if repo is None:
+            raise GitException(f'Could not open git repository <{repo_path}>')
+        return repo.pull(callbacks=callbacks)
@@ -1,6 +1,6 @@
 """MEG UI Manager
 """
-from PyQt5 import QtWidgets, uic
+from PyQt5 import QtCore, QtWidgets, uic
 
 from os.path import dirname
 import pkg_resources
@@ -9,6 +9,8 @@ import sys
 from meg_runtime.ui.mainmenupanel import MainMenuPanel
 from meg_runtime.ui.clonepanel import ClonePanel
 from meg_runtime.ui.repopanel import RepoPanel
+from meg_runtime.ui.gittask import GitTask, fetch_repository, pull_repository
+from meg_runtime.git import GitManager
 from meg_runtime.logger import Logger
 
 
@@ -21,9 +23,16 @@ class UIManager(QtWidgets.QStackedWidget):
         RepoPanel,
     ]
 
+    # The maximum number of git operations running at the same time
+    MAX_GIT_TASKS = 4
+
     def __init__(self, **kwargs):
         """UI manager constructor."""
         super().__init__(**kwargs)
+        # Run git operations in worker threads to keep the UI responsive
+        self.thread_pool = QtCore.QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(self.MAX_GIT_TASKS)
+        self.tasks = set()
         for panel in self.PANELS:
             self.addWidget(panel(self))
         self.change_view(MainMenuPanel)
@@ -33,11 +42,39 @@ class UIManager(QtWidgets.QStackedWidget):
         # TODO
         self.change_view(ClonePanel)
 
-    def clone(self):
-        """Clone a repository."""
-        # TODO
+    def clone(self, repo_url, depth=0, sparse_paths=None):
+        """Clone a repository in a worker thread, only the last depth commits if depth is not zero and only checking out the files matching the sparse paths if any."""
+        task = GitTask(GitManager.clone, repo_url, depth=depth, sparse_paths=sparse_paths)
+        task.signals.finished.connect(self.cloned)
+        return self.run_task(task)
+
+    def cloned(self, repo):
+        """Show the cloned repository."""
         self.change_view(RepoPanel)
 
+    def fetch(self, repo_path):
+        """Fetch the remotes of a repository in a worker thread."""
+        return self.run_task(GitTask(fetch_repository, repo_path))
+
+    def pull(self, repo_path):
+        """Pull a repository in a worker thread."""
+        return self.run_task(GitTask(pull_repository, repo_path))
+
+    def run_task(self, task):
+        """Run a git task in a worker thread, keeping the task until it finished."""
+        self.tasks.add(task)
+        task.signals.finished.connect(lambda result: self.tasks.discard(task))
+        task.signals.failed.connect(lambda message: self.tasks.discard(task))
+        self.thread_pool.start(task)
+        return task
+
+    def closeEvent(self, event):
+        """Cancel the running git tasks before closing."""
+        for task in list(self.tasks):
+            task.cancel()
+        self.thread_pool.waitForDone()
+        super().closeEvent(event)
+
     def return_to_main_menu(self):
         """Return to the main menu screen"""
         self.change_view(MainMenuPanel)
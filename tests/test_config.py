@@ -1,8 +1,87 @@
 """Runtime library unit testing for configuration"""
 
+import os
+import json
+import time
+import hashlib
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from meg_runtime import Config
 
 
+# HTTP request handler serving content with range requests
+class ContentRequestHandler(BaseHTTPRequestHandler):
+    """HTTP request handler serving content with range requests"""
+
+    # The served content by url path, the requests received, the number of requests to interrupt and to fail by url path
+    content = {}
+    requests = []
+    interrupt = 0
+    errors = {}
+
+    # Serve the content of the url path
+    def do_GET(self):
+        """Serve the content of the url path"""
+        ContentRequestHandler.requests.append((self.path, dict(self.headers)))
+        content = ContentRequestHandler.content.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        if ContentRequestHandler.errors.get(self.path, 0) > 0:
+            ContentRequestHandler.errors[self.path] -= 1
+            self.send_error(503)
+            return
+        etag = '"' + hashlib.sha256(content).hexdigest() + '"'
+        # The content is not modified if the validator matches
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        # Serve the requested range if the content is unchanged
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            if start >= len(content):
+                self.send_error(416)
+                return
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        self.send_header('Content-Length', str(len(content) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        # Interrupt the response half way through, if wanted
+        if ContentRequestHandler.interrupt > 0:
+            ContentRequestHandler.interrupt -= 1
+            self.wfile.write(content[start:start + (len(content) - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+    # Do not log requests
+    def log_message(self, format, *args):
+        """Do not log requests"""
+        pass
+
+
+# PyTest fixture to get the url of a local HTTP server serving content
+@pytest.fixture()
+def content_url():
+    """PyTest fixture to get the url of a local HTTP server serving content"""
+    ContentRequestHandler.content.clear()
+    del ContentRequestHandler.requests[:]
+    ContentRequestHandler.interrupt = 0
+    ContentRequestHandler.errors.clear()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ContentRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
 # Configuration load/save test
 def test_config_load_save():
     """Configuration load/save test"""
@@ -26,7 +105,7 @@ def test_config_set_get():
     """Configuration set/get test"""
     assert Config.set('/test/key', 'value')
     assert Config.get('/test/key') == 'value'
-    assert Config.set('test/key', '$(/test/key)value')
+    assert not Config.set('test/key', '$(/test/key)value')
     assert Config.get('/test/key') == 'value'
 
 
@@ -37,15 +116,21 @@ def test_config_set_expand():
     assert Config.set('/test/key', 'value')
     assert Config.expand('$(/test/key)') == 'value'
     # Test nested expansion
-    assert Config.set('test/key', '$(test/key)value')
-    assert Config.expand('$(test/key)') == 'value'
+    assert Config.set('test/key1', '$(test/key)value')
+    assert Config.expand('$(test/key1)') == 'valuevalue'
     # Test multiple nested expansion
-    assert Config.set('test/key1', '$(test/key3)value')
     assert Config.set('test/key2', '$(test/key1)value')
     assert Config.set('test/key3', '$(test/key2)value')
-    assert Config.expand('$(test/key1)') == 'valuevaluevalue'
-    assert Config.expand('$(test/key2)') == 'valuevaluevalue'
-    assert Config.expand('$(test/key3)') == 'valuevaluevalue'
+    assert Config.expand('$(test/key3)') == 'valuevaluevaluevalue'
+    # Test changing a referenced value expands the dependent values again
+    assert Config.set('test/key', 'other')
+    assert Config.expand('$(test/key3)') == 'othervaluevaluevalue'
+    # Test reference cycles are not allowed
+    assert not Config.set('test/key', '$(test/key)value')
+    assert not Config.set('test/key', '$(test/key3)value')
+    assert Config.expand('$(test/key3)') == 'othervaluevaluevalue'
+    assert not Config.set('test', {'key': '$(test/key2)', 'key2': '$(test/key)'})
+    assert Config.get('test/key') == 'other'
 
 
 # Configuration set/exists test
@@ -74,3 +159,381 @@ def test_config_invalid_key():
     assert not Config.set('/test/key/invalid', 'new value')
     assert not Config.set('/path/user', 'this can not be set!')
     assert not Config.set('path/config', 'this can not be set either...')
+
+
+# Configuration cached value invalidation test
+def test_config_cache_invalidation():
+    """Configuration cached value invalidation test"""
+    # Cache a value that depends on another value
+    assert Config.set('test/cache/base', 'base')
+    assert Config.set('test/cache/derived', '$(test/cache/base)/derived')
+    assert Config.get('test/cache/derived') == 'base/derived'
+    # Changing the referenced value invalidates the dependent value
+    assert Config.set('test/cache/base', 'changed')
+    assert Config.get('test/cache/derived') == 'changed/derived'
+    # Replacing a parent dictionary invalidates the values inside it
+    assert Config.set('test/cache', {'base': 'parent', 'derived': '$(test/cache/base)'})
+    assert Config.get('/test/cache/derived') == 'parent'
+    # Removing a value invalidates the cached value and the cached missing keys
+    assert Config.get('test/cache/missing', 'default') == 'default'
+    assert Config.set('test/cache/missing', 'present')
+    assert Config.get('test/cache/missing', 'default') == 'present'
+    assert Config.remove('test/cache')
+    assert Config.get('test/cache/missing', 'default') == 'default'
+    assert Config.get('test/cache/derived', 'default') == 'default'
+
+
+# Configuration reference cycle load test
+def test_config_load_cycle(tmp_path):
+    """Configuration reference cycle load test"""
+    # Save a configuration with a reference cycle
+    config_path = tmp_path / 'config.json'
+    config_path.write_text('{"test": {"cycle1": "$(test/cycle2)", "cycle2": "$(test/cycle1)", "cycle3": "value"}}')
+    # The reference cycle is reported when loading and the rejected configuration is not kept
+    assert Config.set('test/kept', 'kept')
+    assert not Config.load(str(config_path), False)
+    assert Config.get('test/cycle1', 'default') == 'default'
+    assert Config.get('test/cycle3', 'default') == 'default'
+    assert Config.get('test/kept') == 'kept'
+    assert Config.get('path/config') != str(config_path)
+    # The references of a reference cycle in other layers are expanded to nothing
+    repo_config_path = tmp_path / 'repo' / Config.REPOSITORY_CONFIG_PATH
+    repo_config_path.parent.mkdir(parents=True)
+    repo_config_path.write_text('{"test": {"cycle1": "$(test/cycle2)", "cycle2": "$(test/cycle1)"}}')
+    assert Config.load_repository(str(tmp_path / 'repo'))
+    assert Config.expand('<$(test/cycle1)>') == '<>'
+    assert Config.get('test/cycle1', exclude_keys=['test/cycle3']) == ''
+    assert Config.get('test/cycle1', 'default') == 'default'
+    assert Config.load_repository()
+    assert Config.remove('test/kept')
+    # Restore the configuration
+    assert Config.load()
+
+
+# Configuration unchanged and delayed save test
+def test_config_save_unchanged_delayed(tmp_path):
+    """Configuration unchanged and delayed save test"""
+    config_path = str(tmp_path / 'config.json')
+    # Save the configuration and save again without changes
+    assert Config.set('test/key', 'value')
+    assert Config.save(config_path)
+    mtime = os.stat(config_path).st_mtime_ns
+    assert Config.save(config_path)
+    assert os.stat(config_path).st_mtime_ns == mtime
+    assert os.listdir(str(tmp_path)) == ['config.json']
+    # The blocked keys are not saved
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    assert config['test']['key'] == 'value'
+    assert 'user' not in config['path'] and 'config' not in config['path']
+    assert Config.get('path/user') != ''
+    # Delayed saves are coalesced until the delay ends or they are flushed
+    delayed_path = str(tmp_path / 'delayed.json')
+    assert Config.save(delayed_path, delay=60)
+    assert Config.set('test/key', 'delayed value')
+    assert Config.save(delayed_path, delay=60)
+    assert not os.path.exists(delayed_path)
+    assert Config.flush()
+    with open(delayed_path) as config_file:
+        assert json.load(config_file)['test']['key'] == 'delayed value'
+    assert Config.remove('test/key')
+
+
+# Configuration lazy load test
+def test_config_load_lazy(tmp_path):
+    """Configuration lazy load test"""
+    # Save an indented configuration with several top level sections
+    config_path = str(tmp_path / 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({
+            'path': {'home': str(tmp_path)},
+            'plugins': ['test'],
+            'test': {'key': 'value', 'escaped "key"': '$(other/key)'},
+            'other': {'key': '$(test/key)/other'}
+        }, config_file, indent=2)
+    # Only the path section is parsed when loading
+    assert Config.load(config_path, lazy=True)
+    instance = Config._Config__instance
+    assert dict.__contains__(instance, 'path')
+    assert not dict.__contains__(instance, 'test')
+    assert Config.get('path/home') == str(tmp_path)
+    # Sections are parsed on first access, including referenced sections
+    assert Config.get('test/escaped "key"') == 'value/other'
+    assert dict.__contains__(instance, 'other')
+    assert not dict.__contains__(instance, 'plugins')
+    assert Config.exists('plugins')
+    assert Config.set('test/key', 'changed')
+    assert Config.get('test/escaped "key"') == 'changed/other'
+    # Saving parses the remaining sections
+    assert Config.save(config_path)
+    assert Config.load(config_path)
+    assert Config.get('plugins') == ['test']
+    assert Config.get('other/key') == 'changed/other'
+    # Restore the configuration
+    assert Config.load()
+
+
+# Configuration layers test
+def test_config_layers(tmp_path):
+    """Configuration layers test"""
+    # Write a repository configuration that overrides and references the user configuration
+    repo_config_path = tmp_path / 'repo' / Config.REPOSITORY_CONFIG_PATH
+    repo_config_path.parent.mkdir(parents=True)
+    with open(str(repo_config_path), 'w') as config_file:
+        json.dump({'test': {'key': 'repository', 'other': '$(test/user)/repository'}, 'path': {'user': 'blocked'}}, config_file)
+    assert Config.set('test/key', 'user')
+    assert Config.set('test/user', 'user')
+    assert Config.get('test/key') == 'user'
+    # The repository layer overrides the user layer and the dictionaries are merged
+    assert Config.load_repository(str(tmp_path / 'repo'))
+    assert Config.get('test/key') == 'repository'
+    assert Config.get('test/other') == 'user/repository'
+    assert Config.get('test/user') == 'user'
+    assert Config.get('path/user') != 'blocked'
+    assert Config.get_layer('user')['test']['key'] == 'user'
+    # Setting a value shadowed by the repository layer only changes the user layer
+    assert Config.set('test/key', 'changed')
+    assert Config.get('test/key') == 'repository'
+    assert Config.set('test/user', 'changed')
+    assert Config.get('test/other') == 'changed/repository'
+    # Removing the user value reveals the lower layers
+    assert Config.remove('test/user')
+    assert Config.get('test/other') == '/repository'
+    # The environment and default layers are below the user layer
+    assert Config.get('path/home') == Config.expand(Config.get_layer('defaults')['path']['home'])
+    assert Config.set('path/home', str(tmp_path))
+    assert Config.get('path/cache') == os.path.join(str(tmp_path), 'cache')
+    assert Config.remove('path/home')
+    # Unloading the repository layer reveals the user layer again
+    assert Config.load_repository()
+    assert Config.get('test/key') == 'changed'
+    assert not Config.exists('test/other')
+    assert Config.remove('test/key')
+
+
+# Configuration load without clearing test
+def test_config_load_merge(tmp_path):
+    """Configuration load without clearing test"""
+    config_path = str(tmp_path / 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({'test': {'loaded': 'value'}}, config_file)
+    # Loading without clearing merges the nested dictionaries
+    assert Config.set('test/key', 'value')
+    assert Config.load(config_path, False)
+    assert Config.get('test/key') == 'value'
+    assert Config.get('test/loaded') == 'value'
+    # Restore the configuration
+    assert Config.load()
+
+
+# Configuration environment paths test
+def test_config_environment(tmp_path, monkeypatch):
+    """Configuration environment paths test"""
+    config_path = str(tmp_path / 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({'path': {'cache': str(tmp_path / 'user'), 'user': 'blocked'}}, config_file)
+    with monkeypatch.context() as context:
+        context.setenv('MEG_CACHE_PATH', str(tmp_path / 'environment'))
+        context.setenv('MEG_PLUGINS_PATH', str(tmp_path / 'environment'))
+        context.setenv('MEG_USER_PATH', str(tmp_path))
+        assert Config.load(config_path)
+        # The user configuration overrides the paths from the environment, which override the default paths
+        assert Config.get('path/cache') == str(tmp_path / 'user')
+        assert Config.get('path/plugins') == str(tmp_path / 'environment')
+        assert Config.get('path/home') == os.path.join(str(tmp_path), '.meg')
+        # The blocked paths are only from the environment
+        assert Config.get('path/user') == str(tmp_path)
+        assert Config.get('path/config') == config_path
+        # Removing the user value reveals the path from the environment
+        assert Config.remove('path/cache')
+        assert Config.get('path/cache') == str(tmp_path / 'environment')
+    # Restore the configuration
+    assert Config.load()
+
+
+# Configuration change subscription test
+def test_config_subscribe():
+    """Configuration change subscription test"""
+    changes = []
+
+    def changed(key, value):
+        changes.append((key, value))
+    assert Config.subscribe('test/sub', changed)
+    assert Config.subscribe('test/ref', changed)
+    # Changing the key, a key it contains or a key it references notifies the subscriber
+    assert Config.set('test/sub/key', 'value')
+    assert changes == [('test/sub', {'key': 'value'})]
+    assert Config.set('test/ref', '$(test/sub/key)/ref')
+    assert changes[-1] == ('test/ref', 'value/ref')
+    assert Config.set('test/sub/key', 'changed')
+    assert ('test/ref', 'changed/ref') in changes[-2:]
+    # Changing other keys does not notify the subscriber
+    del changes[:]
+    assert Config.set('test/other', 'value')
+    assert changes == []
+    # Unsubscribed callbacks are not notified
+    assert Config.unsubscribe('test/sub', changed)
+    assert Config.unsubscribe('test/ref', changed)
+    assert not Config.unsubscribe('test/ref', changed)
+    assert Config.remove('test')
+    assert changes == []
+
+
+# Configuration reload and watch test
+def test_config_reload_watch(tmp_path):
+    """Configuration reload and watch test"""
+    config_path = str(tmp_path / 'config.json')
+    assert Config.set('test/key', 'value')
+    assert Config.set('test/other', 'value')
+    assert Config.save(config_path)
+    changes = []
+
+    def key_changed(key, value):
+        changes.append(value)
+
+    def other_changed(key, value):
+        changes.append(key)
+
+    assert Config.subscribe('test/key', key_changed)
+    assert Config.subscribe('test/other', other_changed)
+    try:
+        # Replace the configuration file like an editor would
+        def edit(value):
+            with open(config_path + '.tmp', 'w') as config_file:
+                json.dump({'test': {'key': value, 'other': 'value'}}, config_file)
+            os.replace(config_path + '.tmp', config_path)
+
+        # Reloading an unchanged file does not notify the subscribers, reloading a changed file only notifies the changed keys
+        assert Config.reload(config_path)
+        assert changes == []
+        edit('reloaded')
+        assert Config.reload(config_path)
+        assert changes == ['reloaded']
+        assert Config.get('test/key') == 'reloaded'
+        # Watch the file and wait for the change
+        assert Config.watch(config_path, 0.05)
+        try:
+            edit('watched')
+            for i in range(100):
+                if len(changes) > 1:
+                    break
+                time.sleep(0.05)
+            assert changes == ['reloaded', 'watched']
+        finally:
+            assert Config.unwatch()
+        assert Config.get('test/key') == 'watched'
+    finally:
+        assert Config.unsubscribe('test/key', key_changed)
+        assert Config.unsubscribe('test/other', other_changed)
+    # Restore the configuration
+    assert Config.load()
+
+
+# Configuration download test
+def test_config_download(tmp_path, content_url):
+    """Configuration download test"""
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    checksum = hashlib.sha256(content).hexdigest()
+    ContentRequestHandler.content['/archive.zip'] = content
+    download_path = str(tmp_path / 'archive.zip')
+    # Download the content with progress
+    progress = []
+    assert Config.download(content_url + '/archive.zip', download_path, checksum=checksum, progress=lambda size, total: progress.append((size, total)), cache=False) == download_path
+    with open(download_path, 'rb') as download_file:
+        assert download_file.read() == content
+    assert progress[0] == (0, len(content)) and progress[-1] == (len(content), len(content))
+    assert sorted(os.listdir(str(tmp_path))) == ['archive.zip']
+    # An interrupted download is resumed from the partial download
+    os.remove(download_path)
+    ContentRequestHandler.interrupt = 1
+    assert Config.download(content_url + '/archive.zip', download_path, checksum=checksum, cache=False) is None
+    part_size = os.path.getsize(download_path + '.part')
+    assert 0 < part_size < len(content)
+    assert Config.download(content_url + '/archive.zip', download_path, checksum='sha256:' + checksum, cache=False) == download_path
+    assert ContentRequestHandler.requests[-1][1]['Range'] == f'bytes={part_size}-'
+    with open(download_path, 'rb') as download_file:
+        assert download_file.read() == content
+    # A download with a different checksum or an error status fails without leaving any file
+    os.remove(download_path)
+    assert Config.download(content_url + '/archive.zip', download_path, checksum='0' * 64, cache=False) is None
+    assert Config.download(content_url + '/missing.zip', str(tmp_path / 'missing.zip'), cache=False) is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+# Configuration download cache test
+def test_config_download_cache(tmp_path, content_url):
+    """Configuration download cache test"""
+    content = os.urandom(1024 * 1024)
+    ContentRequestHandler.content['/archive.zip'] = content
+    ContentRequestHandler.content['/mirror/archive.zip'] = content
+    assert Config.set('path/download_cache', str(tmp_path / 'cache'))
+    assert Config.set('path/downloads', str(tmp_path / 'downloads'))
+    os.makedirs(str(tmp_path / 'downloads'))
+    try:
+        # Download the content to the cache and link it to the download path
+        download_path = Config.download(content_url + '/archive.zip')
+        assert download_path == str(tmp_path / 'downloads' / 'archive.zip')
+        with open(download_path, 'rb') as download_file:
+            assert download_file.read() == content
+        # Downloading again only validates the cached content and reuses the download path with the same content
+        assert Config.download(content_url + '/archive.zip') == download_path
+        assert ContentRequestHandler.requests[-1][1]['If-None-Match'] == '"' + hashlib.sha256(content).hexdigest() + '"'
+        assert os.listdir(str(tmp_path / 'downloads')) == ['archive.zip']
+        # Content with a known checksum is not requested at all, even from another url
+        count = len(ContentRequestHandler.requests)
+        other_path = str(tmp_path / 'other.zip')
+        assert Config.download(content_url + '/mirror/archive.zip', other_path, checksum=hashlib.sha256(content).hexdigest()) == other_path
+        assert len(ContentRequestHandler.requests) == count
+        assert os.path.samefile(download_path, other_path)
+        # Changed content is downloaded again and a unique download path is used
+        ContentRequestHandler.content['/archive.zip'] = content[::-1]
+        assert Config.download(content_url + '/archive.zip') == str(tmp_path / 'downloads' / 'archive-1.zip')
+        with open(str(tmp_path / 'downloads' / 'archive-1.zip'), 'rb') as download_file:
+            assert download_file.read() == content[::-1]
+        # The least recently used content is evicted when the cache is too large
+        assert Config.set('download/cache_size', len(content))
+        assert Config.download(content_url + '/mirror/archive.zip', str(tmp_path / 'mirror.zip'))
+        with open(str(tmp_path / 'cache' / 'index.json')) as index_file:
+            assert list(json.load(index_file)['objects']) == [hashlib.sha256(content).hexdigest()]
+    finally:
+        assert Config.remove('download')
+        assert Config.remove('path/download_cache')
+        assert Config.remove('path/downloads')
+
+
+# Configuration concurrent download test
+def test_config_download_all(tmp_path, content_url):
+    """Configuration concurrent download test"""
+    urls = []
+    for i in range(20):
+        ContentRequestHandler.content[f'/{i}/archive.zip'] = os.urandom(64 * 1024) + bytes([i])
+        urls.append(content_url + f'/{i}/archive.zip')
+    # Temporary server errors are retried but missing content is not
+    ContentRequestHandler.errors['/0/archive.zip'] = 2
+    urls.append(content_url + '/missing.zip')
+    assert Config.set('path/download_cache', str(tmp_path / 'cache'))
+    try:
+        completed = []
+        paths = Config.download_all(urls + urls[:1], str(tmp_path), completed=lambda url, path: completed.append(url), retries=2, backoff=0.01)
+        assert len(paths) == len(urls) + 1 and paths[0] == paths[-1]
+        assert sorted(completed) == sorted(urls)
+        assert paths[-2] is None
+        assert len([request for request in ContentRequestHandler.requests if request[0] == '/missing.zip']) == 1
+        # Each download has a unique path even though the urls have the same file name
+        assert len(set(paths[:-2])) == 20
+        for i, path in enumerate(paths[:-2]):
+            with open(path, 'rb') as download_file:
+                assert download_file.read() == ContentRequestHandler.content[f'/{i}/archive.zip']
+        # File names without suffix are made unique in the download directory
+        for name in ['a', 'b', 'c']:
+            ContentRequestHandler.content[f'/{name}/master'] = name.encode()
+        os.makedirs(str(tmp_path / 'master'))
+        paths = Config.download_all([content_url + f'/{name}/master' for name in ['a', 'b', 'c']], str(tmp_path / 'master'))
+        assert sorted(paths) == [str(tmp_path / 'master' / name) for name in ['master', 'master-1', 'master-2']]
+        assert sorted(open(path, 'rb').read() for path in paths) == [b'a', b'b', b'c']
+        # A url ending with a slash is named after its last path segment and a url without any name is not downloaded
+        ContentRequestHandler.content['/a/'] = b'a'
+        assert Config.download_all([content_url + '/a/', 'file:///'], str(tmp_path / 'master')) == [str(tmp_path / 'master' / 'a'), None]
+        assert Config.download('file:///') is None
+    finally:
+        assert Config.remove('path/download_cache')
@@ -3,11 +3,16 @@
 import os
 import time
 import shutil
+import socket
+import threading
+import subprocess
 import tempfile
 import pytest
+import pygit2
 from dateutil.tz import gettz
 from datetime import datetime
-from meg_runtime import GitRepository, GitManager, Logger
+from meg_runtime import Config, GitRepository, GitException, GitManager, LockingManager, Logger
+from meg_runtime.git.repository import SHALLOW_SUPPORTED
 
 
 # PyTest session fixture to get temporary path for git repo tests
@@ -94,3 +99,276 @@ def test_git_init(temp_repo_path):
     assert repo is not None
     assert not repo.is_bare
     assert repo.is_empty
+
+
+# Commit files in the working tree of a repository and push the commit
+def commit_and_push(repo, files, message, push=True):
+    """Commit files in the working tree of a repository and push the commit"""
+    for path, content in files.items():
+        if content is None:
+            os.remove(os.path.join(repo.workdir, path))
+            repo.index.remove(path)
+        else:
+            os.makedirs(os.path.dirname(os.path.join(repo.workdir, path)), exist_ok=True)
+            with open(os.path.join(repo.workdir, path), 'wb') as file:
+                file.write(content)
+            repo.index.add(path)
+    repo.index.write()
+    signature = pygit2.Signature('test', 'test@localhost')
+    repo.create_commit('HEAD', signature, signature, message, repo.index.write_tree(), [repo.head.target])
+    if push:
+        repo.remotes['origin'].push([repo.head.name])
+
+
+# Test pulling a repository
+def test_git_pull(temp_repo_path):
+    # Create a remote with two clones
+    remote = pygit2.init_repository(os.path.join(temp_repo_path, 'remote.git'), bare=True)
+    signature = pygit2.Signature('test', 'test@localhost')
+    builder = remote.TreeBuilder()
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        builder.insert(name, remote.create_blob(name.encode()), pygit2.GIT_FILEMODE_BLOB)
+    remote.create_commit('HEAD', signature, signature, 'Initial commit', builder.write(), [])
+    alice = GitRepository(os.path.join(temp_repo_path, 'alice'), remote.path)
+    bob = GitRepository(os.path.join(temp_repo_path, 'bob'), remote.path)
+    # Pulling without remote changes does nothing
+    assert bob.pull() == []
+    # Pulling fast-forwards and only writes the changed files
+    commit_and_push(alice, {'a.txt': b'alice', 'c.txt': None, 'dir/d.txt': b'd'}, 'Change files')
+    unchanged = os.stat(os.path.join(bob.workdir, 'b.txt')).st_mtime_ns
+    assert sorted(bob.pull()) == ['a.txt', 'c.txt', 'dir/d.txt']
+    assert bob.head.target == alice.head.target
+    assert open(os.path.join(bob.workdir, 'a.txt'), 'rb').read() == b'alice'
+    assert open(os.path.join(bob.workdir, 'dir', 'd.txt'), 'rb').read() == b'd'
+    assert not os.path.exists(os.path.join(bob.workdir, 'c.txt'))
+    assert os.stat(os.path.join(bob.workdir, 'b.txt')).st_mtime_ns == unchanged
+    assert not bob.status()
+    # Pulling diverged branches merges them
+    commit_and_push(alice, {'a.txt': b'alice again'}, 'Change a')
+    commit_and_push(bob, {'b.txt': b'bob'}, 'Change b', push=False)
+    local = bob.head.target
+    assert bob.pull() == ['a.txt']
+    merge = bob[bob.head.target]
+    assert merge.parent_ids == [local, alice.head.target]
+    assert open(os.path.join(bob.workdir, 'a.txt'), 'rb').read() == b'alice again'
+    assert open(os.path.join(bob.workdir, 'b.txt'), 'rb').read() == b'bob'
+    assert not bob.status()
+    # Pulling conflicting changes leaves the working tree and branch as they were
+    commit_and_push(alice, {'b.txt': b'alice'}, 'Change b')
+    commit_and_push(bob, {'b.txt': b'bob again'}, 'Change b again', push=False)
+    local = bob.head.target
+    with pytest.raises(GitException):
+        bob.pull()
+    assert bob.head.target == local
+    assert open(os.path.join(bob.workdir, 'b.txt'), 'rb').read() == b'bob again'
+    assert not bob.status()
+
+
+# Test pulling a repository with the files of the runtime
+def test_git_pull_locks(temp_repo_path):
+    remote = pygit2.init_repository(os.path.join(temp_repo_path, 'remote.git'), bare=True)
+    signature = pygit2.Signature('test', 'test@localhost')
+    builder = remote.TreeBuilder()
+    builder.insert('a.txt', remote.create_blob(b'a'), pygit2.GIT_FILEMODE_BLOB)
+    remote.create_commit('HEAD', signature, signature, 'Initial commit', builder.write(), [])
+    alice = GitRepository(os.path.join(temp_repo_path, 'alice'), remote.path)
+    bob = GitRepository(os.path.join(temp_repo_path, 'bob'), remote.path)
+    cwd = os.getcwd()
+    try:
+        # Locking and pulling a repository
+        os.chdir(alice.workdir)
+        LockingManager._LockingManager__instance = None
+        assert LockingManager.addLock('a.txt', 'alice')
+        commit_and_push(bob, {'b.txt': b'b'}, 'Add b')
+        assert alice.pull() == ['b.txt']
+        assert LockingManager.findLock('a.txt')['user'] == 'alice'
+        # The changed lockfile is kept when pulling a branch that also has a lockfile
+        with open(os.path.join(alice.workdir, '.meg', 'locks.json'), 'rb') as lock_file:
+            locks = lock_file.read()
+        commit_and_push(bob, {'.meg/locks.json': b'{"locks": {}}', 'c.txt': b'c'}, 'Add lockfile')
+        assert alice.pull() == ['c.txt']
+        with open(os.path.join(alice.workdir, '.meg', 'locks.json'), 'rb') as lock_file:
+            assert lock_file.read() == locks
+        # Conflicting changes of the lockfile are merged with the remote version and the local lockfile is kept
+        commit_and_push(bob, {'.meg/locks.json': b'{"locks": {"b.txt": {"user": "bob", "date": 0}}}'}, 'Change lockfile')
+        commit_and_push(alice, {'.meg/locks.json': b'{"locks": {}}', 'a.txt': b'alice'}, 'Change lockfile', push=False)
+        with open(os.path.join(alice.workdir, '.meg', 'locks.json'), 'wb') as lock_file:
+            lock_file.write(locks)
+        assert alice.pull() == []
+        assert alice[alice.head.target].tree['.meg/locks.json'].id == bob[bob.head.target].tree['.meg/locks.json'].id
+        with open(os.path.join(alice.workdir, '.meg', 'locks.json'), 'rb') as lock_file:
+            assert lock_file.read() == locks
+        assert LockingManager.findLock('a.txt')['user'] == 'alice'
+    finally:
+        os.chdir(cwd)
+        LockingManager._LockingManager__instance = None
+
+
+# Test fetching the remotes of many repositories
+def test_git_fetch_all(temp_repo_path):
+    # Create remotes with clones and push a commit to each remote from another clone
+    signature = pygit2.Signature('test', 'test@localhost')
+    paths = []
+    for i in range(4):
+        remote = pygit2.init_repository(os.path.join(temp_repo_path, f'remote{i}.git'), bare=True)
+        builder = remote.TreeBuilder()
+        builder.insert('README.md', remote.create_blob(b'readme'), pygit2.GIT_FILEMODE_BLOB)
+        remote.create_commit('HEAD', signature, signature, 'Initial commit', builder.write(), [])
+        paths.append(GitRepository(os.path.join(temp_repo_path, f'clone{i}'), remote.path).workdir)
+        other = GitRepository(os.path.join(temp_repo_path, f'other{i}'), remote.path)
+        commit_and_push(other, {'file.txt': f'file{i}'.encode()}, 'Add file')
+    # Each repository is fetched with its own result
+    completed = []
+    progress = []
+    missing = os.path.join(temp_repo_path, 'missing')
+    results = GitManager.fetch_all(paths + [missing], timeout=60, progress=lambda *args: progress.append(args),
+                                   completed=lambda path, result: completed.append(path))
+    assert [result if result is None else list(result) for result in results] == [['origin']] * 4 + [None]
+    assert all(result['origin'] > 0 for result in results[:4])
+    assert sorted(completed) == sorted(paths + [missing])
+    assert set(args[0] for args in progress) == set(paths)
+    for i, path in enumerate(paths):
+        repo = GitRepository(path)
+        assert repo.read_file(repo.branch_commit('origin', repo.head.shorthand), 'file.txt') == f'file{i}'.encode()
+    # Fetching again receives nothing new and reuses the pooled repositories
+    GitManager.free_pool()
+    assert GitManager.fetch_all(paths) == [{'origin': 0}] * 4
+    assert GitManager.pool_stats() == {'idle': 4, 'acquired': 0}
+    GitManager.free_pool()
+
+
+# Test the pool of open repositories
+def test_git_pool(temp_repo_path):
+    repo_path = os.path.join(temp_repo_path, 'repo')
+    GitManager.init(repo_path)
+    GitManager.free_pool()
+    # Repositories acquired at the same time are different and released repositories are acquired again
+    first = GitManager.acquire(repo_path)
+    second = GitManager.acquire(os.path.join(repo_path, '.git') + os.sep)
+    assert first is not None and second is not None and first is not second
+    assert GitManager.pool_stats() == {'idle': 0, 'acquired': 2}
+    GitManager.release(first)
+    GitManager.release(second)
+    assert GitManager.pool_stats() == {'idle': 2, 'acquired': 0}
+    with GitManager.repository(os.path.join(repo_path, '..', 'repo')) as repo:
+        assert repo is second
+        assert GitManager.pool_stats() == {'idle': 1, 'acquired': 1}
+    # Repositories that cannot be opened are not pooled
+    assert GitManager.acquire(os.path.join(temp_repo_path, 'missing')) is None
+    # The least recently used idle repositories beyond the pool size are evicted
+    other_path = os.path.join(temp_repo_path, 'other')
+    GitManager.init(other_path)
+    Config.set('git/pool_size', 1)
+    try:
+        other = GitManager.acquire(other_path)
+        GitManager.release(other)
+        assert GitManager.pool_stats() == {'idle': 1, 'acquired': 0}
+        assert GitManager.acquire(other_path) is other
+        GitManager.release(other)
+        repo = GitManager.acquire(repo_path)
+        assert repo is not first and repo is not second
+        GitManager.release(repo)
+        assert GitManager.pool_stats() == {'idle': 1, 'acquired': 0}
+    finally:
+        Config.remove('git/pool_size')
+        GitManager.free_pool()
+    # Each thread uses a different repository at the same time
+    in_use = set()
+    failures = []
+
+    def use_pool():
+        for i in range(50):
+            with GitManager.repository(repo_path) as repo:
+                if id(repo) in in_use:
+                    failures.append(repo)
+                in_use.add(id(repo))
+                time.sleep(0)
+                in_use.remove(id(repo))
+    threads = [threading.Thread(target=use_pool) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures
+    assert GitManager.pool_stats()['acquired'] == 0
+    GitManager.free_pool()
+
+
+# PyTest fixture to serve the repositories of a temporary path with git daemon
+@pytest.fixture()
+def git_daemon(temp_repo_path):
+    """PyTest fixture to serve the repositories of a temporary path with git daemon since the local transport cannot fetch shallow history"""
+    if shutil.which('git') is None:
+        pytest.skip('git is not installed')
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    daemon = subprocess.Popen(['git', 'daemon', '--export-all', '--reuseaddr', f'--base-path={temp_repo_path}',
+                               '--listen=127.0.0.1', f'--port={port}', temp_repo_path], stderr=subprocess.DEVNULL)
+    # Wait for the daemon to listen
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    yield f'git://127.0.0.1:{port}'
+    daemon.terminate()
+    daemon.wait()
+
+
+# Create a remote with a history of changes to files in two directories
+def create_history(temp_repo_path, commits=3):
+    """Create a remote with a history of changes to files in two directories"""
+    remote = pygit2.init_repository(os.path.join(temp_repo_path, 'remote.git'), bare=True)
+    signature = pygit2.Signature('test', 'test@localhost')
+    parents = []
+    for i in range(commits):
+        builder = remote.TreeBuilder()
+        for directory in ['models', 'textures']:
+            subtree = remote.TreeBuilder()
+            subtree.insert('part.bin', remote.create_blob(f'{directory}{i}'.encode()), pygit2.GIT_FILEMODE_BLOB)
+            builder.insert(directory, subtree.write(), pygit2.GIT_FILEMODE_TREE)
+        parents = [remote.create_commit('HEAD', signature, signature, f'Commit {i}', builder.write(), parents)]
+    return remote
+
+
+# Test shallow clones
+@pytest.mark.skipif(not SHALLOW_SUPPORTED, reason='pygit2 does not support shallow clones')
+def test_git_clone_shallow(temp_repo_path, git_daemon):
+    create_history(temp_repo_path)
+    # A shallow clone only has the last commits
+    repo = GitManager.clone(f'{git_daemon}/remote.git', os.path.join(temp_repo_path, 'shallow'), depth=1)
+    assert repo is not None and repo.is_shallow
+    assert len(list(repo.walk(repo.head.target))) == 1
+    # A shallow clone can also be sparse
+    repo = GitManager.clone(f'{git_daemon}/remote.git', os.path.join(temp_repo_path, 'sparse'), depth=2, sparse_paths=['models'])
+    assert repo is not None and repo.is_shallow
+    assert len(list(repo.walk(repo.head.target))) == 2
+    assert not os.path.exists(os.path.join(repo.workdir, 'textures'))
+
+
+# Test sparse clones
+def test_git_clone_sparse(temp_repo_path):
+    remote = create_history(temp_repo_path)
+    # A sparse clone only checks out the matching files while tracking every file
+    repo = GitManager.clone(remote.path, os.path.join(temp_repo_path, 'sparse'), sparse_paths=['models'])
+    assert repo is not None
+    assert repo.head.target == remote.head.target
+    assert repo.sparse_paths() == ['models']
+    assert repo.upstream() == ('origin', repo.head.shorthand)
+    assert open(os.path.join(repo.workdir, 'models', 'part.bin'), 'rb').read() == b'models2'
+    assert not os.path.exists(os.path.join(repo.workdir, 'textures'))
+    assert repo.index['textures/part.bin'].id == remote[remote.head.target].tree['textures/part.bin'].id
+    assert repo.status() == {'textures/part.bin': pygit2.GIT_STATUS_WT_DELETED}
+    # Pulling a sparse clone only writes the matching files and tracks the other files
+    other = GitRepository(os.path.join(temp_repo_path, 'other'), remote.path)
+    commit_and_push(other, {'models/part.bin': b'models3', 'textures/part.bin': b'textures3'}, 'Commit 3')
+    assert repo.pull() == ['models/part.bin']
+    assert open(os.path.join(repo.workdir, 'models', 'part.bin'), 'rb').read() == b'models3'
+    assert not os.path.exists(os.path.join(repo.workdir, 'textures'))
+    assert repo.index['textures/part.bin'].id == other.head.peel().tree['textures/part.bin'].id
+    assert repo.status() == {'textures/part.bin': pygit2.GIT_STATUS_WT_DELETED}
+    # Cloning a missing branch fails without leaving the repository
+    assert GitManager.clone(remote.path, os.path.join(temp_repo_path, 'missing'), checkout_branch='missing', sparse_paths=['models']) is None
+    assert not os.path.exists(os.path.join(temp_repo_path, 'missing'))
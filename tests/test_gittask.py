@@ -0,0 +1,78 @@
+"""Runtime library unit testing for git tasks of the UI"""
+
+import os
+import shutil
+import tempfile
+import pytest
+import pygit2
+from PyQt5 import QtCore
+from meg_runtime import GitManager
+from meg_runtime.ui.gittask import GitTask, fetch_repository, pull_repository
+
+
+# PyTest fixture to get a Qt application with a temporary path containing a remote repository
+@pytest.fixture()
+def temp_remote():
+    """PyTest fixture to get a Qt application with a temporary path containing a remote repository"""
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    temp_path = tempfile.mkdtemp()
+    # Create a remote with many files to transfer
+    remote = pygit2.init_repository(os.path.join(temp_path, 'remote.git'), bare=True)
+    signature = pygit2.Signature('test', 'test@localhost')
+    builder = remote.TreeBuilder()
+    for i in range(2000):
+        builder.insert(f'part{i}.dwg', remote.create_blob(f'part{i}'.encode() * 100), pygit2.GIT_FILEMODE_BLOB)
+    remote.create_commit('HEAD', signature, signature, 'Initial commit', builder.write(), [])
+    yield app, temp_path, remote
+    shutil.rmtree(temp_path, True)
+
+
+# Run a git task in a thread pool and wait for the task to finish
+def run_task(task):
+    """Run a git task in a thread pool and wait for the task to finish, returning the results, failures and progress signals"""
+    signals = {'finished': [], 'failed': [], 'progress': []}
+    loop = QtCore.QEventLoop()
+    task.signals.progress.connect(lambda *args: signals['progress'].append(args))
+    task.signals.finished.connect(lambda result: (signals['finished'].append(result), loop.quit()))
+    task.signals.failed.connect(lambda message: (signals['failed'].append(message), loop.quit()))
+    pool = QtCore.QThreadPool()
+    pool.start(task)
+    loop.exec_()
+    pool.waitForDone()
+    return signals
+
+
+# Test cloning in a worker thread
+def test_gittask_clone(temp_remote):
+    app, temp_path, remote = temp_remote
+    signals = run_task(GitTask(GitManager.clone, f'file://{remote.path}', os.path.join(temp_path, 'clone')))
+    assert not signals['failed']
+    repo = signals['finished'][0]
+    assert repo.head.target == remote.head.target
+    assert os.path.exists(os.path.join(repo.workdir, 'part1999.dwg'))
+    # The progress is reported on the thread of the receiver until every object is indexed
+    received_objects, total_objects, indexed_objects, received_bytes = signals['progress'][-1]
+    assert received_objects == total_objects == indexed_objects == 2002
+    assert received_bytes > 0
+    # Fetching and pulling a repository without changes
+    assert run_task(GitTask(fetch_repository, repo.workdir))['finished'] == [repo.workdir]
+    assert run_task(GitTask(pull_repository, repo.workdir))['finished'] == [[]]
+    assert run_task(GitTask(pull_repository, os.path.join(temp_path, 'missing')))['failed']
+
+
+# Test cancelling a clone in a worker thread
+def test_gittask_cancel(temp_remote):
+    app, temp_path, remote = temp_remote
+    # A task cancelled before running does not clone
+    path = os.path.join(temp_path, 'cancelled')
+    task = GitTask(GitManager.clone, remote.path, path)
+    task.cancel()
+    assert run_task(task)['failed'] == ['Transfer cancelled']
+    assert not os.path.exists(path)
+    # Cancelling a running task aborts the transfer
+    task = GitTask(GitManager.clone, f'file://{remote.path}', path)
+    task.signals.progress.connect(lambda *args: task.cancel(), QtCore.Qt.DirectConnection)
+    signals = run_task(task)
+    assert signals['failed'] == ['Transfer cancelled']
+    assert len(signals['progress']) == 1
+    assert not os.path.exists(path)
@@ -0,0 +1,135 @@
+import pytest
+import os
+import stat
+import shutil
+import tempfile
+import socket
+import subprocess
+import socketserver
+import sys
+import threading
+from meg_runtime.locking import LockingManager
+from meg_runtime.locking.daemon import LockDaemon, LockClient, LockSnapshot
+
+pytestmark = pytest.mark.skipif(not hasattr(socketserver, "ThreadingUnixStreamServer"),
+                                reason="Lock daemon requires Unix domain sockets")
+
+
+@pytest.fixture()
+def generateDaemon():
+    tempPath = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempPath)
+    LockingManager._LockingManager__instance = None
+    LockingManager.addLocks(["project/jeffsPart.dwg", "project/é.dwg"], "jeff")
+    daemon = LockDaemon(60)
+    assert daemon.start()
+    yield daemon
+    daemon.stop()
+    os.chdir(cwd)
+    LockingManager._LockingManager__instance = None
+    shutil.rmtree(tempPath, True)
+
+
+def test_runtimeDirectory(generateDaemon):
+    # The socket and snapshot are only accessible by the user
+    directory = LockDaemon.runtimeDirectory()
+    assert os.path.dirname(LockDaemon.socketPath()) == directory
+    assert os.path.dirname(LockDaemon.snapshotPath()) == directory
+    status = os.lstat(directory)
+    assert stat.S_ISDIR(status.st_mode)
+    assert status.st_uid == os.getuid()
+    assert status.st_mode & 0o077 == 0
+
+
+def test_runtimeDirectoryShared(monkeypatch):
+    runtimePath = tempfile.mkdtemp()
+    monkeypatch.setenv("XDG_RUNTIME_DIR", runtimePath)
+    # A directory accessible by other users is not used
+    os.mkdir(os.path.join(runtimePath, "meg-locks"), 0o777)
+    os.chmod(os.path.join(runtimePath, "meg-locks"), 0o777)
+    assert LockDaemon.runtimeDirectory() is None
+    assert LockDaemon.socketPath() is None
+    assert not LockDaemon().start()
+    os.rmdir(os.path.join(runtimePath, "meg-locks"))
+    assert LockDaemon.runtimeDirectory() == os.path.join(runtimePath, "meg-locks")
+    shutil.rmtree(runtimePath, True)
+
+
+def test_snapshot(generateDaemon):
+    snapshot = LockSnapshot(LockDaemon.snapshotPath())
+    assert len(snapshot) == 2
+    assert snapshot.findLock("project/jeffsPart.dwg") == LockingManager.findLock("project/jeffsPart.dwg")
+    assert snapshot.findLock("project/é.dwg")["user"] == "jeff"
+    assert snapshot.findLock("project/other.dwg") is None
+    assert snapshot.findLock("") is None
+    snapshot.close()
+
+
+def test_staleSnapshot(generateDaemon):
+    client = LockClient()
+    assert client.findLock("project/jeffsPart.dwg")["user"] == "jeff"
+    # A daemon that crashed leaves a snapshot that is no longer updated
+    generateDaemon.stop()
+    LockingManager.addLock("project/ghost.dwg", "bob")
+    LockSnapshot.write(LockDaemon.snapshotPath(), LockingManager._LockingManager__instance._lockFile, 1)
+    LockingManager.removeLock("project/ghost.dwg", "bob")
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    with open(LockDaemon.snapshotPath(), 'r+b') as snapshotFile:
+        header = list(LockSnapshot.HEADER.unpack(snapshotFile.read(LockSnapshot.HEADER.size)))
+        header[-1] = process.pid
+        snapshotFile.seek(0)
+        snapshotFile.write(LockSnapshot.HEADER.pack(*header))
+    # The snapshot of a daemon that is not running is not trusted
+    assert not LockSnapshot(LockDaemon.snapshotPath()).available()
+    assert client.findLock("project/ghost.dwg") is None
+    assert client.findLock("project/jeffsPart.dwg")["user"] == "jeff"
+    client.close()
+
+
+def test_client(generateDaemon):
+    # Only one daemon can serve a repository
+    assert not LockDaemon().start()
+    client = LockClient()
+    assert client.addLock("project/bobsPart.dwg", "bob", 60)
+    assert not client.addLock("project/jeffsPart.dwg", "bob")
+    # Changes are published before the daemon responds
+    assert client.findLock("project/bobsPart.dwg")["user"] == "bob"
+    assert "expires" in client.findLock("project/bobsPart.dwg")
+    assert client.findUserLocks("jeff") == ["project/jeffsPart.dwg", "project/é.dwg"]
+    assert client.removeLock("project/bobsPart.dwg", "bob")
+    assert client.findLock("project/bobsPart.dwg") is None
+    # Operations are run by this process if the daemon is not running
+    generateDaemon.stop()
+    assert client.findLock("project/jeffsPart.dwg")["user"] == "jeff"
+    assert client.addLock("project/bobsPart.dwg", "bob")
+    client.close()
+
+
+def test_clientNoResponse(generateDaemon):
+    generateDaemon.stop()
+    # A daemon that stops after receiving a request may have run it, so the request is not run again by the client
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(LockDaemon.socketPath())
+    server.listen(1)
+
+    def receive():
+        connection, _ = server.accept()
+        with connection, connection.makefile('rb') as stream:
+            stream.readline()
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    try:
+        client = LockClient()
+        assert client.addLock("project/bobsPart.dwg", "bob") is None
+        assert LockingManager.findLock("project/bobsPart.dwg") is None
+        thread.join()
+        # The client runs operations itself once the daemon can not be connected to
+        server.close()
+        os.remove(LockDaemon.socketPath())
+        assert client.addLock("project/bobsPart.dwg", "bob")
+        client.close()
+    finally:
+        server.close()
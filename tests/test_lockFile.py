@@ -1,5 +1,6 @@
 import pytest
 import os
+import time
 from meg_runtime.locking.lockFile import LockFile
 
 
@@ -9,6 +10,8 @@ def generateLockfile():
     tempFile = LockFile(fileName)
     yield fileName
     os.remove(fileName)
+    if os.path.exists(fileName + LockFile.JOURNAL_SUFFIX):
+        os.remove(fileName + LockFile.JOURNAL_SUFFIX)
     os.rmdir(".meg")
 
 @pytest.fixture()
@@ -52,4 +55,119 @@ def test_findLock(generateLockfile):
     lock["project/jeffs2ndPart.dwg"] = "bob"
     entry = lock["project/jeffs2ndPart.dwg"]
     assert entry["user"] == "bob"
-    
\ No newline at end of file
+    
+def test_indexedLocks(generateLockfile):
+    lock = LockFile(generateLockfile)
+    lock["project/jeffsPart.dwg"] = "jeff"
+    lock["project/parts/bobsPart.dwg"] = "bob"
+    lock["project-old/part.dwg"] = "bob"
+    lock["assets"] = "jeff"
+    assert list(lock.prefixLocks("project")) == ["project-old/part.dwg", "project/jeffsPart.dwg", "project/parts/bobsPart.dwg"]
+    assert list(lock.descendantLocks("project/")) == ["project/jeffsPart.dwg", "project/parts/bobsPart.dwg"]
+    assert lock.hasDescendantLock("project/parts")
+    assert not lock.hasDescendantLock("project/part")
+    assert lock.ancestorLock("assets/textures/wood.png") == ("assets", lock["assets"])
+    assert lock.ancestorLock("project/parts/bobsPart.dwg") is None
+    assert lock.userLocks("bob") == ["project-old/part.dwg", "project/parts/bobsPart.dwg"]
+    lock["project-old/part.dwg"] = "jeff"
+    del lock["project/parts/bobsPart.dwg"]
+    assert lock.userLocks("bob") == []
+    assert not lock.hasDescendantLock("project/parts")
+    lock.save()
+    lock.load()
+    assert lock.userLocks("jeff") == ["assets", "project-old/part.dwg", "project/jeffsPart.dwg"]
+
+def test_changeTracking(generateLockfile):
+    lock = LockFile(generateLockfile)
+    lock["project/jeffsPart.dwg"] = "jeff"
+    lock.save()
+    status = os.stat(generateLockfile)
+    lockData = lock._lockData
+    # Saving and loading without changes does not write or read the file
+    lock.save()
+    lock.load()
+    assert os.stat(generateLockfile).st_mtime_ns == status.st_mtime_ns
+    assert lock._lockData is lockData
+    # Loading after the file is changed reads the changes
+    other = LockFile(generateLockfile)
+    other["project/bobsPart.dwg"] = "bob"
+    other.save()
+    lock.load()
+    assert lock["project/bobsPart.dwg"]["user"] == "bob"
+    # Saving without changes after the file is changed keeps and reads the changes
+    other["project/samsPart.dwg"] = "sam"
+    other.save()
+    lock.save()
+    assert LockFile(generateLockfile)["project/samsPart.dwg"]["user"] == "sam"
+    assert lock["project/samsPart.dwg"]["user"] == "sam"
+    # Loading with unsaved changes discards them
+    lock["project/other.dwg"] = "jeff"
+    lock.load()
+    assert lock["project/other.dwg"] is None
+
+
+def test_journal(generateLockfile):
+    journalPath = generateLockfile + LockFile.JOURNAL_SUFFIX
+    lock = LockFile(generateLockfile, True)
+    lock["project/jeffsPart.dwg"] = "jeff"
+    lock.save()
+    status = os.stat(generateLockfile)
+    # Changes are appended to the journal without rewriting the lockfile
+    lock["project/bobsPart.dwg"] = "bob"
+    del lock["project/jeffsPart.dwg"]
+    lock.save()
+    assert os.stat(generateLockfile).st_mtime_ns == status.st_mtime_ns
+    with open(journalPath) as journalFile:
+        assert len(journalFile.readlines()) == 3
+    # Loading replays the journal over the lockfile
+    other = LockFile(generateLockfile, True)
+    assert other._lockData == lock._lockData
+    assert other.userLocks("bob") == ["project/bobsPart.dwg"]
+    # Reloading replays only the appended records
+    other["project/samsPart.dwg"] = "sam"
+    other.save()
+    lockData = lock._lockData
+    lock.load()
+    assert lock._lockData is lockData
+    assert lock["project/samsPart.dwg"]["user"] == "sam"
+    # Compaction writes the locks into the lockfile and empties the journal
+    lock.JOURNAL_COMPACT_RECORDS = 2
+    lock["project/newPart.dwg"] = "jeff"
+    lock.save()
+    assert os.stat(generateLockfile).st_mtime_ns != status.st_mtime_ns
+    assert os.path.getsize(journalPath) == 0
+    assert LockFile(generateLockfile)._lockData == lock._lockData
+    assert LockFile(generateLockfile, True)._lockData == lock._lockData
+    # A partially written last record is ignored
+    with open(journalPath, 'a') as journalFile:
+        journalFile.write('["lock", "project/torn')
+    assert LockFile(generateLockfile, True)._lockData == lock._lockData
+
+
+def test_expiry(generateLockfile):
+    lock = LockFile(generateLockfile, True)
+    lock.lock("project/jeffsPart.dwg", "jeff", 10)
+    lock.lock("project/bobsPart.dwg", "bob", 5)
+    lock["project/samsPart.dwg"] = "sam"
+    # The next lock to expire is found in expiry order
+    assert lock.nextExpiry()[1] == "project/bobsPart.dwg"
+    assert not lock.expired("project/bobsPart.dwg")
+    assert lock.expired("project/bobsPart.dwg", time.time() + 5)
+    # Renewing and removing locks updates the next lock to expire
+    assert lock.renew("project/bobsPart.dwg", 20)
+    assert lock.nextExpiry()[1] == "project/jeffsPart.dwg"
+    del lock["project/jeffsPart.dwg"]
+    assert lock.nextExpiry()[1] == "project/bobsPart.dwg"
+    assert not lock.renew("project/jeffsPart.dwg", 20)
+    # Lease expiry times are saved and loaded
+    lock.save()
+    assert LockFile(generateLockfile, True)._lockData == lock._lockData
+    lock.compact()
+    assert LockFile(generateLockfile)["project/bobsPart.dwg"]["expires"] == lock["project/bobsPart.dwg"]["expires"]
+    # Only expired locks are reaped, in batches
+    lock.lock("project/jeffsPart.dwg", "jeff", 10)
+    assert lock.reapExpired(time.time() + 15, 1) == ["project/jeffsPart.dwg"]
+    assert lock.reapExpired(time.time() + 15) == []
+    assert lock.reapExpired(time.time() + 25) == ["project/bobsPart.dwg"]
+    assert lock.nextExpiry() is None
+    assert sorted(lock) == ["project/samsPart.dwg"]
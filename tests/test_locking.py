@@ -1,12 +1,46 @@
 import pytest
-from unittest import mock
 import os
+import time
+import shutil
+import tempfile
+import pygit2
 from meg_runtime.locking import LockingManager
 from meg_runtime.locking.lockFile import LockFile
+from meg_runtime.config import Config
+from meg_runtime.git import GitRepository
+
+
+@pytest.fixture()
+def generateRemote():
+    tempPath = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    remote = pygit2.init_repository(os.path.join(tempPath, "remote.git"), bare=True)
+    signature = pygit2.Signature("test", "test@localhost")
+    builder = remote.TreeBuilder()
+    builder.insert("README.md", remote.create_blob(b"readme"), pygit2.GIT_FILEMODE_BLOB)
+    remote.create_commit("HEAD", signature, signature, "Initial commit", builder.write(), [])
+    clones = [pygit2.clone_repository(remote.path, os.path.join(tempPath, name)).workdir for name in ["alice", "bob"]]
+    yield remote, clones
+    os.chdir(cwd)
+    LockingManager._LockingManager__instance = None
+    shutil.rmtree(tempPath, True)
+
+
+def remoteLocks(remote):
+    return remote[remote.references["refs/meg/locks/" + remote.head.shorthand].target].tree
+
+
+def useClone(clone):
+    os.chdir(clone)
+    LockingManager._LockingManager__instance = None
 
 
 @pytest.fixture()
 def generateLocking():
+    # Use a directory outside of any repository so locks are never synced with the remote of the checkout
+    tempPath = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempPath)
     lock = LockFile(LockingManager.LOCKFILE_DIR + LockingManager.LOCKFILE_NAME)
     lock["project/jeffsPart.dwg"] = "jeff"
     lock["project/jeffs2ndPart.dwg"] = "bob"
@@ -15,8 +49,10 @@ def generateLocking():
     LockingManager._LockingManager__instance = None
     LockingManager()
     yield len(lock)
-    os.remove(LockingManager.LOCKFILE_DIR + LockingManager.LOCKFILE_NAME)
-    os.rmdir(LockingManager.LOCKFILE_DIR)
+    os.chdir(cwd)
+    LockingManager._LockingManager__instance = None
+    shutil.rmtree(tempPath, True)
+
 
 def test_findLock(generateLocking):
     entry = LockingManager.findLock("project/jeffs2ndPart.dwg")
@@ -25,14 +61,133 @@ def test_findLock(generateLocking):
     assert entry["user"] == "jeff"
     assert LockingManager.findLock("IOEFJIOFIJEFIOEFJIOEFJIKOEFJOIKEFKOPEFOPKEF") is None
 
+
 def test_addLock(generateLocking):
-    assert not LockingManager.addLock("project/jeffs2ndPart.dwg", "bob") #Lock belonging to user else already exists
-    assert not LockingManager.addLock("project/jeffsPart.dwg", "bob") #Lock belonging to someone else already exists
+    assert not LockingManager.addLock("project/jeffs2ndPart.dwg", "bob")  # Lock belonging to user else already exists
+    assert not LockingManager.addLock("project/jeffsPart.dwg", "bob")  # Lock belonging to someone else already exists
     assert LockingManager.addLock("morethings/aThing.svg", "bob")
     assert LockingManager.findLock("morethings/aThing.svg")["user"] == "bob"
 
+
 def test_removeLock(generateLocking):
-    assert LockingManager.removeLock("project/jeffsPart.dwg", "bob") == False #Lock belonging to someone else
+    assert LockingManager.removeLock("project/jeffsPart.dwg", "bob") == False  # Lock belonging to someone else
     assert LockingManager.removeLock("src/other.txt", "bob") == True
     assert len(LockingManager.locks()) == generateLocking - 1
 
+
+def test_findIndexedLocks(generateLocking):
+    assert list(LockingManager.findDescendantLocks("project")) == ["project/jeffs2ndPart.dwg", "project/jeffsPart.dwg"]
+    assert list(LockingManager.findPrefixLocks("src/")) == ["src/other.txt"]
+    assert LockingManager.hasDescendantLock("src")
+    assert LockingManager.findUserLocks("bob") == ["project/jeffs2ndPart.dwg", "src/other.txt"]
+    assert LockingManager.addLock("assets", "jeff")
+    assert LockingManager.findAncestorLock("assets/wood.png")[0] == "assets"
+
+
+def test_addLocks(generateLocking):
+    results = LockingManager.addLocks(["project/jeffsPart.dwg", "assets/a.png", "assets/b.png", "assets/a.png"], "bob")
+    assert results == {"project/jeffsPart.dwg": False, "assets/a.png": True, "assets/b.png": True}
+    assert LockingManager.findLock("assets/b.png")["user"] == "bob"
+    assert LockingManager.addLocks(LockingManager.LOCKFILE_DIR + "*.json", "bob") == {".meg/locks.json": True}
+
+
+def test_removeLocks(generateLocking):
+    assert LockingManager.removeLocks("project/*.dwg", "bob") == {"project/jeffs2ndPart.dwg": True, "project/jeffsPart.dwg": False}
+    assert LockingManager.removeLocks(["src/other.txt", "src/none.txt"], "bob") == {"src/other.txt": True, "src/none.txt": True}
+    assert len(LockingManager.locks()) == generateLocking - 2
+
+
+def test_updateLocks(generateRemote):
+    remote, (alice, bob) = generateRemote
+    # Locks are pushed to the locks reference of the branch without changing the branch
+    head = remote.head.target
+    useClone(alice)
+    assert LockingManager.addLock("project/part.dwg", "alice")
+    lockData = LockFile.parse(remoteLocks(remote)[".meg/locks.json"].data)
+    assert lockData["project/part.dwg"]["user"] == "alice"
+    assert remote.head.target == head
+    # Locks of other clones are merged before locking
+    useClone(bob)
+    assert not LockingManager.addLock("project/part.dwg", "bob")
+    assert LockingManager.addLock("project/other.dwg", "bob")
+    useClone(alice)
+    assert LockingManager.removeLock("project/part.dwg", "alice")
+    assert LockingManager.findLock("project/other.dwg")["user"] == "bob"
+    # Concurrent unsynced changes of different locks are both kept
+    lock = LockFile(os.path.join(bob, ".meg", "locks.json"))
+    lock["project/bobs.dwg"] = "bob"
+    lock.save()
+    LockingManager.locks()["project/alices.dwg"] = "alice"
+    LockingManager.updateLocks()
+    useClone(bob)
+    LockingManager.updateLocks()
+    assert sorted(LockingManager.locks()) == ["project/alices.dwg", "project/bobs.dwg", "project/other.dwg"]
+    # Syncing without changes does not commit
+    locksId = remote.references["refs/meg/locks/" + remote.head.shorthand].target
+    LockingManager.updateLocks()
+    assert remote.references["refs/meg/locks/" + remote.head.shorthand].target == locksId
+    assert len(LockFile.parse(remoteLocks(remote)[".meg/locks.json"].data)) == 3
+    # Fetching between syncs does not remove the locks of other clones
+    useClone(alice)
+    assert LockingManager.addLock("project/x.dwg", "alice")
+    useClone(bob)
+    pygit2.Repository(bob).remotes["origin"].fetch()
+    assert LockingManager.addLock("project/y.dwg", "bob")
+    lockData = LockFile.parse(remoteLocks(remote)[".meg/locks.json"].data)
+    assert "project/x.dwg" in lockData and "project/y.dwg" in lockData
+
+
+def test_updateLocksPull(generateRemote):
+    remote, (alice, bob) = generateRemote
+    useClone(alice)
+    assert LockingManager.addLock("project/part.dwg", "alice")
+    # The lockfile is excluded from the working tree status and the branch can still be pulled
+    repo = GitRepository(alice)
+    assert repo.status() == {}
+    other = GitRepository(bob)
+    other.push_commit("origin", other.commit_files(other.head.target, {"part.txt": b"part"}, "Add part"), other.head.shorthand)
+    assert repo.pull() == ["part.txt"]
+    assert repo.head.target == remote.head.target
+    assert LockingManager.findLock("project/part.dwg")["user"] == "alice"
+    assert LockingManager.addLock("project/other.dwg", "alice")
+    assert repo.pull() == []
+    assert repo.status() == {}
+
+
+def test_updateLocksJournal(generateRemote):
+    remote, (alice, bob) = generateRemote
+    Config.set("locking/journal", True)
+    try:
+        # Journaled locks are pushed as appended journal records
+        useClone(alice)
+        assert LockingManager.addLock("project/part.dwg", "alice")
+        useClone(bob)
+        assert LockingManager.addLock("project/other.dwg", "bob")
+        tree = remoteLocks(remote)
+        assert tree[".meg/locks.json.journal"].data.count(b"\n") == 2
+        assert LockFile.parse(tree[".meg/locks.json"].data, tree[".meg/locks.json.journal"].data) == dict(LockingManager.locks().items())
+        useClone(alice)
+        LockingManager.updateLocks()
+        assert LockingManager.findLock("project/other.dwg")["user"] == "bob"
+    finally:
+        Config.remove("locking/journal")
+
+
+def test_leases(generateLocking):
+    assert LockingManager.addLock("project/lease.dwg", "jeff", 0.2)
+    # A lock cannot be taken until it expires
+    assert not LockingManager.addLock("project/lease.dwg", "bob")
+    assert LockingManager.renewLock("project/lease.dwg", "jeff", 0.2)
+    assert not LockingManager.renewLock("project/lease.dwg", "bob", 0.2)
+    assert LockingManager.renewLocks("bob", ttl=60) == ["project/jeffs2ndPart.dwg", "src/other.txt"]
+    time.sleep(0.3)
+    assert LockingManager.addLocks(["project/lease.dwg"], "bob") == {"project/lease.dwg": True}
+    # The reaper removes locks when they expire
+    LockingManager.addLock("project/reaped.dwg", "jeff", 0.1)
+    LockingManager.startReaper(10)
+    try:
+        time.sleep(0.5)
+        assert LockingManager.findLock("project/reaped.dwg") is None
+        assert LockingManager.findLock("project/lease.dwg")["user"] == "bob"
+    finally:
+        LockingManager.stopReaper()
@@ -1,6 +1,7 @@
 """Runtime library unit testing for permissions"""
 
 import os
+import json
 import pytest
 from meg_runtime import PermissionsManager
 
@@ -31,3 +32,96 @@ def test_permissions_02(change_to_test_directory):
     assert perms.can_write('a')
     assert not perms.can_read('b')
     assert not perms.can_write('b')
+
+
+def test_permissions_reload(tmp_path):
+    path = str(tmp_path / 'permissions.json')
+    with open(path, 'w') as permissions_file:
+        json.dump({'roles': {'manager': ['user1']},
+                   'files': {'a': {'users_read': [], 'users_write': [], 'roles_read': ['manager'], 'roles_write': []}}},
+                  permissions_file)
+    perms = PermissionsManager(path, 'user1')
+    assert perms.can_read('a')
+    assert not perms.can_write('a')
+    assert perms._get_roles() == ['manager']
+    # The compiled permissions are not rebuilt if the file did not change
+    rules = perms._rules
+    assert not perms.reload()
+    assert perms._rules is rules
+    # The compiled permissions are rebuilt when the file changes
+    with open(path, 'w') as permissions_file:
+        json.dump({'roles': {'reviewer': ['user1'], 'manager': [], 'engineer': ['user1', 'user1']},
+                   'files': {'a': {'users_read': [], 'users_write': ['user1'], 'roles_read': ['manager'], 'roles_write': []}}},
+                  permissions_file)
+    assert perms.reload()
+    assert not perms.can_read('a')
+    assert perms.can_write('a')
+    # The roles are in definition order
+    assert perms._get_roles() == ['reviewer', 'engineer']
+
+
+def test_permissions_rules(tmp_path):
+    path = str(tmp_path / 'permissions.json')
+
+    def rule(users_read, users_write):
+        return {'users_read': users_read, 'users_write': users_write, 'roles_read': [], 'roles_write': []}
+    with open(path, 'w') as permissions_file:
+        json.dump({'roles': {}, 'files': {
+            'assets': rule(['user1'], []),
+            'assets/**/*.psd': rule(['user1'], ['user1']),
+            'assets/textures/': rule([], []),
+            'assets/textures/wood.psd': rule(['user1'], ['user1']),
+            'src/*/main.py': rule(['user1'], ['user1']),
+        }}, permissions_file)
+    perms = PermissionsManager(path, 'user1')
+    # Directories are inherited by their descendants
+    assert perms.can_read('assets')
+    assert perms.can_read('assets/models/chair.obj')
+    assert not perms.can_write('assets/models/chair.obj')
+    # Patterns are more specific than the directories they are in
+    assert perms.can_write('assets/chair.psd')
+    assert perms.can_write('assets/models/chair.psd')
+    # Deeper directories are more specific than patterns, files are the most specific
+    assert not perms.can_read('assets/textures/stone.psd')
+    assert perms.can_write('assets/textures/wood.psd')
+    assert perms.can_write('src/app/main.py')
+    assert not perms.can_read('src/app/other.py')
+    assert not perms.can_read('other')
+    # Checking many paths gives the same permissions as checking each path
+    paths = ['assets', 'assets/a.psd', 'assets/textures/stone.psd', 'assets/textures/wood.psd', 'assets/textures/sub/a.psd',
+             'assets/models/chair.obj', 'src/app/main.py', 'src/app/other.py', 'other']
+    assert perms.check_paths(paths) == {path: (perms.can_read(path), perms.can_write(path), perms.can_lock(path)) for path in paths}
+
+
+def test_permissions_check_paths(change_to_test_directory):
+    perms = PermissionsManager('test_permissions_01.json', 'user2')
+    assert perms.can_lock('b')
+    assert not perms.can_lock('a')
+    assert perms.check_paths(['a', 'b', 'c']) == {'a': (True, False, False), 'b': (True, True, True), 'c': (False, False, False)}
+    assert perms.filter_paths(['a', 'b', 'c']) == ['a', 'b']
+    assert perms.filter_paths(['a', 'b', 'c'], 'lock') == ['b']
+
+
+def test_permissions_stats(change_to_test_directory):
+    perms = PermissionsManager('test_permissions_01.json', 'user1')
+    assert perms.stats() is None
+    perms = PermissionsManager('test_permissions_01.json', 'user1', stats=True)
+    perms.can_read('a')
+    perms.can_lock('a')
+    perms.can_read('c')
+    perms.can_read('c')
+    perms.check_paths(['a', 'b', 'c'])
+    stats = perms.stats()
+    assert stats['checks'] == {'read': 4, 'write': 1, 'lock': 1, 'bulk': 1}
+    assert stats['paths']['bulk'] == 3
+    assert stats['cache']['hits'] == 1 and stats['cache']['misses'] == 1
+    assert stats['load']['count'] == 1 and stats['compile']['count'] == 1
+    # Every check is sampled as slow with no threshold
+    perms.enable_stats(0)
+    perms.can_write('b')
+    stats = perms.stats()
+    assert stats['checks']['write'] == 1 and stats['checks']['read'] == 0
+    assert stats['slow']['count'] == 1
+    assert stats['slow']['samples'][0]['path'] == 'b'
+    perms.disable_stats()
+    assert perms.stats() is None
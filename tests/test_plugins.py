@@ -78,3 +78,11 @@ def test_plugins_install_archive_from_url():
     assert PluginManager.install_archive_from_url('https://github.com/MultimediaExtensibleGit/Plugins/archive/master.tar.gz')
     assert PluginManager.load('test')
     assert PluginManager.uninstall('test')
+
+
+# Plugin remote archives install test with urls that can not be downloaded
+def test_plugins_install_archives_from_urls():
+    """Plugin remote archives install test with urls that can not be downloaded"""
+    assert not PluginManager.install_archives_from_urls([])
+    assert not PluginManager.install_archives_from_urls(['https://localhost/'])
+    assert not PluginManager.install_archives_from_urls([None])